@@ -8,19 +8,22 @@ import argparse
 from collections import namedtuple
 import json
 from multiprocessing.connection import Listener, Client
-from netaddr import IPNetwork, IPAddress
+from netaddr import AddrFormatError, IPNetwork
 import os
 import socket
-import struct
 import sys
 from threading import Thread, Lock
+import time
 
 np = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 if np not in sys.path:
     sys.path.append(np)
 import util.log
 
-from utils import parse_packet, craft_arp_packet, craft_eth_frame, craft_garp_response
+from cache import ArpReplyCache
+from capture import ArpCapture, MAX_TARGETS
+from ratelimit import TokenBucket, RequestLimiter
+from utils import ARP_FRAME, parse_arp, mac_to_str, ip_to_str, mac_to_bytes, ip_to_int, mac_bytes, garp_reply
 
 
 logger = util.log.getLogger('arp')
@@ -28,13 +31,40 @@ logger = util.log.getLogger('arp')
 ETH_BROADCAST = 'ff:ff:ff:ff:ff:ff'
 ETH_TYPE_ARP = 0x0806
 
-Config = namedtuple('Config', 'vnhs garp_socket interface')
+# seconds between two logs of the reply cache's hit rate and the request counters
+CACHE_LOG_INTERVAL = 60
+
+# garp messages of a pctrl turned into frames before they are sent
+GARP_BATCH_SIZE = 256
+
+# gratuitous ARPs sent per millisecond, unless the config says otherwise
+GARP_RATE = 100
+
+# seconds a request isn't relayed again, and requests relayed per second
+# and participant port, unless the config says otherwise
+HOLD_DOWN = 1.0
+REQUEST_RATE = 50
+REQUEST_BURST = 10
+
+# seconds between two checks whether the config file changed
+CONFIG_CHECK_INTERVAL = 5
+
+# prefix lengths tried to cover the next-hops in the socket filter, longest first
+NEXTHOP_PREFIXLENS = (24, 16, 8, 0)
+
+Config = namedtuple('Config', 'vnhs vnh_network vnh_netmask garp_socket interface garp_rate hold_down request_rate request_burst nonSDN_nhip_2_nhmac participant_macs')
 
 arpListener = None
 config = None
 
+# serializes the updates of portmac2Participant, readers don't take it
 participantsLock = Lock()
+# port mac (bytes) -> PctrlClient, replaced as a whole on every update
 portmac2Participant = {}
+# PctrlClient -> its port macs
+participant2Macs = {}
+
+arpCache = ArpReplyCache()
 
 clientPoolLock = Lock()
 clientActivePool = dict()
@@ -45,6 +75,8 @@ class PctrlClient(object):
     def __init__(self, conn, addr):
         self.conn = conn
         self.addr = addr
+        # garp frames waiting to be sent
+        self.replies = []
 
     def start(self):
         logger.info('ARP Pctrl Client started for client ip %s.', self.addr)
@@ -55,15 +87,30 @@ class PctrlClient(object):
                 rv = None
 
             if not (rv and self.process_message(**json.loads(rv))):
+                self.send_replies()
                 self.close()
                 break
 
+            # send the garps of a burst together
+            if len(self.replies) >= GARP_BATCH_SIZE or not self.conn.poll():
+                self.send_replies()
+
+
+    def send_replies(self):
+        if self.replies:
+            arpListener.send_garps(self.replies)
+            self.replies = []
+
 
     def process_message(self, msgType=None, **data):
         if msgType == 'hello':
             rv = self.process_hello_message(**data)
         elif msgType == 'garp':
             rv = self.process_garp_message(**data)
+        elif msgType == 'garps':
+            rv = self.process_garps_message(**data)
+        elif msgType == 'invalidate':
+            rv = self.process_invalidate_message(**data)
         else:
             logger.warn("Unrecognized or absent msgType: %s. Message ignored.", msgType)
             rv = True
@@ -72,10 +119,16 @@ class PctrlClient(object):
 
 
     def process_hello_message(self, macs=None):
+        global portmac2Participant
+
         if isinstance(macs, list):
+            macs = [mac_to_bytes(mac) for mac in macs]
             with participantsLock:
+                portmacs = dict(portmac2Participant)
                 for mac in macs:
-                    portmac2Participant[mac] = self
+                    portmacs[mac] = self
+                participant2Macs.setdefault(self, set()).update(macs)
+                portmac2Participant = portmacs
         else:
             logger.warn("hello message from %s is missing MAC list. 'macs' has value: %s. Closing connection.", self.addr, macs)
             return False
@@ -102,8 +155,45 @@ class PctrlClient(object):
         else:
             logger.debug("Gratuitous ARP relayed: "+str(data))
 
-        garp_message = craft_garp_response(**data)
-        arpListener.send(garp_message)
+        reply = garp_reply(**data)
+
+        # later requests for this VNH are answered by the proxy itself
+        arpCache.update(self, reply[3], reply[2])
+
+        self.replies.append(reply)
+
+        return True
+
+
+    def process_garps_message(self, garps=None, eth_dsts=None):
+        "Bulk gratuitous ARPs: each (vnh, vmac) of garps is sent to each of eth_dsts"
+        if not (isinstance(garps, list) and isinstance(eth_dsts, list)):
+            logger.warn("garps message from %s is missing its garps or eth_dsts. Message ignored.", self.addr)
+            return True
+
+        logger.debug("Gratuitous ARPs relayed: %d VNHs to %d ports", len(garps), len(eth_dsts))
+
+        eth_dsts = [mac_to_bytes(eth_dst) for eth_dst in eth_dsts]
+        for vnh, vmac in garps:
+            vnh = ip_to_int(vnh)
+            vmac = mac_to_bytes(vmac)
+            arpCache.update(self, vnh, vmac)
+            for eth_dst in eth_dsts:
+                self.replies.append((eth_dst, vmac, vmac, vnh, vmac, vnh))
+
+        return True
+
+
+    def process_invalidate_message(self, vnhs=None):
+        "The pctrl freed these VNHs, requests for them go to the pctrl again"
+        if not isinstance(vnhs, list):
+            logger.warn("invalidate message from %s is missing its vnhs. Message ignored.", self.addr)
+            return True
+
+        logger.debug("VNHs invalidated: %d", len(vnhs))
+
+        for vnh in vnhs:
+            arpCache.remove(self, ip_to_int(vnh))
 
         return True
 
@@ -117,6 +207,18 @@ class PctrlClient(object):
 
 
     def close(self):
+        global portmac2Participant
+
+        # the capture thread doesn't find this pctrl anymore
+        with participantsLock:
+            macs = participant2Macs.pop(self, ())
+            portmacs = dict(portmac2Participant)
+            for mac in macs:
+                # unless another pctrl took it over
+                if portmacs.get(mac) is self:
+                    del portmacs[mac]
+            portmac2Participant = portmacs
+
         with clientPoolLock:
             s, t = clientActivePool[self.conn]
             del clientActivePool[self.conn]
@@ -126,10 +228,7 @@ class PctrlClient(object):
 
         self.conn.close()
 
-        with participantsLock:
-            macs = [mac for mac,pctl in portmac2Participant.items() if pctl == self]
-            for mac in macs:
-                del portmac2Participant[mac]
+        arpCache.remove_client(self)
 
 
 class PctrlListener(object):
@@ -157,66 +256,138 @@ class PctrlListener(object):
 
 class ArpListener(object):
     def __init__(self):
-        # info about non-sdn participants
-        # TODO: Create a mapping between actual interface IP addresses
-        # and the corresponding MAC addresses for all the non-SDN participants
-        # In case of MDS, it is actual mac adresses of these interfaces, in case
-        # of the superset scheme it is : 1XXXX-nexthop_id
-        # self.nonSDN_nhip_2_nhmac = {}
+        # info about non-sdn participants: next-hop ip -> mac they are answered with
+        self.nonSDN_nhip_2_nhmac = config.nonSDN_nhip_2_nhmac
+        # port mac -> ips of the participant's ports with that mac
+        self.participant_macs = config.participant_macs
         try:
-            self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.ntohs(ETH_TYPE_ARP))
-            self.sock.bind((config.interface, 0))
+            # only ARP requests for VNHs and next-hops make it out of the kernel
+            self.capture = ArpCapture(config.interface, self.filter_targets(config))
         except socket.error as msg:
             logger.error("Can't open socket %s", str(config.interface))
             logger.exception('Failed to create socket. Error Code : ' + str(msg[0]) + ' Message ' + msg[1])
             raise
 
+        self.last_cache_log = time.time()
 
-    def start(self):
-        while True:
-            # receive arp requests
-            packet, addr = self.sock.recvfrom(65565)
-            eth_frame, arp_packet = parse_packet(packet)
+        # gratuitous ARPs of all pctrls are paced together
+        self.garp_bucket = TokenBucket(config.garp_rate * 1000, config.garp_rate)
+        self.garp_lock = Lock()
 
-            arp_type = struct.unpack("!h", arp_packet["oper"])[0]
-            logger.debug("Received ARP-" + ("REQUEST" if (arp_type == 1) else "REPLY") +" SRC: "+eth_frame["src_mac"]+" / "+arp_packet["src_ip"]+" "+"DST: "+eth_frame["dst_mac"]+" / "+arp_packet["dst_ip"])
+        # keeps routers re-ARPing from flooding the pctrls
+        self.limiter = RequestLimiter(config.hold_down, config.request_rate, config.request_burst)
+
+
+    def filter_targets(self, config):
+        "The VNH range and the subnets of the next-hops, process_nexthop_request checks the exact ips"
+        # one compare per target, so the next-hops are covered by as few subnets as fit
+        for prefixlen in NEXTHOP_PREFIXLENS:
+            netmask = (0xffffffff << (32 - prefixlen)) & 0xffffffff
+            subnets = set(nhip & netmask for nhip in config.nonSDN_nhip_2_nhmac)
+            if len(subnets) < MAX_TARGETS:
+                break
+
+        targets = [(config.vnh_network, config.vnh_netmask)]
+        targets.extend((subnet, netmask) for subnet in sorted(subnets))
+        return targets
 
-            if arp_type == 1:
-                # check if the arp request stems from one of the participants
-                requester_srcmac = eth_frame["src_mac"]
-                requested_ip = arp_packet["dst_ip"]
-                # Send the ARP request message to respective controller and forget about it
-                if IPAddress(requested_ip) in config.vnhs:
-                    self.send_arp_request(requester_srcmac, requested_ip)
-    
-                    # TODO: If the requested IP address belongs to a non-SDN participant
-                    # then refer the structure `self.nonSDN_nhip_2_nhmac` and
-                    # send an immediate ARP response.
-                    """
-                    response_vmac = self.get_vmac_default(requester_srcmac, requested_ip)
-                    if response_vmac != "":
-                        logger.debug("ARP-PROXY: reply with VMAC "+response_vmac)
-
-                        data = self.craft_arp_packet(arp_packet, response_vmac)
-                        eth_packet = self.craft_eth_frame(eth_frame, response_vmac, data)
-                        self.sock.send(''.join(eth_packet))
-                    """
-
-
-    def send_arp_request(self, requester_srcmac, requested_ip):
-        "Send the arp request to the corresponding pctrl"
-        with participantsLock:
-            try:
-                pctrlClient = portmac2Participant[requester_srcmac]
-            except KeyError:
-                pctrlClient = None
 
+    def reload(self, config):
+        "Take over the next-hops and the GARP rate of a changed config"
+        # first, nothing is taken over if the filter can't be attached
+        self.capture.set_filter(self.filter_targets(config))
+        self.nonSDN_nhip_2_nhmac = config.nonSDN_nhip_2_nhmac
+        self.participant_macs = config.participant_macs
+        with self.garp_lock:
+            self.garp_bucket = TokenBucket(config.garp_rate * 1000, config.garp_rate)
+        self.limiter.configure(config.hold_down, config.request_rate, config.request_burst)
+
+
+    def start(self):
+        for buf, frames in self.capture.batches():
+            now = time.time()
+            replies = []
+            for offset, length in frames:
+                if length >= ARP_FRAME.size:
+                    self.process_frame(buf, offset, replies, now)
+
+            if replies:
+                self.send_replies(replies)
+
+            if now - self.last_cache_log >= CACHE_LOG_INTERVAL:
+                self.last_cache_log = now
+                logger.info("ARP reply cache: %s", arpCache.stats())
+                logger.info("ARP requests: %s", self.limiter.stats())
+
+
+    def process_frame(self, buf, offset, replies, now):
+        eth_src, eth_type, arp_type, sha, spa, tpa = parse_arp(buf, offset)
+
+        # the socket filter passes ARP requests for VNHs and next-hop subnets only,
+        # but frames may have been queued before it was attached
+        if eth_type != ETH_TYPE_ARP or arp_type != 1:
+            return
+        if tpa & config.vnh_netmask != config.vnh_network:
+            self.process_nexthop_request(eth_src, spa, tpa, replies)
+            return
+
+        # check if the arp request stems from one of the participants
+        requester_srcmac = mac_to_str(eth_src)
+        requested_ip = ip_to_str(tpa)
+        logger.debug("Received ARP-REQUEST SRC: %s / %s DST: %s", requester_srcmac, ip_to_str(spa), requested_ip)
+
+        pctrlClient = self.get_participant(eth_src)
         if pctrlClient:
-            pctrlClient.send(requester_srcmac, requested_ip)
+            # answer from the VMACs the participant's controller sent before
+            vmac = arpCache.lookup(pctrlClient, tpa)
+            if vmac is not None:
+                replies.append((eth_src, vmac, vmac, tpa, eth_src, spa))
+            elif self.limiter.allow(eth_src, tpa, now):
+                # Send the ARP request message to respective controller and forget about it
+                pctrlClient.send(requester_srcmac, requested_ip)
+
+
+    def process_nexthop_request(self, eth_src, spa, tpa, replies):
+        "Answer a non-SDN participant asking for a next-hop right away"
+        nhmac = self.nonSDN_nhip_2_nhmac.get(tpa)
+        if nhmac is None:
+            return
+        # the route server talks to the participants' routers directly, and
+        # participants with an SDN controller only use VNHs as next-hops
+        if eth_src not in self.participant_macs or self.get_participant(eth_src):
+            return
+        # gratuitous ARPs and duplicate address probes of a router for its
+        # own address, an answer would look like an address conflict
+        if tpa == spa or tpa in self.participant_macs[eth_src]:
+            return
+
+        logger.debug("ARP-PROXY: reply to %s for %s with %s", mac_to_str(eth_src), ip_to_str(tpa), mac_to_str(nhmac))
+        replies.append((eth_src, nhmac, nhmac, tpa, eth_src, spa))
+
+
+    def get_participant(self, requester_srcmac):
+        "The pctrl of the participant the mac (bytes) belongs to"
+        return portmac2Participant.get(requester_srcmac)
 
 
     def send(self, data):
-        self.sock.send(data)
+        self.capture.send(data)
+
+
+    def send_replies(self, replies):
+        self.capture.send_replies(replies)
+
+
+    def send_garps(self, replies):
+        "Send the replies of the pctrls, at most config.garp_rate per millisecond"
+        rate = config.garp_rate
+        for i in range(0, len(replies), rate):
+            chunk = replies[i:i + rate]
+            with self.garp_lock:
+                delay = self.garp_bucket.reserve(len(chunk))
+            if delay:
+                time.sleep(delay)
+            self.send_replies(chunk)
 
 
 def parse_config(config_file):
@@ -232,7 +403,74 @@ def parse_config(config_file):
 
     interface = config["ARP Proxy"]["Interface"]
 
-    return Config(vnhs, garp_socket, interface)
+    garp_rate = int(config["ARP Proxy"].get("GARP Rate", GARP_RATE))
+
+    hold_down = float(config["ARP Proxy"].get("Hold Down", HOLD_DOWN))
+    request_rate = float(config["ARP Proxy"].get("Request Rate", REQUEST_RATE))
+    request_burst = float(config["ARP Proxy"].get("Request Burst", REQUEST_BURST))
+
+    nonSDN_nhip_2_nhmac = get_nexthop_macs(config)
+    participant_macs = {}
+    for participant in config["Participants"].values():
+        for port in participant["Ports"]:
+            participant_macs.setdefault(mac_to_bytes(port["MAC"]), set()).add(ip_to_int(port["IP"]))
+
+    return Config(vnhs, int(vnhs.network), int(vnhs.netmask), garp_socket, interface, garp_rate,
+                  hold_down, request_rate, request_burst, nonSDN_nhip_2_nhmac, participant_macs)
+
+
+def get_nexthop_macs(config):
+    "Map the ip of every participant port to the mac non-SDN participants reach it with"
+    superset = config["VMAC"]["Mode"] == "Superset"
+    vmac_size = config["VMAC"]["Options"]["VMAC Size"]
+
+    nexthop_macs = {}
+    for part, participant in config["Participants"].items():
+        for port in participant["Ports"]:
+            if superset:
+                # 1XXXX-nexthop_id, vmac_next_hop_match with the inbound bit in pctrl/ss_lib.py
+                nhmac = mac_bytes((1 << (vmac_size - 1)) | int(part))
+            else:
+                # in case of MDS, the actual mac of the interface
+                nhmac = mac_to_bytes(port["MAC"])
+            nexthop_macs[ip_to_int(port["IP"])] = nhmac
+
+    return nexthop_macs
+
+
+def watch_config(config_file):
+    "Reload the config whenever the file changes"
+    global config
+
+    mtime = os.stat(config_file).st_mtime
+    while True:
+        time.sleep(CONFIG_CHECK_INTERVAL)
+        try:
+            new_mtime = os.stat(config_file).st_mtime
+        except OSError:
+            continue
+        if new_mtime == mtime:
+            continue
+        mtime = new_mtime
+
+        try:
+            new_config = parse_config(config_file)
+        except (ValueError, KeyError, TypeError, AttributeError, EnvironmentError, socket.error, AddrFormatError) as e:
+            # maybe caught in the middle of a rewrite, the next change is tried again
+            logger.error("Can't reload config file %s, keeping the old one: %s", config_file, e)
+            continue
+
+        if (new_config.interface, new_config.garp_socket) != (config.interface, config.garp_socket):
+            logger.warn("Interface and GARP_SOCKET changes take effect after a restart")
+        new_config = new_config._replace(interface=config.interface, garp_socket=config.garp_socket)
+        try:
+            arpListener.reload(new_config)
+        except (ValueError, socket.error) as e:
+            logger.error("Can't apply config file %s, keeping the old one: %s", config_file, e)
+            continue
+
+        config = new_config
+        logger.info("Reloaded config file %s", config_file)
 
 
 def main():
@@ -253,6 +491,10 @@ def main():
     ap_thread = Thread(target=arpListener.start)
     ap_thread.start()
 
+    cw_thread = Thread(target=watch_config, args=(config_file,))
+    cw_thread.daemon = True
+    cw_thread.start()
+
     # start pctrl listener in foreground
     logger.info("Starting PCTRL Listener")
     pctrlListener = PctrlListener()
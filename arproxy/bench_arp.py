@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+'''
+Offline benchmark of the ARP proxy's capture path.
+
+Replays the frames of a pcap, mixed with synthetic ARP requests for the
+VNH range (the bundled capture only holds replies), through the old parser
+(dicts of strings plus a netaddr lookup) and through parse_arp with the
+integer VNH check. Runs the socket filter over the same frames to check
+that it passes exactly the requests the proxy relays, and builds the
+replies to those requests from the template.
+'''
+
+import argparse
+import os
+import struct
+import sys
+import time
+
+np = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if np not in sys.path:
+    sys.path.append(np)
+
+from netaddr import IPAddress, IPNetwork
+
+from capture import arp_request_filter, BPF_LD_H_ABS, BPF_LD_W_ABS, BPF_JEQ_K, BPF_AND_K, BPF_TAX, BPF_TXA, BPF_RET_K
+from utils import ARP_FRAME, ARP_REPLY_SIZE, ETH_TYPE_ARP, init_arp_replies, parse_arp, parse_packet, patch_arp_reply
+
+PCAP = os.path.join(np, 'examples', 'test-ms', 'arp_bgp.pcap')
+VNHS = '172.0.1.1/24'
+
+PCAP_HEADER = struct.Struct('<IHHiIII')
+PCAP_RECORD = struct.Struct('<IIII')
+
+# eth dst, eth src, eth type, htype, ptype, hlen, plen, oper, SHA, SPA, THA, TPA
+ARP_REQUEST = struct.Struct('!6s6sHHHBBH6sI6sI')
+
+
+def read_pcap(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    magic = PCAP_HEADER.unpack_from(data)[0]
+    if magic != 0xa1b2c3d4:
+        raise ValueError('%s: not a little endian pcap' % path)
+
+    frames = []
+    offset = PCAP_HEADER.size
+    while offset + PCAP_RECORD.size <= len(data):
+        _, _, caplen, _ = PCAP_RECORD.unpack_from(data, offset)
+        offset += PCAP_RECORD.size
+        frames.append(data[offset:offset + caplen])
+        offset += caplen
+    return frames
+
+
+def arp_requests(vnhs, count):
+    "Requests of participant routers for the VNHs, as the proxy sees them"
+    frames = []
+    first, size = int(vnhs.network) + 1, vnhs.size - 2
+    for i in xrange(count):
+        mac = struct.pack('!HI', 0x0800, 0x27000000 + i % 64)
+        frames.append(ARP_REQUEST.pack('\xff' * 6, mac, ETH_TYPE_ARP, 1, 0x0800, 6, 4, 1,
+                                       mac, 0xac000000 + 1 + i % 64, '\x00' * 6, first + i % size))
+    return frames
+
+
+def run_filter(program, frame):
+    "Interpret the classic BPF instructions arp_request_filter emits"
+    a = x = 0
+    pc = 0
+    while True:
+        code, jt, jf, k = program[pc]
+        pc += 1
+        if code == BPF_LD_H_ABS:
+            if k + 2 > len(frame):
+                return 0
+            a = struct.unpack_from('!H', frame, k)[0]
+        elif code == BPF_LD_W_ABS:
+            if k + 4 > len(frame):
+                return 0
+            a = struct.unpack_from('!I', frame, k)[0]
+        elif code == BPF_JEQ_K:
+            pc += jt if a == k else jf
+        elif code == BPF_AND_K:
+            a &= k
+        elif code == BPF_TAX:
+            x = a
+        elif code == BPF_TXA:
+            a = x
+        elif code == BPF_RET_K:
+            return k
+        else:
+            raise ValueError('unknown BPF instruction %#x' % code)
+
+
+def legacy(frames, vnhs):
+    relayed = 0
+    for packet in frames:
+        eth_frame, arp_packet = parse_packet(packet)
+        arp_type = struct.unpack("!h", arp_packet["oper"])[0]
+        if arp_type == 1 and IPAddress(arp_packet["dst_ip"]) in vnhs:
+            relayed += 1
+    return relayed
+
+
+def unpacked(frames, vnhs):
+    network, netmask = int(vnhs.network), int(vnhs.netmask)
+    relayed = 0
+    for packet in frames:
+        eth_src, eth_type, arp_type, sha, spa, tpa = parse_arp(packet)
+        if eth_type == ETH_TYPE_ARP and arp_type == 1 and tpa & netmask == network:
+            relayed += 1
+    return relayed
+
+
+def replies(frames, vnhs):
+    "Answer each relayed request with a VMAC, in batches like ArpCapture.send_batches"
+    network, netmask = int(vnhs.network), int(vnhs.netmask)
+    buf = bytearray(64 * ARP_REPLY_SIZE)
+    init_arp_replies(buf, 0, 64)
+    vmac = '\xa0\x00\x00\x00\x00\x01'
+    sent = 0
+    for packet in frames:
+        eth_src, eth_type, arp_type, sha, spa, tpa = parse_arp(packet)
+        if eth_type == ETH_TYPE_ARP and arp_type == 1 and tpa & netmask == network:
+            patch_arp_reply(buf, (sent % 64) * ARP_REPLY_SIZE, eth_src, vmac, vmac, tpa, sha, spa)
+            sent += 1
+    return sent
+
+
+def measure(name, func, frames, vnhs, rounds):
+    start = time.time()
+    for _ in xrange(rounds):
+        relayed = func(frames, vnhs)
+    elapsed = max(time.time() - start, 1e-9)
+    print '%-10s %8d frames %10.0f frames/s %6d relayed' % (name, len(frames) * rounds, len(frames) * rounds / elapsed, relayed)
+    return relayed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pcap', nargs='?', default=PCAP, help='pcap to replay')
+    parser.add_argument('-v', '--vnhs', default=VNHS, help='VNH range')
+    parser.add_argument('-r', '--rounds', type=int, default=1000, help='times the pcap is replayed')
+    parser.add_argument('-n', '--requests', type=int, default=256, help='synthetic VNH requests added to the pcap')
+    args = parser.parse_args()
+
+    vnhs = IPNetwork(args.vnhs)
+    frames = read_pcap(args.pcap) + arp_requests(vnhs, args.requests)
+
+    # the old parser can't handle truncated frames, neither does the proxy read them
+    arp_frames = [f for f in frames if len(f) >= ARP_FRAME.size and struct.unpack_from('!H', f, 12)[0] == ETH_TYPE_ARP]
+
+    program = arp_request_filter([(int(vnhs.network), int(vnhs.netmask))])
+    passed = [f for f in frames if run_filter(program, f)]
+    print 'filter     %8d frames, %d ARP, %d passed' % (len(frames), len(arp_frames), len(passed))
+
+    relayed = measure('legacy', legacy, arp_frames, vnhs, args.rounds)
+    if measure('unpack', unpacked, arp_frames, vnhs, args.rounds) != relayed:
+        sys.exit('parsers disagree')
+    if relayed != len(passed):
+        sys.exit('filter disagrees with the parser')
+    if not passed:
+        sys.exit('no frame passed the filter, nothing was measured')
+    measure('filtered', unpacked, passed, vnhs, args.rounds)
+    if measure('replies', replies, passed, vnhs, args.rounds) != len(passed):
+        sys.exit('not every relayed request was answered')
+
+
+if __name__ == '__main__':
+    main()
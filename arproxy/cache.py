@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+#  Author:
+#  Rudiger Birkner (Networked Systems Group ETH Zurich)
+
+
+from threading import Lock
+
+
+''' VMACs the participant controllers answered with, per (participant, VNH) '''
+class ArpReplyCache(object):
+    def __init__(self):
+        # (pctrl client, vnh) -> vmac, read without the lock by the capture thread
+        self.vmacs = {}
+        # pctrl client -> its vnhs
+        self.client_vnhs = {}
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, client, vnh):
+        vmac = self.vmacs.get((client, vnh))
+        if vmac is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return vmac
+
+    def update(self, client, vnh, vmac):
+        "Learn the VMAC of a reply or gratuitous ARP, the latter replaces what was cached"
+        with self.lock:
+            self.vmacs[(client, vnh)] = vmac
+            self.client_vnhs.setdefault(client, set()).add(vnh)
+
+    def remove(self, client, vnh):
+        "The pctrl freed or reassigned the VNH, its cached VMAC is stale"
+        with self.lock:
+            if self.vmacs.pop((client, vnh), None) is not None:
+                self.client_vnhs[client].discard(vnh)
+
+    def remove_client(self, client):
+        with self.lock:
+            for vnh in self.client_vnhs.pop(client, ()):
+                del self.vmacs[(client, vnh)]
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def stats(self):
+        return 'entries=%d hits=%d misses=%d hit rate=%.1f%%' % (
+            len(self.vmacs), self.hits, self.misses, 100 * self.hit_rate())
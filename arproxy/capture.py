@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+#  Author:
+#  Rudiger Birkner (Networked Systems Group ETH Zurich)
+
+
+import ctypes
+import mmap
+import select
+import socket
+import struct
+from threading import Lock
+
+import util.log
+
+from utils import ETH_TYPE_ARP, ARP_REPLY_SIZE, ARP_REPLY_TEMPLATE, init_arp_replies, patch_arp_reply
+
+
+logger = util.log.getLogger('arp')
+
+SOL_PACKET = 263
+SO_ATTACH_FILTER = 26
+PACKET_RX_RING = 5
+PACKET_TX_RING = 13
+PACKET_VERSION = 10
+TPACKET_V2 = 1
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+TP_STATUS_AVAILABLE = 0
+TP_STATUS_SEND_REQUEST = 1
+TP_STATUS_WRONG_FORMAT = 4
+
+# struct tpacket2_hdr: status, len, snaplen, mac, net, ...
+TPACKET2_HDR = struct.Struct('IIIHH')
+STATUS = struct.Struct('I')
+TX_LEN = struct.Struct('I')
+# frames to send start right after the tpacket2_hdr
+TX_DATA = 32
+
+# ARP frames are 42 bytes (60 with padding), a frame of the ring holds
+# the tpacket2_hdr, the sockaddr_ll and the ethernet frame
+FRAME_SIZE = 256
+BLOCK_SIZE = 4096
+BLOCK_NR = 64
+TX_BLOCK_NR = 16
+
+# frames read or built at once without the rings
+BATCH_SIZE = 64
+
+# classic BPF
+BPF_LD_H_ABS = 0x28
+BPF_LD_W_ABS = 0x20
+BPF_JEQ_K = 0x15
+BPF_AND_K = 0x54
+BPF_TAX = 0x07
+BPF_TXA = 0x87
+BPF_RET_K = 0x06
+
+SOCK_FILTER = struct.Struct('HBBI')
+# instructions the kernel takes, jt and jf are 8 bit offsets
+BPF_MAXINSNS = 4096
+BPF_MAX_JUMP = 0xff
+# every target adds 3 instructions between the first one and ACCEPT
+MAX_TARGETS = 64
+
+ACCEPT = 'accept'
+DROP = 'drop'
+
+
+def arp_request_filter(targets):
+    "BPF program passing only ARP requests for an address in one of the (network, netmask) targets"
+    program = [(BPF_LD_H_ABS, 0, 0, 12),
+               (BPF_JEQ_K, 0, DROP, ETH_TYPE_ARP),
+               # oper
+               (BPF_LD_H_ABS, 0, 0, 20),
+               (BPF_JEQ_K, 0, DROP, 1),
+               # target protocol address
+               (BPF_LD_W_ABS, 0, 0, 38),
+               (BPF_TAX, 0, 0, 0)]
+    for network, netmask in targets:
+        program.extend([(BPF_TXA, 0, 0, 0),
+                        (BPF_AND_K, 0, 0, netmask),
+                        (BPF_JEQ_K, ACCEPT, 0, network)])
+    program.extend([(BPF_RET_K, 0, 0, 0),
+                    (BPF_RET_K, 0, 0, 0xffff)])
+
+    if len(program) > BPF_MAXINSNS:
+        raise ValueError('socket filter for %d targets has %d instructions, the kernel takes at most %d' % (
+            len(targets), len(program), BPF_MAXINSNS))
+
+    # resolve the jumps, they are relative to the next instruction
+    labels = {DROP: len(program) - 2, ACCEPT: len(program) - 1}
+    resolved = []
+    for i, (code, jt, jf, k) in enumerate(program):
+        jt = labels[jt] - i - 1 if jt in labels else jt
+        jf = labels[jf] - i - 1 if jf in labels else jf
+        if max(jt, jf) > BPF_MAX_JUMP:
+            raise ValueError('socket filter for %d targets jumps %d instructions at %d, at most %d targets fit' % (
+                len(targets), max(jt, jf), i, MAX_TARGETS))
+        resolved.append((code, jt, jf, k))
+
+    return resolved
+
+
+def attach_filter(sock, program):
+    code = ''.join(SOCK_FILTER.pack(*insn) for insn in program)
+    buf = ctypes.create_string_buffer(code, len(code))
+    # struct sock_fprog, the kernel copies the program
+    fprog = struct.pack('HL', len(program), ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+''' reads ARP requests from a raw socket, filtered in the kernel and in batches '''
+class ArpCapture(object):
+    def __init__(self, interface, targets):
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.ntohs(ETH_TYPE_ARP))
+        self.set_filter(targets)
+        self.sock.bind((interface, 0))
+
+        self.poll = select.poll()
+        self.poll.register(self.sock, select.POLLIN)
+
+        self.tx_lock = Lock()
+        self.tx_frame_nr = 0
+        try:
+            self.ring = self.map_ring()
+        except (socket.error, EnvironmentError) as e:
+            logger.warn("PACKET_MMAP ring not available, reading with recv: %s", e)
+            self.ring = None
+            self.tx_frame_nr = 0
+            self.buf = bytearray(BATCH_SIZE * FRAME_SIZE)
+            self.view = memoryview(self.buf)
+
+        if not self.tx_frame_nr:
+            self.tx_buf = bytearray(BATCH_SIZE * ARP_REPLY_SIZE)
+            init_arp_replies(self.tx_buf, 0, BATCH_SIZE)
+            self.tx_view = memoryview(self.tx_buf)
+
+    def set_filter(self, targets):
+        attach_filter(self.sock, arp_request_filter(targets))
+
+    def map_ring(self):
+        self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V2)
+        frame_nr = BLOCK_SIZE / FRAME_SIZE * BLOCK_NR
+        self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, struct.pack('IIII', BLOCK_SIZE, BLOCK_NR, FRAME_SIZE, frame_nr))
+        self.frame_nr = frame_nr
+        self.frame = 0
+
+        # the TX ring is mapped right after the RX ring
+        tx_frame_nr = BLOCK_SIZE / FRAME_SIZE * TX_BLOCK_NR
+        try:
+            self.sock.setsockopt(SOL_PACKET, PACKET_TX_RING, struct.pack('IIII', BLOCK_SIZE, TX_BLOCK_NR, FRAME_SIZE, tx_frame_nr))
+            self.tx_frame_nr = tx_frame_nr
+        except socket.error as e:
+            logger.warn("PACKET_MMAP TX ring not available, sending with send: %s", e)
+        self.tx_offset = BLOCK_SIZE * BLOCK_NR
+        self.tx_frame = 0
+
+        size = BLOCK_SIZE * (BLOCK_NR + (TX_BLOCK_NR if self.tx_frame_nr else 0))
+        ring = mmap.mmap(self.sock.fileno(), size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+        # only the addresses of the replies are written when sending
+        init_arp_replies(ring, self.tx_offset + TX_DATA, self.tx_frame_nr, FRAME_SIZE)
+        return ring
+
+    def batches(self):
+        "Yield (buffer, [(offset, length)]) of the frames that arrived, blocking until there is one"
+        if self.ring is not None:
+            return self.ring_batches()
+        return self.recv_batches()
+
+    def ring_batches(self):
+        ring = self.ring
+        while True:
+            headers = []
+            frames = []
+            while len(headers) < self.frame_nr:
+                pos = self.frame * FRAME_SIZE
+                status, length, snaplen, mac, net = TPACKET2_HDR.unpack_from(ring, pos)
+                if not status & TP_STATUS_USER:
+                    break
+                headers.append(pos)
+                frames.append((pos + mac, snaplen))
+                self.frame = (self.frame + 1) % self.frame_nr
+
+            if not frames:
+                self.poll.poll()
+                continue
+
+            yield ring, frames
+
+            # hand the frames back to the kernel
+            for pos in headers:
+                STATUS.pack_into(ring, pos, TP_STATUS_KERNEL)
+
+    def recv_batches(self):
+        view = self.view
+        while True:
+            frames = [(0, self.sock.recv_into(view[0:FRAME_SIZE], FRAME_SIZE))]
+            # and whatever else is queued already
+            while len(frames) < BATCH_SIZE:
+                offset = len(frames) * FRAME_SIZE
+                try:
+                    length = self.sock.recv_into(view[offset:offset + FRAME_SIZE], FRAME_SIZE, socket.MSG_DONTWAIT)
+                except socket.error:
+                    break
+                frames.append((offset, length))
+
+            yield self.buf, frames
+
+    def send(self, data):
+        if not self.tx_frame_nr:
+            self.sock.send(data)
+            return
+
+        # with a TX ring the kernel only sends what is in the ring
+        data = str(data)
+        with self.tx_lock:
+            pos = self.tx_slot()
+            self.ring[pos + TX_DATA:pos + TX_DATA + len(data)] = data
+            self.tx_frame_ready(pos, len(data))
+            self.sock.send('')
+
+            # the slot is a reply template again
+            if data[12:22] != ARP_REPLY_TEMPLATE[12:22]:
+                self.ring[pos + TX_DATA:pos + TX_DATA + ARP_REPLY_SIZE] = ARP_REPLY_TEMPLATE
+
+    def send_replies(self, replies):
+        "Build the ARP replies, patch_arp_reply's arguments, in place and send them in as few calls as possible"
+        with self.tx_lock:
+            if self.tx_frame_nr:
+                self.send_ring(replies)
+            else:
+                self.send_batches(replies)
+
+    def tx_slot(self):
+        "Offset of the next frame of the TX ring, once the kernel is done with it"
+        pos = self.tx_offset + self.tx_frame * FRAME_SIZE
+        while True:
+            status = STATUS.unpack_from(self.ring, pos)[0]
+            if status == TP_STATUS_AVAILABLE:
+                return pos
+            if status & TP_STATUS_WRONG_FORMAT:
+                logger.warn("ARP reply rejected by the TX ring")
+                STATUS.pack_into(self.ring, pos, TP_STATUS_AVAILABLE)
+                return pos
+            # the ring is full, wait for the kernel to send what is queued
+            self.sock.send('')
+
+    def tx_frame_ready(self, pos, length):
+        TX_LEN.pack_into(self.ring, pos + 4, length)
+        STATUS.pack_into(self.ring, pos, TP_STATUS_SEND_REQUEST)
+        self.tx_frame = (self.tx_frame + 1) % self.tx_frame_nr
+
+    def send_ring(self, replies):
+        ring = self.ring
+        pending = False
+        for reply in replies:
+            pos = self.tx_slot()
+            patch_arp_reply(ring, pos + TX_DATA, *reply)
+            self.tx_frame_ready(pos, ARP_REPLY_SIZE)
+            pending = True
+
+        if pending:
+            self.sock.send('')
+
+    def send_batches(self, replies):
+        count = 0
+        for reply in replies:
+            patch_arp_reply(self.tx_buf, count * ARP_REPLY_SIZE, *reply)
+            count += 1
+            if count == BATCH_SIZE:
+                self.send_buf(count)
+                count = 0
+        self.send_buf(count)
+
+    def send_buf(self, count):
+        for i in xrange(count):
+            self.sock.send(self.tx_view[i * ARP_REPLY_SIZE:(i + 1) * ARP_REPLY_SIZE])
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+#  Author:
+#  Rudiger Birkner (Networked Systems Group ETH Zurich)
+
+
+import time
+
+
+''' token bucket, filling up with rate tokens per second up to burst '''
+class TokenBucket(object):
+    def __init__(self, rate, burst, now=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.time() if now is None else now
+
+    def refill(self, now):
+        if now > self.last:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+    def consume(self, n=1, now=None):
+        "Take n tokens if there are enough"
+        self.refill(time.time() if now is None else now)
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def reserve(self, n, now=None):
+        "Take n tokens, ahead of time if need be, and return the seconds until they are there"
+        self.refill(time.time() if now is None else now)
+        self.tokens -= n
+        if self.tokens < 0:
+            return -self.tokens / self.rate
+        return 0.0
+
+
+''' decides which ARP requests are relayed to the participant controllers '''
+class RequestLimiter(object):
+    def __init__(self, hold_down, rate, burst):
+        # (requester mac, target ip) -> when it was last relayed
+        self.relayed_at = {}
+        # requester mac -> its TokenBucket
+        self.buckets = {}
+        self.configure(hold_down, rate, burst)
+        self.last_prune = time.time()
+
+        self.relayed = 0
+        self.suppressed = 0
+        self.dropped = 0
+
+    def configure(self, hold_down, rate, burst):
+        self.hold_down = hold_down
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+
+    def allow(self, requester, target, now):
+        "Whether to relay the request, requests seen within the hold-down or over the port's rate are not"
+        key = (requester, target)
+        last = self.relayed_at.get(key)
+        if last is not None and now - last < self.hold_down:
+            self.suppressed += 1
+            return False
+
+        bucket = self.buckets.get(requester)
+        if bucket is None:
+            bucket = self.buckets[requester] = TokenBucket(self.rate, self.burst, now)
+        if not bucket.consume(1, now):
+            self.dropped += 1
+            return False
+
+        self.relayed_at[key] = now
+        self.relayed += 1
+
+        # forget the requests whose hold-down is over
+        if now - self.last_prune >= self.hold_down:
+            self.last_prune = now
+            self.relayed_at = dict((k, t) for k, t in self.relayed_at.iteritems() if now - t < self.hold_down)
+
+        return True
+
+    def stats(self):
+        return 'relayed=%d suppressed=%d dropped=%d' % (self.relayed, self.suppressed, self.dropped)
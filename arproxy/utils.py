@@ -8,12 +8,74 @@ ETH_TYPE_ARP = 0x0806
 eth_length = 14
 arp_length = 28
 
+# eth src, eth type, oper, SHA, SPA, TPA of an ARP frame
+ARP_FRAME = struct.Struct("!6x6sH6xH6sI6xI")
+# an ARP reply is the template with the addresses packed into it
+ARP_REPLY_SIZE = eth_length + arp_length
+ARP_REPLY_TEMPLATE = bytearray(ARP_REPLY_SIZE)
+struct.pack_into("!HHHBBH", ARP_REPLY_TEMPLATE, 12, ETH_TYPE_ARP, 1, 0x0800, 6, 4, 2)
+ARP_REPLY_TEMPLATE = str(ARP_REPLY_TEMPLATE)
+ETH_ADDRS = struct.Struct("!6s6s")
+ARP_ADDRS = struct.Struct("!6sI6sI")
+MAC = struct.Struct("!HI")
+IP = struct.Struct("!I")
+
 def parse_packet(packet):
     eth_frame = parse_eth_frame(packet[0:eth_length])
     arp_packet = parse_arp_packet(packet[eth_length:(eth_length+arp_length)])
 
     return eth_frame, arp_packet
 
+def parse_arp(buf, offset=0):
+    "Unpack (eth_src, eth_type, oper, SHA, SPA, TPA) straight from the buffer, addresses as bytes and ints"
+    return ARP_FRAME.unpack_from(buf, offset)
+
+def mac_to_str(mac):
+    return ':'.join('%02x' % ord(b) for b in mac)
+
+def ip_to_str(ip):
+    return socket.inet_ntoa(struct.pack("!I", ip))
+
+def mac_to_bytes(mac):
+    return binascii.unhexlify(mac.replace(':', ''))
+
+def ip_to_int(ip):
+    return IP.unpack(socket.inet_aton(str(ip)))[0]
+
+def mac_bytes(mac):
+    if isinstance(mac, (int, long)):
+        return MAC.pack(mac >> 32, mac & 0xffffffff)
+    return mac
+
+def ip_int(ip):
+    if isinstance(ip, str):
+        return IP.unpack(ip)[0]
+    return ip
+
+def arp_reply(eth_dst, eth_src, SHA, SPA, THA, TPA):
+    "The arguments of patch_arp_reply from MACs and IPs either as ints or as bytes"
+    return mac_bytes(eth_dst), mac_bytes(eth_src), mac_bytes(SHA), ip_int(SPA), mac_bytes(THA), ip_int(TPA)
+
+def init_arp_replies(buf, offset, count, stride=ARP_REPLY_SIZE):
+    "Copy the template into count frames of buf, patch_arp_reply fills in the rest"
+    for i in xrange(count):
+        buf[offset + i * stride:offset + i * stride + ARP_REPLY_SIZE] = ARP_REPLY_TEMPLATE
+
+def patch_arp_reply(buf, offset, eth_dst, eth_src, SHA, SPA, THA, TPA):
+    "Write the addresses, MACs as bytes and IPs as ints, of an ARP reply into the template at offset"
+    ETH_ADDRS.pack_into(buf, offset, eth_dst, eth_src)
+    ARP_ADDRS.pack_into(buf, offset + 22, SHA, SPA, THA, TPA)
+
+def craft_arp_reply(eth_dst, eth_src, SHA, SPA, THA, TPA):
+    frame = bytearray(ARP_REPLY_TEMPLATE)
+    patch_arp_reply(frame, 0, *arp_reply(eth_dst, eth_src, SHA, SPA, THA, TPA))
+    return frame
+
+def garp_reply(SPA, TPA, SHA, THA, eth_src, eth_dst):
+    "The arguments of patch_arp_reply for a garp message of the participant controller"
+    return (mac_to_bytes(eth_dst), mac_to_bytes(eth_src), mac_to_bytes(SHA), ip_to_int(SPA),
+            mac_to_bytes(THA), ip_to_int(TPA))
+
 def parse_eth_frame(frame):
     eth_detailed = struct.unpack("!6s6sH", frame)
 
@@ -71,34 +133,6 @@ def craft_garp_response(SPA, TPA, SHA, THA, eth_src, eth_dst):
     Format gratuitous ARP:
     eth_src = VMAC, eth_dst = 00..00<part_id>, SHA = VMAC, SPA = vnhip, THA = VMAC, TPA = vnhip
     """
-    arp_packet = [
-        # HTYPE
-        struct.pack("!h", 1),
-        # PTYPE (IPv4)
-        struct.pack("!h", 0x0800),
-        # HLEN
-        struct.pack("!B", 6),
-        # PLEN
-        struct.pack("!B", 4),
-        # OPER (reply)
-        struct.pack("!h", 2),
-        # SHA
-        binascii.unhexlify(SHA.replace(':', '')),
-        # SPA
-        socket.inet_aton(str(SPA)),
-        # THA
-        binascii.unhexlify(THA.replace(':', '')),
-        # TPA
-        socket.inet_aton(str(TPA))
-    ]
-    eth_frame = [
-        # Destination address:
-        binascii.unhexlify(eth_dst.replace(':', '')),
-        # Source address:
-        binascii.unhexlify(eth_src.replace(':', '')),
-        # Protocol
-        struct.pack("!h", ETH_TYPE_ARP),
-        # Data
-        ''.join(arp_packet)
-    ]
-    return ''.join(eth_frame)
+    frame = bytearray(ARP_REPLY_TEMPLATE)
+    patch_arp_reply(frame, 0, *garp_reply(SPA, TPA, SHA, THA, eth_src, eth_dst))
+    return frame
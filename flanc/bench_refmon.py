@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+'''
+Offline benchmark of the reference monitor.
+
+Drives RefMon.process_flow_mods and the Multi-Switch/Multi-Table
+controllers without Mininet or OVS: the datapaths are fake, they record
+what is sent to them and answer every barrier right after the burst.
+By default the OpenFlow messages are stubs, so only the refmon's own
+work is measured, --ryu-parser uses Ryu's parsers and serializers.
+
+For each of the OF1.0, OF1.3, OFDPA and Multi-Table paths it reports
+flow mods/s, the net number of gc tracked objects per flow mod and the
+latency per burst.
+'''
+
+import argparse
+import gc
+import os
+import time
+
+from ryu.ofproto import ofproto_v1_0, ofproto_v1_0_parser, ofproto_v1_3, ofproto_v1_3_parser
+
+from flow_mod_log import read_bursts
+from lib import Config, MultiSwitchController, MultiTableController, LatencyHistogram
+from refmon import RefMon
+
+import util.log
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'examples')
+MS_CONFIG = os.path.join(EXAMPLES, 'test-ms', 'config', 'sdx_global.cfg')
+MT_CONFIG = os.path.join(EXAMPLES, 'test-mt', 'config', 'sdx_global.cfg')
+
+
+class StubObject(object):
+    "Stands in for matches, actions and instructions"
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+
+
+class StubMsg(object):
+    "Stands in for OpenFlow messages, serializes to nothing"
+    def __init__(self, *args, **kwargs):
+        self.__dict__.update(kwargs)
+        self.xid = None
+
+    def set_xid(self, xid):
+        self.xid = xid
+
+    def serialize(self):
+        self.buf = ''
+
+
+class StubBarrierRequest(StubMsg):
+    def __init__(self, datapath):
+        super(StubBarrierRequest, self).__init__(datapath=datapath)
+
+
+class StubParser(object):
+    OFPFlowMod = OFPGroupMod = StubMsg
+    OFPBarrierRequest = StubBarrierRequest
+    OFPMatch = OFPBucket = StubObject
+    OFPActionOutput = OFPActionSetDlSrc = OFPActionSetDlDst = OFPActionSetField = StubObject
+    OFPActionGroup = OFPActionPopVlan = StubObject
+    OFPInstructionActions = OFPInstructionGotoTable = StubObject
+
+
+class FakeDatapath(object):
+    def __init__(self, dpid, ofproto, parser):
+        self.id = dpid
+        self.ofproto = ofproto
+        self.ofproto_parser = parser
+
+        self.xid = 0
+        self.msgs = 0
+        self.bytes = 0
+        # xids of the barriers that haven't been answered yet
+        self.barriers = []
+
+    def set_xid(self, msg):
+        self.xid += 1
+        msg.set_xid(self.xid)
+        self.msgs += 1
+        if isinstance(msg, self.ofproto_parser.OFPBarrierRequest):
+            self.barriers.append(self.xid)
+        return self.xid
+
+    def send(self, buf):
+        self.bytes += len(buf)
+
+    def send_msg(self, msg):
+        if msg.xid is None:
+            self.set_xid(msg)
+        msg.serialize()
+        self.send(msg.buf)
+
+
+class BarrierReply(object):
+    def __init__(self, datapath, xid):
+        self.msg = self
+        self.datapath = datapath
+        self.xid = xid
+
+
+def make_refmon(config):
+    "A RefMon without Ryu's app manager, the server and the log files"
+    refmon = RefMon.__new__(RefMon)
+    refmon.logger = util.log.getLogger('ReferenceMonitor')
+    refmon.config = config
+    refmon.log = None
+    refmon.flow_mod_log = None
+    refmon.burst_latency = LatencyHistogram()
+    refmon.last_latency_log = time.time()
+    if config.isMultiSwitchMode():
+        refmon.controller = MultiSwitchController(config)
+    else:
+        refmon.controller = MultiTableController(config)
+    return refmon
+
+
+def synthetic_bursts(count, size, ofv):
+    "Bursts like a participant controller sends them: outbound rules, each burst replacing the one before"
+    bursts = []
+    for i in xrange(count):
+        participant = 1 + i % 3
+        flow_mods = []
+        for j in xrange(size):
+            rule_id = (i * size + j) % 4096
+            cookie = {"id": rule_id % 256} if ofv == "1.0" else {"cookie": [rule_id, 65535]}
+            if i > 0 and j % 4 == 0:
+                flow_mod = {"rule_type": "outbound", "mod_type": "remove", "priority": 0,
+                            "action": {}, "match": {}}
+            else:
+                flow_mod = {"rule_type": "outbound", "mod_type": "insert", "priority": 4,
+                            "action": {"fwd": ["inbound"], "set_eth_dst": "a2:00:00:00:%02x:%02x" % (participant, j % 256)},
+                            "match": {"eth_dst": ["20:00:00:%02x:%02x:00" % (rule_id >> 8, rule_id & 0xff),
+                                                  "ff:ff:ff:ff:ff:00"],
+                                      "tcp_dst": 80 + j % 16}}
+            flow_mod.update(cookie)
+            flow_mods.append(flow_mod)
+        bursts.append((time.time(), participant, flow_mods))
+    return bursts
+
+
+def run(name, config_file, ofv, ofdpa, bursts, ryu_parser):
+    config = Config(config_file)
+    config.ofv = ofv
+    config.always_ready = True
+    if ofdpa:
+        config.ofdpa = set(config.dpids)
+
+    if ofv == "1.0":
+        ofproto, parser = ofproto_v1_0, ofproto_v1_0_parser
+    else:
+        ofproto, parser = ofproto_v1_3, ofproto_v1_3_parser
+    if not ryu_parser:
+        parser = StubParser
+
+    refmon = make_refmon(config)
+    datapaths = []
+    for dp_name, dpid in config.dpids.iteritems():
+        dp = FakeDatapath(dpid, ofproto, parser)
+        refmon.controller.switch_connect(dp)
+        datapaths.append(dp)
+
+    count = sum(len(flow_mods) for _, _, flow_mods in bursts)
+
+    gc.collect()
+    gc.disable()
+    objects = gc.get_count()[0]
+    start = time.time()
+    for _, participant, flow_mods in bursts:
+        refmon.process_flow_mods({"auth_info": {"participant": participant}, "flow_mods": flow_mods})
+        for dp in datapaths:
+            for xid in dp.barriers:
+                refmon.barrier_reply_handler(BarrierReply(dp, xid))
+            dp.barriers = []
+    elapsed = time.time() - start
+    objects = gc.get_count()[0] - objects
+    gc.enable()
+
+    print '%-12s %7d flow mods %6d bursts %10.0f flow mods/s %8.1f objects/flow mod %8d msgs  burst latency %s' % (
+        name, count, len(bursts), count / elapsed, float(objects) / max(count, 1),
+        sum(dp.msgs for dp in datapaths), refmon.burst_latency.summary())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('log', nargs='*', help='flow mod logs to replay instead of synthetic bursts')
+    parser.add_argument('-b', '--bursts', type=int, default=1000, help='number of synthetic bursts')
+    parser.add_argument('-s', '--size', type=int, default=32, help='flow mods per synthetic burst')
+    parser.add_argument('--ryu-parser', action='store_true', help="use Ryu's parsers instead of stubs")
+    args = parser.parse_args()
+
+    recorded = []
+    for path in args.log:
+        recorded.extend(read_bursts(path))
+
+    for name, config_file, ofv, ofdpa in (('OF1.0', MS_CONFIG, "1.0", False),
+                                          ('OF1.3', MS_CONFIG, "1.3", False),
+                                          ('OFDPA', MS_CONFIG, "1.3", True),
+                                          ('Multi-Table', MT_CONFIG, "1.3", False)):
+        if recorded:
+            if ofv == "1.0":
+                # recorded logs carry OF1.3 cookies
+                continue
+            bursts = recorded
+        else:
+            bursts = synthetic_bursts(args.bursts, args.size, ofv)
+        run(name, config_file, ofv, ofdpa, bursts, args.ryu_parser)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+'''
+Flow mod log of the reference monitor.
+
+The binary format starts with MAGIC, followed by one record per burst: a
+RECORD header (burst time, payload length) and the payload, the compact
+json of [participant, flow mods]. The text format is the one refmon wrote
+before:
+
+    BURST: <time>
+    PARTICIPANT: <participant>
+    <one json flow mod per line>
+    <empty line>
+
+Run as a script to convert between the two formats.
+'''
+
+import argparse
+import json
+import mmap
+import os
+from Queue import Queue
+import struct
+from threading import Thread
+
+MAGIC = 'IXFMLOG1'
+RECORD = struct.Struct('!dI')
+
+# the writer flushes at least every FLUSH_EVERY bursts
+FLUSH_EVERY = 1000
+
+
+''' writes the flow mod log in a background thread '''
+class FlowModLogWriter(object):
+
+    def __init__(self, path, binary=True):
+        self.binary = binary
+        self.file = open(path, 'wb', 1 << 20)
+        if self.binary:
+            self.file.write(MAGIC)
+
+        self.queue = Queue()
+        self.thread = Thread(target=self.writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, burst_time, participant, flow_mods):
+        self.queue.put((burst_time, participant, flow_mods))
+
+    def writer(self):
+        encode = encode_record if self.binary else encode_text
+        pending = 0
+        while True:
+            burst = self.queue.get()
+            if burst is None:
+                break
+            self.file.write(encode(*burst))
+            pending += 1
+
+            if self.queue.empty() or pending >= FLUSH_EVERY:
+                self.file.flush()
+                pending = 0
+
+        self.file.close()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+def encode_record(burst_time, participant, flow_mods):
+    payload = json.dumps([participant, flow_mods], separators=(',', ':'))
+    return RECORD.pack(burst_time, len(payload)) + payload
+
+
+def encode_text(burst_time, participant, flow_mods):
+    lines = ['BURST: ' + str(burst_time), 'PARTICIPANT: ' + str(participant)]
+    lines.extend(json.dumps(flow_mod) for flow_mod in flow_mods)
+    return '\n'.join(lines) + '\n\n'
+
+
+def read_bursts(path):
+    "Yield (time, participant, flow mods) for every burst of a log in either format"
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if m[:len(MAGIC)] == MAGIC:
+                for burst in read_binary(m, len(MAGIC)):
+                    yield burst
+            else:
+                for burst in read_text(iter(m.readline, '')):
+                    yield burst
+        finally:
+            m.close()
+
+
+def read_binary(m, offset):
+    while offset + RECORD.size <= len(m):
+        burst_time, length = RECORD.unpack_from(m, offset)
+        offset += RECORD.size
+        if offset + length > len(m):
+            # the writer was interrupted in the middle of a record
+            return
+        participant, flow_mods = json.loads(m[offset:offset + length])
+        offset += length
+        yield burst_time, participant, flow_mods
+
+
+def read_text(lines):
+    burst = None
+    for line in lines:
+        if line.startswith('BURST'):
+            burst = [float(line.split(': ')[1]), None, []]
+        elif line.startswith('PARTICIPANT') and burst:
+            burst[1] = line.split(': ')[1].strip()
+        elif burst:
+            if line.strip():
+                burst[2].append(json.loads(line))
+            else:
+                yield tuple(burst)
+                burst = None
+    if burst:
+        yield tuple(burst)
+
+
+def convert(src, dst, binary):
+    writer = FlowModLogWriter(dst, binary)
+    for burst in read_bursts(src):
+        writer.write(*burst)
+    writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='convert a flow mod log between the binary and the text format')
+    parser.add_argument('format', choices=['binary', 'text'], help='format to convert to')
+    parser.add_argument('input', help='flow mod log to read, in either format')
+    parser.add_argument('output', help='file to write')
+    args = parser.parse_args()
+
+    convert(args.input, args.output, args.format == 'binary')
+
+
+if __name__ == '__main__':
+    main()
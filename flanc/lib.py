@@ -1,10 +1,12 @@
 #  Author:
 #  Rudiger Birkner (Networked Systems Group ETH Zurich)
 
+from bisect import bisect_left
+from collections import deque, OrderedDict
 import json
 import logging
-
-from Queue import Queue
+from threading import Lock
+from time import time
 
 import os
 import sys
@@ -14,7 +16,7 @@ if np not in sys.path:
 import util.log
 
 
-from ofdpa20 import OFDPA20
+from ofdpa20 import get_ofdpa
 
 # PRIORITIES
 FLOW_MISS_PRIORITY = 0
@@ -22,6 +24,9 @@ FLOW_MISS_PRIORITY = 0
 # COOKIES
 NO_COOKIE = 0
 
+# log the flow mod install latencies at most this often (seconds)
+LATENCY_LOG_INTERVAL = 10
+
 class Config(object):
 
     MULTISWITCH = 0
@@ -43,6 +48,9 @@ class Config(object):
         self.parser = None
         self.ofproto = None
 
+        # parser -> (match cache, instruction cache)
+        self.compile_caches = {}
+
         # loading config file
         config = json.load(open(config_file, 'r'))
 
@@ -91,6 +99,13 @@ class Config(object):
     def isMultiTableMode(self):
         return self.mode == self.MULTITABLE
 
+    def get_compile_caches(self):
+        "Match and instruction caches of the current parser, what one parser built can't be sent with another"
+        caches = self.compile_caches.get(self.parser)
+        if caches is None:
+            caches = self.compile_caches[self.parser] = (CompileCache(), CompileCache())
+        return caches
+
 
 class InvalidConfigError(Exception):
     def __init__(self, flow_mod):
@@ -98,68 +113,240 @@ class InvalidConfigError(Exception):
     def __str__(self):
         return repr(self.flow_mod)
 
-class MultiTableController(object):
-    def __init__(self, config):
+class CompileCache(object):
+    """
+    Cache of OpenFlow objects compiled from the json description of a match
+    or actions. Holds at most size entries, it is flushed when full.
+    """
+    def __init__(self, size=65536):
+        self.size = size
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key, build):
+        key = freeze(key)
+        try:
+            value = self.cache[key]
+            self.hits += 1
+            return value
+        except KeyError:
+            pass
+
+        self.misses += 1
+        if len(self.cache) >= self.size:
+            self.cache.clear()
+        value = self.cache[key] = build()
+        return value
+
+
+def freeze(obj):
+    "Hashable canonical form of a json-like object"
+    if isinstance(obj, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in obj.iteritems()))
+    if isinstance(obj, list) or isinstance(obj, tuple):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+class FabricController(object):
+    """
+    What both controllers share: the flows each datapath should have, kept
+    across switch reconnects, the bursts waiting for their datapath and the
+    tracking of barriers.
+    """
+    def __init__(self, config, logger):
         self.config = config
-        self.logger = util.log.getLogger('MultiTableController')
-        self.logger.info('mt_ctrlr: creating an instance of MultiTableController')
+        self.logger = logger
 
-        self.fm_queue = Queue()
+        # datapath name -> ShadowFlowTable, the desired state of the datapath
+        self.shadow = {}
+        # datapath name -> bursts that arrived before the datapath was ready
+        self.waiting = {}
 
-    def init_fabric(self):
-        # install table-miss flow entry
-        self.logger.info("mt_ctrlr: init fabric")
-        match = self.config.parser.OFPMatch()
-        actions = [self.config.parser.OFPActionOutput(self.config.ofproto.OFPP_CONTROLLER, self.config.ofproto.OFPCML_NO_BUFFER)]
-        instructions = [self.config.parser.OFPInstructionActions(self.config.ofproto.OFPIT_APPLY_ACTIONS, actions)]
+        self.barriers = BarrierTracker(self.logger)
 
-        for table in self.config.tables.values():
-            mod = self.config.parser.OFPFlowMod(datapath=self.config.datapaths["main"],
-                                                cookie=NO_COOKIE, cookie_mask=1,
-                                                table_id=table,
-                                                command=self.config.ofproto.OFPFC_ADD,
-                                                priority=FLOW_MISS_PRIORITY,
-                                                match=match, instructions=instructions)
-            self.config.datapaths["main"].send_msg(mod)
+        # datapath name -> Lock, held by whoever changes the state of that datapath:
+        # the server's workers pushing bursts and Ryu's thread handling its events
+        self.dp_locks = {}
 
-        mod = self.config.parser.OFPFlowMod(datapath=self.config.datapaths["arp"],
-                                            cookie=NO_COOKIE, cookie_mask=1,
-                                            command=self.config.ofproto.OFPFC_ADD,
-                                            priority=FLOW_MISS_PRIORITY,
-                                            match=match, instructions=instructions)
-        self.config.datapaths["arp"].send_msg(mod)
+        # datapath name -> time of disconnect
+        self.disconnected = {}
+        # dpid -> (xid of the last barrier of the resync, datapath name)
+        self.resyncs = {}
+        self.recovery_time = LatencyHistogram()
 
     def switch_connect(self, dp):
         dp_name = self.config.dpid_2_name[dp.id]
 
-        self.config.datapaths[dp_name] = dp
-
         if self.config.ofproto is None:
             self.config.ofproto = dp.ofproto
         if self.config.parser is None:
             self.config.parser = dp.ofproto_parser
 
-        self.logger.info('mt_ctrlr: switch connect: ' + dp_name)
+        self.logger.info('switch connect: ' + dp_name)
 
-        if self.is_ready():
-            self.init_fabric()
+        # the server's workers may be pushing bursts to the datapath meanwhile
+        with self.dp_lock(dp_name):
+            self.config.datapaths[dp_name] = dp
+            if dp_name in self.shadow:
+                self.resync(dp)
+            else:
+                self.shadow[dp_name] = ShadowFlowTable()
+                if self.is_ready():
+                    self.init_fabric()
 
-            while not self.fm_queue.empty():
-                self.process_flow_mod(self.fm_queue.get())
+        if self.is_ready():
+            for dp_name in self.waiting.keys():
+                # a worker adds to waiting under the lock, once it sees the datapath it doesn't anymore
+                with self.dp_lock(dp_name):
+                    if dp_name in self.config.datapaths:
+                        for fms, burst in self.waiting.pop(dp_name, ()):
+                            self.process_flow_mods(fms, burst)
 
     def switch_disconnect(self, dp):
         if dp.id in self.config.dpid_2_name:
             dp_name = self.config.dpid_2_name[dp.id]
-            self.logger.info('mt_ctrlr: switch disconnect: ' + dp_name)
-            del self.config.datapaths[dp_name]
+            self.logger.info('switch disconnect: ' + dp_name)
+            with self.dp_lock(dp_name):
+                del self.config.datapaths[dp_name]
+                self.barriers.forget(dp)
+                self.resyncs.pop(dp.id, None)
+                self.disconnected.setdefault(dp_name, time())
+
+    def resync(self, dp):
+        "Replace whatever a reconnected switch has installed by its desired state. Caller holds its dp_lock."
+        dp_name = self.config.dpid_2_name[dp.id]
+        shadow = self.shadow[dp_name]
+
+        msgs = self.delete_all_msgs(dp)
+        msgs.append(self.config.parser.OFPBarrierRequest(dp))
+        msgs.extend(self.table_miss_flow_mods(dp))
+
+        flow_mods = []
+        group_mods = []
+        for fm in shadow.flow_mods():
+            flow_mod, fm_group_mods = self.make_flow_mod(dp, fm)
+            self.flow_reinstalled(dp, fm)
+            flow_mods.append(flow_mod)
+            group_mods.extend(fm_group_mods)
+        group_mods = self.new_group_mods(dp, group_mods)
+        if group_mods:
+            msgs.extend(group_mods)
+            msgs.append(self.config.parser.OFPBarrierRequest(dp))
+        msgs.extend(flow_mods)
+        msgs.append(self.config.parser.OFPBarrierRequest(dp))
+        shadow.reinstalled()
+
+        self.logger.info('resync ' + dp_name + ': reinstalling ' + str(len(flow_mods)) + ' flows')
+        buf, last_xid = serialize_msgs(dp, msgs)
+        self.resyncs[dp.id] = (last_xid, dp_name)
+        dp.send(buf)
+
+    def delete_all_msgs(self, dp):
+        match = self.config.parser.OFPMatch()
+        if self.config.ofv == "1.3":
+            return [self.config.parser.OFPFlowMod(datapath=dp,
+                                                  table_id=self.config.ofproto.OFPTT_ALL,
+                                                  command=self.config.ofproto.OFPFC_DELETE,
+                                                  out_port=self.config.ofproto.OFPP_ANY,
+                                                  out_group=self.config.ofproto.OFPG_ANY,
+                                                  match=match)]
+        return [self.config.parser.OFPFlowMod(datapath=dp,
+                                              command=self.config.ofproto.OFPFC_DELETE,
+                                              out_port=self.config.ofproto.OFPP_NONE,
+                                              match=match)]
+
+    def make_flow_mod(self, dp, fm):
+        "Returns the OpenFlow message for fm and the group mods it depends on"
+        return fm.get_flow_mod(self.config), []
+
+    def flow_reinstalled(self, dp, fm):
+        pass
 
+    def new_group_mods(self, dp, group_mods):
+        return group_mods
 
     def process_flow_mod(self, fm):
-        if not self.is_ready():
-            self.fm_queue.put(fm)
+        self.process_flow_mods([fm])
+
+    def dp_lock(self, dp_name):
+        return self.dp_locks.setdefault(dp_name, Lock())
+
+    def process_flow_mods(self, fms, burst=None):
+        "Push a burst of flow mods, all for the same datapath. Caller holds its dp_lock."
+        if not fms:
+            return
+        dp_name = fms[0].get_dst_dp()
+        if not self.is_ready() or dp_name not in self.config.datapaths:
+            self.waiting.setdefault(dp_name, []).append((fms, burst))
+            return
+
+        dp = self.config.datapaths[dp_name]
+        msgs = self.burst_msgs(dp, self.shadow[dp_name], fms)
+
+        buf, last_xid = serialize_msgs(dp, msgs)
+        self.barriers.expect(dp, last_xid, burst)
+        dp.send(buf)
+
+    def handle_barrier_reply(self, datapath, xid):
+        "Returns the bursts the barrier completed on this datapath"
+        with self.dp_lock(self.config.dpid_2_name.get(datapath.id)):
+            return self.barrier_reply(datapath, xid)
+
+    def barrier_reply(self, datapath, xid):
+        resync = self.resyncs.get(datapath.id)
+        if resync is not None and resync[0] == xid:
+            del self.resyncs[datapath.id]
+            disconnected = self.disconnected.pop(resync[1], None)
+            if disconnected is not None:
+                self.recovery_time.add(time() - disconnected)
+                self.logger.info('resync ' + resync[1] + ': recovered ' + str(time() - disconnected) +
+                                 's after disconnect, time to recover: ' + self.recovery_time.summary())
+        return self.barriers.reply(datapath, xid)
+
+
+class MultiTableController(FabricController):
+    def __init__(self, config):
+        super(MultiTableController, self).__init__(config, util.log.getLogger('MultiTableController'))
+        self.logger.info('mt_ctrlr: creating an instance of MultiTableController')
+
+    def init_fabric(self):
+        # install table-miss flow entry
+        self.logger.info("mt_ctrlr: init fabric")
+        for dp in self.config.datapaths.values():
+            for mod in self.table_miss_flow_mods(dp):
+                dp.send_msg(mod)
+
+    def table_miss_flow_mods(self, dp):
+        match = self.config.parser.OFPMatch()
+        actions = [self.config.parser.OFPActionOutput(self.config.ofproto.OFPP_CONTROLLER, self.config.ofproto.OFPCML_NO_BUFFER)]
+        instructions = [self.config.parser.OFPInstructionActions(self.config.ofproto.OFPIT_APPLY_ACTIONS, actions)]
+
+        if dp is self.config.datapaths.get("arp"):
+            tables = [0]
         else:
-            mod = fm.get_flow_mod(self.config)
-            self.config.datapaths[fm.get_dst_dp()].send_msg(mod)
+            tables = self.config.tables.values()
+
+        mods = []
+        for table in tables:
+            mods.append(self.config.parser.OFPFlowMod(datapath=dp,
+                                                      cookie=NO_COOKIE, cookie_mask=1,
+                                                      table_id=table,
+                                                      command=self.config.ofproto.OFPFC_ADD,
+                                                      priority=FLOW_MISS_PRIORITY,
+                                                      match=match, instructions=instructions))
+        return mods
+
+    def burst_msgs(self, dp, shadow, fms):
+        "The flow mods of a burst that change the datapath, followed by a barrier"
+        msgs = []
+        for fm in fms:
+            flow_mod, _ = shadow.update(fm, fm.get_flow_mod(self.config), self.config.ofproto)
+            if flow_mod is not None:
+                msgs.append(flow_mod)
+        msgs.append(self.config.parser.OFPBarrierRequest(dp))
+        return msgs
 
     def packet_in(self, ev):
         self.logger.info("mt_ctrlr: packet in")
@@ -173,91 +360,137 @@ class MultiTableController(object):
         request = self.config.parser.OFPBarrierRequest(self.config.datapaths["main"])
         self.config.datapaths["main"].send_msg(request)
 
-    def handle_barrier_reply(self, datapath):
-        if self.config.datapaths["main"] == datapath:
-            return True
-        return False
 
-class MultiSwitchController(object):
+class MultiSwitchController(FabricController):
     def __init__(self, config):
-        self.logger = util.log.getLogger('MultiSwitchController')
+        super(MultiSwitchController, self).__init__(config, util.log.getLogger('MultiSwitchController'))
         self.logger.info('ms_ctrlr: creating an instance of MultiSwitchController')
 
         self.datapaths = {}
-        self.config = config
-
-        self.fm_queue = Queue()
-        self.last_command_type = {}
-
-    def switch_connect(self, dp):
-        dp_name = self.config.dpid_2_name[dp.id]
-
-        self.config.datapaths[dp_name] = dp
-
-        if self.config.ofproto is None:
-            self.config.ofproto = dp.ofproto
-        if self.config.parser is None:
-            self.config.parser = dp.ofproto_parser
-
-        self.logger.info('ms_ctrlr: switch connect: ' + dp_name)
-
-        if self.is_ready():
-            self.init_fabric()
-
-            while not self.fm_queue.empty():
-                self.process_flow_mod(self.fm_queue.get())
-
-    def switch_disconnect(self, dp):
-        if dp.id in self.config.dpid_2_name:
-            dp_name = self.config.dpid_2_name[dp.id]
-            self.logger.info('ms_ctrlr: switch disconnect: ' + dp_name)
-            del self.config.datapaths[dp_name]
 
     def init_fabric(self):
         # install table-miss flow entry
         self.logger.info('ms_ctrlr: init fabric')
+        for datapath in self.config.datapaths.values():
+            for mod in self.table_miss_flow_mods(datapath):
+                datapath.send_msg(mod)
+
+    def table_miss_flow_mods(self, datapath):
         match = self.config.parser.OFPMatch()
 
         if self.config.ofv  == "1.3":
             actions = [self.config.parser.OFPActionOutput(self.config.ofproto.OFPP_CONTROLLER, self.config.ofproto.OFPCML_NO_BUFFER)]
             instructions = [self.config.parser.OFPInstructionActions(self.config.ofproto.OFPIT_APPLY_ACTIONS, actions)]
+            mod = self.config.parser.OFPFlowMod(datapath=datapath,
+                                                cookie=NO_COOKIE, cookie_mask=3,
+                                                command=self.config.ofproto.OFPFC_ADD,
+                                                priority=FLOW_MISS_PRIORITY,
+                                                match=match, instructions=instructions)
         else:
             actions = [self.config.parser.OFPActionOutput(self.config.ofproto.OFPP_CONTROLLER)]
-
-        for datapath in self.config.datapaths.values():
-            if self.config.ofv  == "1.3":
-                mod = self.config.parser.OFPFlowMod(datapath=datapath,
-                                                    cookie=NO_COOKIE, cookie_mask=3,
-                                                    command=self.config.ofproto.OFPFC_ADD,
-                                                    priority=FLOW_MISS_PRIORITY,
-                                                    match=match, instructions=instructions)
-            else:
-                mod = self.config.parser.OFPFlowMod(datapath=datapath,
-                                                    cookie=NO_COOKIE,
-                                                    command=self.config.ofproto.OFPFC_ADD,
-                                                    priority=FLOW_MISS_PRIORITY,
-                                                    match=match, actions=actions)
-            datapath.send_msg(mod)
-
-    def process_flow_mod(self, fm):
-        if not self.is_ready():
-            self.fm_queue.put(fm)
-        else:
-            dp = self.config.datapaths[fm.get_dst_dp()]
-            if self.config.dpid_2_name[dp.id] in self.config.ofdpa:
-                ofdpa = OFDPA20(self.config)
-                flow_mod, group_mods = fm.get_flow_and_group_mods(self.config)
-                for gm in group_mods:
-                    if not ofdpa.is_group_mod_installed_in_switch(dp, gm):
-                        dp.send_msg(gm)
-                        ofdpa.mark_group_mod_as_installed(dp, gm)
+            mod = self.config.parser.OFPFlowMod(datapath=datapath,
+                                                cookie=NO_COOKIE,
+                                                command=self.config.ofproto.OFPFC_ADD,
+                                                priority=FLOW_MISS_PRIORITY,
+                                                match=match, actions=actions)
+        return [mod]
+
+    def is_ofdpa_datapath(self, dp):
+        return self.config.dpid_2_name[dp.id] in self.config.ofdpa
+
+    def delete_all_msgs(self, dp):
+        msgs = super(MultiSwitchController, self).delete_all_msgs(dp)
+        if self.is_ofdpa_datapath(dp):
+            msgs.append(self.config.parser.OFPGroupMod(datapath=dp,
+                                                       command=self.config.ofproto.OFPGC_DELETE,
+                                                       group_id=self.config.ofproto.OFPG_ALL))
+            # the switch lost its groups, allocate and install them again
+            get_ofdpa(self.config).forget_switch(dp)
+        return msgs
+
+    def make_flow_mod(self, dp, fm):
+        if self.is_ofdpa_datapath(dp):
+            return fm.get_flow_and_group_mods(self.config)
+        return fm.get_flow_mod(self.config), []
+
+    def flow_reinstalled(self, dp, fm):
+        if self.is_ofdpa_datapath(dp):
+            get_ofdpa(self.config).acquire_groups(dp, fm)
+
+    def burst_msgs(self, dp, shadow, fms):
+        """
+        The flow mods of a burst that change the datapath, reordered into
+        alternating groups of deletes and adds, each closed by a barrier.
+        """
+        is_ofdpa = self.is_ofdpa_datapath(dp)
+        ofdpa = get_ofdpa(self.config) if is_ofdpa else None
+
+        groups = []
+        deletes = None
+        for fm in fms:
+            flow_mod, group_mods = self.make_flow_mod(dp, fm)
+
+            flow_mod, replaced = shadow.update(fm, flow_mod, self.config.ofproto)
+            if flow_mod is None:
+                continue
+
+            if is_ofdpa:
+                # replaced only holds flows certainly gone from the switch,
+                # one a delete may have missed keeps its groups
+                for old in replaced:
+                    ofdpa.release_groups(dp, old)
+                if flow_mod.command != self.config.ofproto.OFPFC_DELETE:
+                    ofdpa.acquire_groups(dp, fm)
+
+            if flow_mod.command != self.config.ofproto.OFPFC_DELETE:
+                if deletes is None:
+                    deletes = FlowModGroup()
+                    adds = FlowModGroup()
+                    groups.append((deletes, adds))
+                adds.add(flow_mod, group_mods)
             else:
-                flow_mod = fm.get_flow_mod(self.config)
-            if (not dp.id in self.last_command_type or (self.last_command_type[dp.id] != flow_mod.command)):
-                self.logger.info('refmon: sending barrier')
-                self.last_command_type[dp.id] = flow_mod.command
-                dp.send_msg(self.config.parser.OFPBarrierRequest(dp))
-            dp.send_msg(flow_mod)
+                # a delete can move ahead of the adds of its group unless
+                # it would remove one of them
+                if deletes is None or adds.overlaps(flow_mod, self.config.ofv):
+                    deletes = FlowModGroup()
+                    adds = FlowModGroup()
+                    groups.append((deletes, adds))
+                deletes.add(flow_mod, [])
+
+        msgs = []
+        for deletes, adds in groups:
+            if deletes.flow_mods:
+                msgs.extend(deletes.flow_mods)
+                msgs.append(self.config.parser.OFPBarrierRequest(dp))
+            if adds.flow_mods:
+                group_mods = self.new_group_mods(dp, adds.group_mods)
+                if group_mods:
+                    # groups have to exist before flows point to them
+                    msgs.extend(group_mods)
+                    msgs.append(self.config.parser.OFPBarrierRequest(dp))
+                msgs.extend(adds.flow_mods)
+                msgs.append(self.config.parser.OFPBarrierRequest(dp))
+        if is_ofdpa:
+            # groups the burst left unused go once no flow points to them anymore
+            group_mods = ofdpa.collect_groups(dp)
+            if group_mods:
+                msgs.extend(group_mods)
+                msgs.append(self.config.parser.OFPBarrierRequest(dp))
+        if not msgs:
+            # nothing changes, the barrier just marks the burst as done
+            msgs.append(self.config.parser.OFPBarrierRequest(dp))
+        return msgs
+
+    def new_group_mods(self, dp, group_mods):
+        if not self.is_ofdpa_datapath(dp):
+            return group_mods
+        ofdpa = get_ofdpa(self.config)
+        new = []
+        for gm in group_mods:
+            if not ofdpa.is_group_mod_installed_in_switch(dp, gm):
+                new.append(gm)
+                ofdpa.mark_group_mod_as_installed(dp, gm)
+        return new
 
     def packet_in(self, ev):
         pass
@@ -276,7 +509,306 @@ class MultiSwitchController(object):
         else:
             return False
 
-    def handle_barrier_reply(self, datapath):
-        if self.config.datapaths["outbound"] == datapath:
+
+class FlowModGroup(object):
+    "Flow mods of a burst that can be sent without a barrier between them"
+    def __init__(self):
+        self.flow_mods = []
+        self.group_mods = []
+        self.cookies = set()
+
+    def add(self, flow_mod, group_mods):
+        self.flow_mods.append(flow_mod)
+        self.group_mods.extend(group_mods)
+        self.cookies.add(flow_mod.cookie)
+
+    def overlaps(self, delete, ofv):
+        "Could delete remove any of the flow mods of this group?"
+        if not self.flow_mods:
+            return False
+        if ofv != "1.3":
+            # OF1.0 deletes ignore the cookie
             return True
-        return False
+        mask = delete.cookie_mask
+        if mask == 2**64-1 or mask == 2**32-1:
+            return delete.cookie in self.cookies
+        return any((cookie & mask) == (delete.cookie & mask) for cookie in self.cookies)
+
+
+def serialize_msgs(dp, msgs):
+    "Serialize msgs into one buffer for a single socket write, returns it and the last xid"
+    buf = bytearray()
+    for msg in msgs:
+        if msg.xid is None:
+            dp.set_xid(msg)
+        msg.serialize()
+        buf.extend(msg.buf)
+    return buf, msgs[-1].xid
+
+
+class ShadowFlowTable(object):
+    """
+    The flows the refmon installed on a datapath, per table, keyed by
+    (priority, match, cookie). Flow mods that would not change the
+    datapath are suppressed, inserts that only change the actions of a
+    flow become strict modifies. A flow is only forgotten when a delete
+    certainly removes it; flows a delete may or may not have removed are
+    kept, but never suppress a flow mod.
+    """
+    def __init__(self):
+        # table id -> {(priority, match, cookie): (actions, FlowMod)}
+        self.tables = {}
+        # table id -> {(priority, match): cookie}
+        self.flows = {}
+        # table id -> {cookie: set of (priority, match, cookie)}
+        self.cookies = {}
+        # table id -> keys of the flows a delete may have removed
+        self.uncertain = {}
+
+        self.suppressed = 0
+        self.modified = 0
+
+    def update(self, fm, flow_mod, ofproto):
+        """
+        Record flow_mod. Returns it (maybe turned into a modify) or None if
+        it can be dropped, and the FlowMods of the flows it replaces or deletes.
+        """
+        table_id = getattr(flow_mod, 'table_id', 0)
+        entries = self.tables.setdefault(table_id, {})
+        flows = self.flows.setdefault(table_id, {})
+        cookies = self.cookies.setdefault(table_id, {})
+        uncertain = self.uncertain.setdefault(table_id, set())
+        match = freeze(fm.matches)
+
+        if flow_mod.command == ofproto.OFPFC_ADD:
+            key = (fm.priority, match, flow_mod.cookie)
+            actions = freeze(fm.actions)
+            if key in uncertain:
+                # the flow may be gone, an add installs it either way
+                uncertain.discard(key)
+                replaced = [entries[key][1]]
+            elif key in entries:
+                if entries[key][0] == actions:
+                    self.suppressed += 1
+                    return None, []
+                flow_mod.command = ofproto.OFPFC_MODIFY_STRICT
+                self.modified += 1
+                replaced = [entries[key][1]]
+            else:
+                # an add replaces the flow with the same priority and match
+                replaced = []
+                if key[:2] in flows:
+                    replaced.append(self.remove(table_id, key[:2] + (flows[key[:2]],)))
+                flows[key[:2]] = flow_mod.cookie
+                cookies.setdefault(flow_mod.cookie, set()).add(key)
+            entries[key] = (actions, fm)
+            return flow_mod, replaced
+
+        # a non-strict delete
+        mask = getattr(flow_mod, 'cookie_mask', 0)
+        if mask == 2**64-1 or mask == 2**32-1:
+            candidates = cookies.get(flow_mod.cookie, ())
+        elif mask:
+            candidates = [key for cookie, keys in cookies.iteritems()
+                          if (cookie & mask) == (flow_mod.cookie & mask) for key in keys]
+        else:
+            candidates = entries.keys()
+
+        removed = []
+        maybe = False
+        for key in candidates:
+            covered = delete_covers(dict(key[1]), fm.matches)
+            if covered:
+                removed.append(key)
+            elif covered is None:
+                uncertain.add(key)
+                maybe = True
+        if not removed and not maybe:
+            self.suppressed += 1
+            return None, []
+        return flow_mod, [self.remove(table_id, key) for key in removed]
+
+    def remove(self, table_id, key):
+        _, fm = self.tables[table_id].pop(key)
+        self.uncertain[table_id].discard(key)
+        del self.flows[table_id][key[:2]]
+        keys = self.cookies[table_id][key[2]]
+        keys.discard(key)
+        if not keys:
+            del self.cookies[table_id][key[2]]
+        return fm
+
+    def flow_mods(self):
+        "The FlowMods that installed the current flows"
+        return [fm for entries in self.tables.itervalues() for _, fm in entries.itervalues()]
+
+    def reinstalled(self):
+        "All flows were installed again, none of them is in doubt anymore"
+        self.uncertain = {}
+
+    def dump(self):
+        "All flows as dicts, for comparison with the datapath's flow stats"
+        return [{"table_id": table_id, "priority": priority, "match": dict(match),
+                 "cookie": cookie, "actions": actions}
+                for table_id, entries in self.tables.iteritems()
+                for (priority, match, cookie), (actions, _) in entries.iteritems()]
+
+
+def delete_covers(flow_match, delete_match):
+    """
+    Does a non-strict delete with delete_match remove a flow with
+    flow_match? It does if every field of the delete is in the flow and
+    the flow's values are a subset of the delete's. None if that can't be
+    told because a value isn't understood.
+    """
+    covered = True
+    for field, value in delete_match.iteritems():
+        if field not in flow_match:
+            return False
+        other = flow_match[field]
+        if other == value:
+            continue
+        delete_value = parse_match_value(value)
+        flow_value = parse_match_value(other)
+        if delete_value is None or flow_value is None:
+            covered = None
+            continue
+        value, mask = delete_value
+        other, other_mask = flow_value
+        # exact values have all bits set in their mask, -1
+        if other_mask & mask != mask or other & mask != value & mask:
+            return False
+    return covered
+
+
+def parse_match_value(value):
+    "(value, mask) of a match field as an int, mask -1 if exact. None if not understood."
+    if isinstance(value, (list, tuple)):
+        if len(value) != 2:
+            return None
+        value, mask = parse_match_int(value[0]), parse_match_int(value[1])
+    elif isinstance(value, basestring) and "/" in value:
+        value, mask = value.split("/", 1)
+        if mask.isdigit() and "." in value:
+            # ipv4 prefix length
+            mask = (2**32-1) ^ (2**(32 - min(int(mask), 32)) - 1)
+        else:
+            mask = parse_match_int(mask)
+        value = parse_match_int(value)
+    else:
+        value, mask = parse_match_int(value), -1
+    if value is None or mask is None:
+        return None
+    return value & mask, mask
+
+
+def parse_match_int(value):
+    "An int, ipv4 address or mac address as an int, None if it is neither"
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return value
+    if not isinstance(value, basestring):
+        return None
+    try:
+        if "." in value:
+            parts = [int(part) for part in value.split(".")]
+            if len(parts) != 4 or not all(0 <= part <= 255 for part in parts):
+                return None
+            return reduce(lambda addr, part: addr << 8 | part, parts)
+        if ":" in value:
+            parts = value.split(":")
+            if len(parts) != 6:
+                return None
+            return int("".join(part.zfill(2) for part in parts), 16)
+        return int(value, 0)
+    except ValueError:
+        return None
+
+
+class Burst(object):
+    "Flow mods received from a participant at once, possibly for several datapaths"
+    def __init__(self, participant, received, flow_mods, datapaths):
+        self.participant = participant
+        self.received = received
+        self.flow_mods = flow_mods
+        self.datapaths = datapaths
+        self.outstanding = len(datapaths)
+
+    def installed_on_datapath(self):
+        "Returns True once the burst is installed on all its datapaths"
+        self.outstanding -= 1
+        return self.outstanding == 0
+
+
+class BarrierTracker(object):
+    """
+    Bursts waiting for the reply to their last barrier, per datapath. A
+    switch answers barriers in order, so a reply also completes all bursts
+    sent to it before.
+    """
+    def __init__(self, logger):
+        self.logger = logger
+
+        # dpid -> {xid of the last barrier of a burst: (send time, burst)}
+        self.pending = {}
+        self.install_latency = LatencyHistogram()
+        self.last_log = time()
+
+    def expect(self, dp, xid, burst):
+        self.pending.setdefault(dp.id, OrderedDict())[xid] = (time(), burst)
+
+    def reply(self, dp, xid):
+        pending = self.pending.get(dp.id)
+        if not pending or xid not in pending:
+            return []
+
+        now = time()
+        bursts = []
+        while pending:
+            burst_xid, (sent, burst) = pending.popitem(last=False)
+            self.install_latency.add(now - sent)
+            if burst is not None:
+                bursts.append(burst)
+            if burst_xid == xid:
+                break
+
+        if now - self.last_log >= LATENCY_LOG_INTERVAL:
+            self.last_log = now
+            self.logger.info('flow mod install latency: ' + self.install_latency.summary())
+        return bursts
+
+    def forget(self, dp):
+        self.pending.pop(dp.id, None)
+
+
+class LatencyHistogram(object):
+    "Latency samples, kept as bucket counts and a window of recent values for percentiles"
+
+    # upper bounds of the buckets in ms, the last bucket is unbounded
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self, window=10000):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.recent = deque(maxlen=window)
+        self.total = 0
+
+    def add(self, seconds):
+        ms = seconds * 1000
+        self.counts[bisect_left(self.BUCKETS, ms)] += 1
+        self.recent.append(ms)
+        self.total += 1
+
+    def percentile(self, p):
+        if not self.recent:
+            return None
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+    def summary(self):
+        if not self.recent:
+            return 'no samples'
+        buckets = ' '.join('<=%dms:%d' % (bound, count)
+                           for bound, count in zip(self.BUCKETS, self.counts) if count)
+        if self.counts[-1]:
+            buckets += ' >%dms:%d' % (self.BUCKETS[-1], self.counts[-1])
+        return 'n=%d p50=%.1fms p95=%.1fms p99=%.1fms %s' % (
+            self.total, self.percentile(50), self.percentile(95), self.percentile(99), buckets)
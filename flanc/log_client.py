@@ -4,10 +4,11 @@
 
 
 import argparse
+from collections import OrderedDict
+import cPickle
 import json
-from multiprocessing import Queue
-from multiprocessing.connection import Client
-from Queue import Empty
+import socket
+import struct
 from threading import Thread
 from time import sleep, time
 
@@ -18,15 +19,23 @@ if np not in sys.path:
     sys.path.append(np)
 import util.log
 
+from flow_mod_log import read_bursts
+
+# frames as multiprocessing.connection.Client would send them
+HEADER = struct.Struct('!i')
+
+# bursts sent at once when replaying as fast as possible
+BATCH_SIZE = 256
 
 ''' LogClient for Reference Monitor '''
 class LogClient(object):
 
-    def __init__(self, address, port, authkey, input_file, debug = False, timing = False):
+    def __init__(self, address, port, authkey, input_file, debug = False, timing = False, speed = None):
         self.logger = util.log.getLogger('log_client')
         self.logger.info('server: start')
 
-        self.timing = timing
+        # replay speed relative to the times in the log, None replays as fast as possible
+        self.speed = 1.0 if timing and speed is None else speed
 
         self.address = address
         self.port = int(port)
@@ -34,21 +43,19 @@ class LogClient(object):
 
         self.input_file = input_file
 
-        self.real_start_time = time()
-        self.simulation_start_time = 0
-
-        self.fp_thread = None
+        # (log time, participant, frame, number of flow mods)
+        self.bursts = []
         self.fs_thread = None
 
-        self.flow_mod_queue = Queue()
+        self.sent_bursts = 0
+        self.sent_flow_mods = 0
+        self.elapsed = 0
 
     def start(self):
         self.run = True
 
-        self.fp_thread = Thread(target=self.file_processor)
-        self.fp_thread.setDaemon(True)
-        self.fp_thread.start()
-        self.logger.debug('file processor started')
+        self.load()
+        self.logger.debug('loaded ' + str(len(self.bursts)) + ' bursts')
 
         self.fs_thread = Thread(target=self.flow_mod_sender)
         self.fs_thread.setDaemon(True)
@@ -57,89 +64,64 @@ class LogClient(object):
 
     def stop(self):
         self.run = False
-        
+
         self.fs_thread.join()
         self.logger.debug('flow mod sender terminated')
 
-        self.fp_thread.join()
-        self.logger.debug('file processor terminated')
-
-        self.flow_mod_queue.close()
-
-    ''' receiver '''
-    def file_processor(self):
-        with open(self.input_file) as infile:
-            flag = 0
-            tmp = {}
-
-            for line in infile:
-                if line.startswith("BURST"):
-                    flag = 1
-                    tmp = {"flow_mods": []}
-                    
-                    x = line.split("\n")[0].split(": ")[1]
-                    tmp["time"] = float(x)
-
-                elif line.startswith("PARTICIPANT") and flag == 1:
-                    flag = 2
-
-                    x = line.split("\n")[0].split(": ")[1]
-
-                    tmp["auth_info"] = {"participant": int(x), "auth_key": "secrect"}
-
-                elif flag == 2:
-                    if line.startswith("\n"):
-                        if not self.run:
-                            break
-
-                        self.logger.debug('processed one burst')
-
-                        self.flow_mod_queue.put(tmp)
-
-                        while self.flow_mod_queue.qsize() > 32000:
-                            self.logger.debug('queue is full - taking a break')
-                            sleep(self.sleep_time(tmp["time"])/2)
-
-                            if not self.run:
-                                break
-
-                        flag = 0
-
-                    else:
-                        tmp["flow_mods"].append(json.loads(line))
-
-        self.logger.debug('finished processing the log')
+    def load(self):
+        "Parse the log and encode every burst into the frame sent to the refmon"
+        for burst_time, participant, flow_mods in read_bursts(self.input_file):
+            # auth_info first, like FlowModMsgBuilder
+            msg = OrderedDict([("auth_info", OrderedDict([("participant", int(participant)), ("auth_key", "secrect")])),
+                               ("flow_mods", flow_mods)])
+            data = cPickle.dumps(json.dumps(msg), cPickle.HIGHEST_PROTOCOL)
+            self.bursts.append((burst_time, int(participant), HEADER.pack(len(data)) + data, len(flow_mods)))
 
     def flow_mod_sender(self):
-        while self.run:
-            try:
-                flow_mod = self.flow_mod_queue.get(True, 0.5)
-            except Empty:
-                continue
-
-            if self.timing:
-                if self.simulation_start_time == 0:
-                    self.real_start_time = time()
-                    self.simulation_start_time = flow_mod["time"]
-
-                sleep_time = self.sleep_time(flow_mod["time"])
-
-                self.logger.debug('sleep for ' + str(sleep_time) + ' seconds')
-
-                sleep(sleep_time)
-
-            self.send(flow_mod)
-
-    def send(self, flow_mod):
-        conn = Client((self.address, self.port))
-
-        conn.send(json.dumps(flow_mod))
+        # one persistent connection per participant keeps its bursts in order
+        conns = {}
+
+        start_time = time()
+        i = 0
+        while self.run and i < len(self.bursts):
+            if self.speed:
+                # everything that is due by now
+                j = i
+                while j < len(self.bursts) and self.sleep_time(start_time, self.bursts[j][0]) == 0:
+                    j += 1
+                if j == i:
+                    sleep(self.sleep_time(start_time, self.bursts[i][0]))
+                    continue
+            else:
+                j = min(i + BATCH_SIZE, len(self.bursts))
+
+            frames = {}
+            for _, participant, frame, count in self.bursts[i:j]:
+                frames.setdefault(participant, []).append(frame)
+                self.sent_flow_mods += count
+            for participant, participant_frames in frames.iteritems():
+                if participant not in conns:
+                    conns[participant] = self.connect()
+                conns[participant].sendall(''.join(participant_frames))
+
+            self.sent_bursts += j - i
+            i = j
+
+        self.elapsed = time() - start_time
+        for conn in conns.values():
+            conn.close()
+
+        self.logger.info('replayed ' + self.report())
+        self.run = False
 
-        conn.close()
+    def connect(self):
+        conn = socket.create_connection((self.address, self.port))
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
 
-    def sleep_time(self, flow_mod_time):
-        time_diff = flow_mod_time - self.simulation_start_time
-        wake_up_time = self.real_start_time + time_diff
+    def sleep_time(self, start_time, flow_mod_time):
+        time_diff = (flow_mod_time - self.bursts[0][0]) / self.speed
+        wake_up_time = start_time + time_diff
         sleep_time = wake_up_time - time()
 
         if sleep_time < 0:
@@ -147,8 +129,14 @@ class LogClient(object):
 
         return sleep_time
 
+    def report(self):
+        elapsed = max(self.elapsed, 1e-9)
+        return '%d bursts and %d flow mods in %.3fs: %.1f bursts/s, %.1f flow mods/s' % (
+            self.sent_bursts, self.sent_flow_mods, self.elapsed,
+            self.sent_bursts / elapsed, self.sent_flow_mods / elapsed)
+
 def main(argv):
-    log_client_instance = LogClient(args.ip, args.port, args.key, args.input, True, args.timing)
+    log_client_instance = LogClient(args.ip, args.port, args.key, args.input, True, args.timing, args.speed)
     log_client_instance.start()
 
     while log_client_instance.run:
@@ -157,6 +145,8 @@ def main(argv):
         except KeyboardInterrupt:
             log_client_instance.stop()
 
+    print log_client_instance.report()
+
 ''' main '''
 if __name__ == '__main__':
 
@@ -166,6 +156,7 @@ if __name__ == '__main__':
     parser.add_argument('key', help='authkey of the refmon')
     parser.add_argument('input', help='flow mod input file')
     parser.add_argument('-t', '--timing', help='enable timed replay of flow mods', action='store_true')
+    parser.add_argument('-s', '--speed', type=float, help='timed replay, SPEED times faster than logged (implies -t)')
 
     args = parser.parse_args()
 
@@ -10,6 +10,15 @@ import util.log
 
 LOG = True
 
+ofdpa = None
+
+def get_ofdpa(config):
+    "Return the OFDPA20 instance, created on first use"
+    global ofdpa
+    if ofdpa is None:
+        ofdpa = OFDPA20(config)
+    return ofdpa
+
 class OFDPA20():
     __shared_state = {}
 
@@ -37,6 +46,21 @@ class OFDPA20():
     def mark_group_mod_as_installed(self, datapath, group_mod):
         self.switch_info[datapath.id].mark_group_mod_as_installed(group_mod)
 
+    def acquire_groups(self, datapath, fm):
+        self.switch_info[datapath.id].acquire_groups(fm)
+
+    def release_groups(self, datapath, fm):
+        if datapath.id in self.switch_info:
+            self.switch_info[datapath.id].release_groups(fm)
+
+    def collect_groups(self, datapath):
+        if datapath.id in self.switch_info:
+            return self.switch_info[datapath.id].collect_groups()
+        return []
+
+    def forget_switch(self, datapath):
+        self.switch_info.pop(datapath.id, None)
+
 
 class OFDPA20_switch():
     def __init__(self, config, datapath):
@@ -51,20 +75,26 @@ class OFDPA20_switch():
 
         self.vlan = 1                    # untagged inputs go on vlan 1
 
-        self.l2_rewrite_to_gid = {}    # mapping from src/dst rewrite string to unique ID
+        self.l2_rewrite_to_gid = {}    # mapping from (port, eth_src, eth_dst) to unique ID
         self.l2_rewrite_uniq = 0
+        self.l2_rewrite_free = []      # IDs of collected rewrite groups
 
         self.l2_multicast_to_gid = {}  # mapping from mcast tuple of port #'s to unique ID
         self.l2_multicast_uniq = 0
+        self.l2_multicast_free = []
 
         self.gid_to_group_mod = {}
-        self.installed_group_mods = set()
+        self.installed_gids = set()
 
-    def make_instructions_and_group_mods(self, fm):
+        # rewrite and multicast groups are shared by flows and deleted
+        # once no flow uses them anymore, interface groups are kept
+        self.refs = {}                 # gid -> number of flows using it
+        self.gid_to_key = {}           # gid -> its key in l2_rewrite_to_gid or l2_multicast_to_gid
+
+    def parse_actions(self, fm):
         fwd_ports = []
         eth_src = None
         eth_dst = None
-        group_mods = []
 
         for action, value in fm.actions.iteritems():
             if action == "fwd":
@@ -81,6 +111,11 @@ class OFDPA20_switch():
                 eth_dst = value
             else:
                 self.logger.error('Unhandled action: ' + action + self.log_info)
+        return fwd_ports, eth_src, eth_dst
+
+    def make_instructions_and_group_mods(self, fm):
+        fwd_ports, eth_src, eth_dst = self.parse_actions(fm)
+        group_mods = []
 
         if fwd_ports:
             for port in fwd_ports:
@@ -140,8 +175,15 @@ class OFDPA20_switch():
     def l2_multicast_group_id(self, ports):
         mcast_key = tuple(sorted(ports))
         if not mcast_key in self.l2_multicast_to_gid:
-            self.l2_multicast_to_gid[mcast_key] = 0x30000000 | (self.vlan << 16) | (self.l2_multicast_uniq & 0xffff)
-            self.l2_multicast_uniq += 1
+            if self.l2_multicast_free:
+                uniq = self.l2_multicast_free.pop()
+            else:
+                uniq = self.l2_multicast_uniq
+                self.l2_multicast_uniq += 1
+            gid = 0x30000000 | (self.vlan << 16) | (uniq & 0xffff)
+            self.l2_multicast_to_gid[mcast_key] = gid
+            self.gid_to_key[gid] = mcast_key
+            self.refs[gid] = 0
         return self.l2_multicast_to_gid[mcast_key]
 
     # L2 Rewrite Group stuff
@@ -154,16 +196,63 @@ class OFDPA20_switch():
         return self.make_group_mod(fm, self.l2_rewrite_group_id(port, eth_src, eth_dst), actions)
 
     def l2_rewrite_group_id(self, port, eth_src, eth_dst):
-        rewrite_key = "port: " + str(port) + ('' if not eth_src else " eth_src: " + eth_src) + ('' if not eth_dst else " eth_dst: " + eth_dst)
+        rewrite_key = (port, eth_src or None, eth_dst or None)
         if not rewrite_key in self.l2_rewrite_to_gid:
-            self.l2_rewrite_to_gid[rewrite_key] = (1 << 28) | (self.l2_rewrite_uniq & 0xffff)
-            self.l2_rewrite_uniq += 1
+            if self.l2_rewrite_free:
+                uniq = self.l2_rewrite_free.pop()
+            else:
+                uniq = self.l2_rewrite_uniq
+                self.l2_rewrite_uniq += 1
+            gid = (1 << 28) | (uniq & 0xffff)
+            self.l2_rewrite_to_gid[rewrite_key] = gid
+            self.gid_to_key[gid] = rewrite_key
+            self.refs[gid] = 0
         return self.l2_rewrite_to_gid[rewrite_key]
 
+    def shared_group_id(self, fm):
+        "The rewrite or multicast group fm's flow points to, None if it uses none"
+        fwd_ports, eth_src, eth_dst = self.parse_actions(fm)
+        if (eth_src or eth_dst) and fwd_ports:
+            return self.l2_rewrite_to_gid.get((fwd_ports[0], eth_src or None, eth_dst or None))
+        if len(fwd_ports) > 1:
+            return self.l2_multicast_to_gid.get(tuple(sorted(fwd_ports)))
+        return None
+
+    # Group lifetimes
+    def acquire_groups(self, fm):
+        gid = self.shared_group_id(fm)
+        if gid is not None:
+            self.refs[gid] += 1
+
+    def release_groups(self, fm):
+        gid = self.shared_group_id(fm)
+        if gid is not None:
+            self.refs[gid] -= 1
+
+    def collect_groups(self):
+        "Forget the shared groups no flow uses, returns the group mods deleting them from the switch"
+        group_mods = []
+        for gid in [gid for gid, refs in self.refs.iteritems() if refs <= 0]:
+            del self.refs[gid]
+            key = self.gid_to_key.pop(gid)
+            self.gid_to_group_mod.pop(gid, None)
+            if gid >> 28 == 1:
+                del self.l2_rewrite_to_gid[key]
+                self.l2_rewrite_free.append(gid & 0xffff)
+            else:
+                del self.l2_multicast_to_gid[key]
+                self.l2_multicast_free.append(gid & 0xffff)
+
+            if gid in self.installed_gids:
+                self.installed_gids.discard(gid)
+                group_mods.append(self.datapath.ofproto_parser.OFPGroupMod(datapath=self.datapath,
+                                                                           command=self.config.ofproto.OFPGC_DELETE,
+                                                                           group_id=gid))
+        return group_mods
 
     def is_group_mod_installed_in_switch(self, group_mod):
-        return group_mod in self.installed_group_mods
+        return group_mod.group_id in self.installed_gids
 
     def mark_group_mod_as_installed(self, group_mod):
         self.logger.info('Group mod installed ' + str(group_mod) + self.log_info)
-        self.installed_group_mods.add(group_mod)
+        self.installed_gids.add(group_mod.group_id)
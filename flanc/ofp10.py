@@ -29,7 +29,7 @@ class FlowMod(object):
 
     def validate_flow_mod(self, flow_mod):
         if "id" in flow_mod:
-            self.cookie = int('{0:08b}'.format(int(self.origin))+'{0:08b}'.format(int(flow_mod["id"])),2)
+            self.cookie = (int(self.origin) << 8) | int(flow_mod["id"])
             if ("mod_type" in flow_mod and flow_mod["mod_type"] in self.mod_types):
                 self.mod_type = flow_mod["mod_type"]
                 if ("rule_type" in flow_mod and flow_mod["rule_type"] in self.rule_types):
@@ -159,8 +159,7 @@ class FlowMod(object):
                                           match=match, 
                                           cookie=self.cookie,
                                           command=self.config.ofproto.OFPFC_DELETE, 
-                                          out_group=self.config.ofproto.OFPG_ANY, 
-                                          out_port=self.config.ofproto.OFPP_ANY)
+                                          out_port=self.config.ofproto.OFPP_NONE)
 
     def get_dst_dp(self):
         return self.rule_type 
@@ -4,7 +4,21 @@
 from ryu.ofproto import ether
 from ryu.ofproto import inet
 
-from ofdpa20 import OFDPA20
+from ofdpa20 import get_ofdpa
+
+# match field -> fields (and values) it requires if not given explicitly
+MATCH_PREREQUISITES = {
+    "eth_type": (),
+    "arp_tpa":  (("eth_type", ether.ETH_TYPE_ARP),),
+    "ipv4_src": (("eth_type", ether.ETH_TYPE_IP),),
+    "ipv4_dst": (("eth_type", ether.ETH_TYPE_IP),),
+    "tcp_src":  (("eth_type", ether.ETH_TYPE_IP), ("ip_proto", inet.IPPROTO_TCP)),
+    "tcp_dst":  (("eth_type", ether.ETH_TYPE_IP), ("ip_proto", inet.IPPROTO_TCP)),
+    "udp_src":  (("eth_type", ether.ETH_TYPE_IP), ("ip_proto", inet.IPPROTO_UDP)),
+    "udp_dst":  (("eth_type", ether.ETH_TYPE_IP), ("ip_proto", inet.IPPROTO_UDP)),
+}
+
+MAC_FIELDS = frozenset(["eth_dst", "eth_src"])
 
 class FlowMod(object):
     def __init__(self, config, origin, flow_mod):
@@ -26,7 +40,7 @@ class FlowMod(object):
         self.actions = []
 
         if self.config.ofdpa:
-            self.ofdpa = OFDPA20(config);
+            self.ofdpa = get_ofdpa(config)
 
         self.validate_flow_mod(flow_mod)
 
@@ -36,10 +50,10 @@ class FlowMod(object):
     def validate_flow_mod(self, flow_mod):
         if "cookie" in flow_mod:
             if len(flow_mod["cookie"]) > 1:
-                self.cookie["cookie"] = int('{0:016b}'.format(int(self.origin))+'{0:016b}'.format(int(flow_mod["cookie"][0])),2)
-                self.cookie["mask"] = int('{0:016b}'.format(2**16-1) + '{0:016b}'.format(flow_mod["cookie"][1]),2)
+                self.cookie["cookie"] = (int(self.origin) << 16) | int(flow_mod["cookie"][0])
+                self.cookie["mask"] = (0xffff << 16) | int(flow_mod["cookie"][1])
             else:
-                self.cookie["cookie"] = int('{0:016b}'.format(int(self.origin))+'{0:016b}'.format(int(flow_mod["cookie"])),2)
+                self.cookie["cookie"] = (int(self.origin) << 16) | int(flow_mod["cookie"])
                 self.cookie["mask"] = 2**32-1
             if ("mod_type" in flow_mod and flow_mod["mod_type"] in self.mod_types):
                 self.mod_type = flow_mod["mod_type"]
@@ -60,13 +74,7 @@ class FlowMod(object):
         validated_matches = {}
 
         for match, value in matches.iteritems():
-            if match == "eth_type":
-                validated_matches[match] = value
-            elif match == "arp_tpa":
-                validated_matches[match] = value
-                if "eth_type" not in validated_matches:
-                    validated_matches["eth_type"] = ether.ETH_TYPE_ARP
-            elif match == "in_port":
+            if match == "in_port":
                 if isinstance( value, int ) or value.isdigit():
                     validated_matches["in_port"] = value
                 else:
@@ -78,44 +86,14 @@ class FlowMod(object):
                     else: 
                         if self.rule_type in self.config.datapath_ports and value in self.config.datapath_ports[self.rule_type]:
                             validated_matches["in_port"] = self.config.datapath_ports[self.rule_type][value]
-            elif match == "eth_dst":
+            elif match in MAC_FIELDS:
                 if len(value) > 1:
                     validated_matches[match] = value
-            elif match == "eth_src":
-                if len(value) > 1:
-                    validated_matches[match] = value
-            elif match == "ipv4_src":
-                validated_matches[match] = value
-                if "eth_type" not in validated_matches:
-                    validated_matches["eth_type"] = ether.ETH_TYPE_IP
-            elif match == "ipv4_dst":
-                validated_matches[match] = value
-                if "eth_type" not in validated_matches:
-                    validated_matches["eth_type"] = ether.ETH_TYPE_IP
-            elif match == "tcp_src":
-                validated_matches[match] = value
-                if "eth_type" not in validated_matches:
-                    validated_matches["eth_type"] = ether.ETH_TYPE_IP
-                if "ip_proto" not in validated_matches:
-                    validated_matches["ip_proto"] = inet.IPPROTO_TCP
-            elif match == "tcp_dst":
-                validated_matches[match] = value
-                if "eth_type" not in validated_matches:
-                    validated_matches["eth_type"] = ether.ETH_TYPE_IP
-                if "ip_proto" not in validated_matches:
-                    validated_matches["ip_proto"] = inet.IPPROTO_TCP
-            elif match == "udp_src":
-                validated_matches[match] = value
-                if "eth_type" not in validated_matches:
-                    validated_matches["eth_type"] = ether.ETH_TYPE_IP
-                if "ip_proto" not in validated_matches:
-                    validated_matches["ip_proto"] = inet.IPPROTO_UDP
-            elif match == "udp_dst":
+            elif match in MATCH_PREREQUISITES:
                 validated_matches[match] = value
-                if "eth_type" not in validated_matches:
-                    validated_matches["eth_type"] = ether.ETH_TYPE_IP
-                if "ip_proto" not in validated_matches:
-                    validated_matches["ip_proto"] = inet.IPPROTO_UDP
+                for field, field_value in MATCH_PREREQUISITES[match]:
+                    if field not in validated_matches:
+                        validated_matches[field] = field_value
         return validated_matches
 
     def make_instructions(self):
@@ -187,7 +165,10 @@ class FlowMod(object):
         self.parser = config.parser
         group_mods = []
 
-        match = self.parser.OFPMatch(**self.matches)
+        # OFPMatch and instruction objects are shared by flow mods with equal
+        # match/actions, per config and parser
+        match_cache, instruction_cache = config.get_compile_caches()
+        match = match_cache.lookup(self.matches, lambda: self.parser.OFPMatch(**self.matches))
 
         if self.config.tables:
             if self.rule_type == "arp":
@@ -204,7 +185,7 @@ class FlowMod(object):
             if self.is_ofdpa_datapath(datapath):
                 instructions, group_mods = self.ofdpa.make_instructions_and_group_mods(self, datapath)
             else:
-                instructions = self.make_instructions()
+                instructions = instruction_cache.lookup((self.rule_type, self.actions), self.make_instructions)
             flow_mod = self.parser.OFPFlowMod(datapath=datapath, 
                                           cookie=self.cookie["cookie"], cookie_mask=self.cookie["mask"], 
                                           table_id=table_id, 
@@ -2,10 +2,9 @@
 #  Rudiger Birkner (Networked Systems Group ETH Zurich)
 
 
+from collections import OrderedDict
 import json
-from multiprocessing import Queue
 import os
-from Queue import Empty
 from time import time
 
 from ryu import cfg
@@ -21,6 +20,8 @@ if np not in sys.path:
 import util.log
 
 from lib import MultiSwitchController, MultiTableController, Config, InvalidConfigError
+from lib import Burst, LatencyHistogram, LATENCY_LOG_INTERVAL
+from flow_mod_log import FlowModLogWriter
 from ofp10 import FlowMod as OFP10FlowMod
 from ofp13 import FlowMod as OFP13FlowMod
 from server import Server
@@ -56,7 +57,8 @@ class RefMon(app_manager.RyuApp):
         log_file_path = CONF['refmon']['flowmodlog']
         if log_file_path is not None:
             log_file = os.path.abspath(log_file_path)
-            self.flow_mod_log = open(log_file, "w")
+            binary = CONF['refmon']['flowmodlogformat'] == 'binary'
+            self.flow_mod_log = FlowModLogWriter(log_file, binary)
         else:
             self.flow_mod_log = None
 
@@ -78,8 +80,9 @@ class RefMon(app_manager.RyuApp):
         elif self.config.isMultiTableMode():
             self.controller = MultiTableController(self.config)
 
-	# this must be set before Server, which uses it.
-        self.flow_mod_times = Queue()
+        # receive to install latency of the bursts
+        self.burst_latency = LatencyHistogram()
+        self.last_latency_log = time()
 
         # start server receiving flowmod requests
         self.server = Server(self, self.config.server["IP"], self.config.server["Port"], self.config.server["key"])
@@ -110,20 +113,31 @@ class RefMon(app_manager.RyuApp):
 
     @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
     def barrier_reply_handler(self, ev):
-        datapath = ev.msg.datapath
-        if self.controller.handle_barrier_reply(datapath):
-            end_time = time()
+        for burst in self.controller.handle_barrier_reply(ev.msg.datapath, ev.msg.xid):
+            if burst.installed_on_datapath():
+                self.burst_installed(burst)
 
-            try:
-                start_time = self.flow_mod_times.get_nowait()
-            except Empty:
-                pass
+    def burst_installed(self, burst):
+        end_time = time()
+        latency = end_time - burst.received
+        self.burst_latency.add(latency)
 
-            if self.log:
-                self.log.write(str(start_time) + " " + str(end_time) + " " + str(end_time - start_time) + "\n")
+        # one json object per line
+        if self.log:
+            self.log.write(json.dumps({"participant": burst.participant,
+                                       "received": burst.received,
+                                       "installed": end_time,
+                                       "latency": latency,
+                                       "flow_mods": burst.flow_mods,
+                                       "datapaths": burst.datapaths}) + "\n")
+
+        if end_time - self.last_latency_log >= LATENCY_LOG_INTERVAL:
+            self.last_latency_log = end_time
+            self.logger.info('refmon: burst latency: ' + self.burst_latency.summary())
 
-    def process_flow_mods(self, msg):
-        self.flow_mod_times.put(time())
+    def process_flow_mods(self, msg, received=None):
+        if received is None:
+            received = time()
 
         self.logger.info('refmon: received flowmod request')
 
@@ -137,24 +151,28 @@ class RefMon(app_manager.RyuApp):
 
             if "flow_mods" in msg:
 
-                # flow mod logging
+                # flow mod logging, encoded and written by the log's own thread
                 if self.flow_mod_log:
-                    self.flow_mod_log.write('BURST: ' + str(time()) + '\n')
-                    self.flow_mod_log.write('PARTICIPANT: ' + str(msg['auth_info']['participant']) + '\n')
-                    for flow_mod in msg["flow_mods"]:
-                        self.flow_mod_log.write(json.dumps(flow_mod) + '\n')
-                    self.flow_mod_log.write('\n')
-
-                self.logger.debug('BURST: ' + str(time()))
-                self.logger.debug('PARTICIPANT: ' + str(msg['auth_info']['participant']))
-                for flow_mod in msg["flow_mods"]:
-                    self.logger.debug('FLOWMOD from ' + str(origin) + ': ' + json.dumps(flow_mod))
+                    self.flow_mod_log.write(received, origin, msg["flow_mods"])
 
+                self.logger.debug('BURST from ' + str(origin) + ': ' + str(len(msg["flow_mods"])) + ' flow mods')
 
-                # push flow mods to the data plane
+                # bursts of different participants are validated concurrently
+                fms = []
                 for flow_mod in msg["flow_mods"]:
                     if self.config.ofv == "1.0":
                         fm = OFP10FlowMod(self.config, origin, flow_mod)
                     elif self.config.ofv == "1.3":
                         fm = OFP13FlowMod(self.config, origin, flow_mod)
-                    self.controller.process_flow_mod(fm)
+                    fms.append(fm)
+
+                # but only one burst at a time is pushed to each datapath,
+                # keeping each burst's order
+                dp_2_fms = OrderedDict()
+                for fm in fms:
+                    dp_2_fms.setdefault(fm.get_dst_dp(), []).append(fm)
+
+                burst = Burst(origin, received, len(fms), dp_2_fms.keys())
+                for dp_name, dp_fms in dp_2_fms.iteritems():
+                    with self.controller.dp_lock(dp_name):
+                        self.controller.process_flow_mods(dp_fms, burst)
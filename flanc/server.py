@@ -4,9 +4,17 @@
 #  Rudiger Birkner (Networked Systems Group ETH Zurich)
 
 
+import cPickle
+from cStringIO import StringIO
+import errno
 import json
-from multiprocessing.connection import Listener
+from Queue import Queue
+import re
+import select
+import socket
+import struct
 from threading import Thread
+from time import time
 
 import os
 import sys
@@ -16,6 +24,19 @@ if np not in sys.path:
 import util.log
 
 
+# multiprocessing.connection frames every message with its length
+HEADER = struct.Struct('!i')
+# larger frames are rejected along with their connection
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+# drop connections that haven't sent anything for that long before their first message,
+# and those that haven't said whose they are that long after they were accepted
+CONN_TIMEOUT = 5
+
+# senders that put auth_info first say whose a connection is in its first bytes
+PEEK_SIZE = 128
+PARTICIPANT = re.compile(r'\{"auth_info": \{"participant": "?(\w+)"?')
+
 ''' Server of Reference Monitor to Receive Flow Mods '''
 class Server(object):
 
@@ -24,8 +45,19 @@ class Server(object):
         self.logger.info('server: start')
 
         self.refmon = refmon
-        #self.listener = Listener((address, port), authkey=str(key), backlog=100)
-        self.listener = Listener((address, port), backlog=100)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((address, port))
+        self.listener.listen(100)
+
+        # PendingConnections in accept order, until their first message is dispatched
+        self.accepted = []
+        self.seq = 0
+        # connections that keep sending messages after their first one
+        self.streaming = []
+
+        # origin -> queue of messages, each drained by its own worker
+        self.workers = {}
 
     def start(self):
         self.receive = True
@@ -35,21 +67,189 @@ class Server(object):
     ''' receiver '''
     def receiver(self):
         while self.receive:
-            conn = self.listener.accept()
-            self.logger.info('server: accepted connection from ' + str(self.listener.last_accepted))
+            fds = [self.listener] + [c.sock for c in self.accepted + self.streaming if not c.done]
+            readable, _, _ = select.select(fds, [], [], 1)
 
-            msg = None
-            while msg is None:
-                try:
-                    msg = conn.recv()
-                except:
-                    pass
+            for sock in readable:
+                if sock is self.listener:
+                    self.accept()
+            # read in accept order, so messages of one participant stay in order
+            for pc in self.accepted + self.streaming:
+                if pc.sock in readable:
+                    pc.read()
+
+            self.dispatch()
+
+    def accept(self):
+        conn, addr = self.listener.accept()
+        conn.setblocking(0)
+        self.logger.info('server: accepted connection from ' + str(addr))
+
+        self.seq += 1
+        pc = PendingConnection(conn, self.seq, self.logger)
+        self.accepted.append(pc)
+
+    def dispatch(self):
+        '''
+        Hand complete messages to the workers, each participant's connections
+        in the order they were accepted. A participant sends its bursts one
+        connection after the other, so a complete message only waits for
+        earlier connections of the same participant, and for earlier ones
+        that haven't told whose they are yet. A connection that stays open
+        after its first message is a persistent one, from then on its
+        messages are handed over as soon as they are complete.
+        '''
+        now = time()
+        # participants with an earlier connection still pending
+        waiting = set()
+        # an earlier pending connection could be anyone's
+        unknown = False
+        accepted = []
+        for pc in self.accepted:
+            if not pc.msgs and not pc.done and now - pc.last_recv >= CONN_TIMEOUT:
+                self.logger.warning('server: dropping connection that stalled before its first message')
+                pc.close()
+            elif pc.participant is None and not pc.done and now - pc.accepted >= CONN_TIMEOUT:
+                # it holds up everyone's connections
+                self.logger.warning('server: dropping connection that did not identify its participant in time')
+                pc.close()
+
+            if pc.msgs and not unknown and pc.participant not in waiting:
+                self.hand_over(pc)
+                if not pc.done:
+                    self.streaming.append(pc)
+                continue
+            if pc.done and not pc.msgs:
+                continue
+
+            accepted.append(pc)
+            if pc.participant is None:
+                unknown = True
+            else:
+                waiting.add(pc.participant)
+        self.accepted = accepted
+
+        for pc in self.streaming:
+            self.hand_over(pc)
+        self.streaming = [pc for pc in self.streaming if not pc.done]
+
+    def hand_over(self, pc):
+        for msg, origin, received in pc.msgs:
             self.logger.info('server: received message')
-            self.refmon.process_flow_mods(json.loads(msg))
+            if origin not in self.workers:
+                queue = Queue()
+                worker = Thread(target=self.worker, args=(queue,))
+                worker.daemon = True
+                worker.start()
+                self.workers[origin] = queue
+            self.workers[origin].put((msg, received))
+        pc.msgs = []
 
-            conn.close()
-            self.logger.info('server: closed connection')
+    def worker(self, queue):
+        while True:
+            msg, received = queue.get()
+            try:
+                self.refmon.process_flow_mods(msg, received)
+            except Exception:
+                self.logger.exception('server: failed to process flow mods')
 
     def stop(self):
         self.receive = False
         self.receiver.join(1)
+
+
+''' a connection and the messages read from it that haven't been dispatched yet '''
+class PendingConnection(object):
+
+    def __init__(self, sock, seq, logger):
+        self.sock = sock
+        self.seq = seq
+        self.logger = logger
+        self.accepted = self.last_recv = time()
+        self.chunks = []
+        self.size = 0
+        self.length = None
+        # (message, participant, time it was complete)
+        self.msgs = []
+        # as a string, from the first bytes or the first message
+        self.participant = None
+        self.peeked = False
+        self.done = False
+
+    def read(self):
+        while not self.done:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                data = ''
+
+            if not data:
+                # closed by the client
+                self.close()
+                break
+
+            self.last_recv = time()
+            self.chunks.append(data)
+            self.size += len(data)
+
+            if not self.peeked and (self.size >= PEEK_SIZE or self.msgs):
+                self.peek()
+
+            # wait until the next message is complete
+            if self.size < HEADER.size or (self.length is not None and self.size < HEADER.size + self.length):
+                continue
+
+            buf = ''.join(self.chunks)
+            offset = 0
+            while len(buf) - offset >= HEADER.size:
+                length = HEADER.unpack_from(buf, offset)[0]
+                if not 0 <= length <= MAX_MESSAGE_SIZE:
+                    self.logger.warning('server: dropping connection that sent a frame of ' + str(length) + ' bytes')
+                    self.close()
+                    return
+                end = offset + HEADER.size + length
+                if end > len(buf):
+                    break
+                try:
+                    self.add_message(buf[offset + HEADER.size:end])
+                except Exception as e:
+                    self.logger.warning('server: dropping connection that sent an undecodable message: ' + str(e))
+                    self.close()
+                    return
+                offset = end
+
+            self.chunks = [buf[offset:]]
+            self.size = len(buf) - offset
+            self.length = HEADER.unpack_from(buf, offset)[0] if self.size >= HEADER.size else None
+
+    def peek(self):
+        self.peeked = True
+        if self.participant is None and not self.msgs:
+            match = PARTICIPANT.search(''.join(self.chunks)[:PEEK_SIZE])
+            if match:
+                self.participant = match.group(1)
+
+    def add_message(self, data):
+        # the messages are pickled strings, don't let them name anything else
+        unpickler = cPickle.Unpickler(StringIO(data))
+        unpickler.find_global = None
+        msg = unpickler.load()
+        if not isinstance(msg, basestring):
+            raise ValueError('not a string')
+
+        # without auth_info the connection can't be placed among its participant's
+        msg = json.loads(msg)
+        try:
+            origin = msg["auth_info"]["participant"]
+        except (KeyError, TypeError):
+            raise ValueError('no auth_info')
+
+        if self.participant is None:
+            self.participant = str(origin)
+        self.msgs.append((msg, origin, time()))
+
+    def close(self):
+        self.done = True
+        self.sock.close()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#  Author:
+#  Rudiger Birkner (Networked Systems Group ETH Zurich)
+
+
+from collections import OrderedDict
+import cPickle
+import json
+import socket
+from threading import Event
+import time
+import unittest
+
+import server
+from server import HEADER, Server
+
+
+def frame(msg):
+    data = cPickle.dumps(msg, cPickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(len(data)) + data
+
+
+def flow_mods(participant):
+    return json.dumps(OrderedDict([("auth_info", OrderedDict([("participant", participant), ("auth_key", "key")])),
+                                   ("flow_mods", [])]))
+
+
+class FakeRefMon(object):
+    def __init__(self):
+        self.msgs = []
+        self.received = Event()
+
+    def process_flow_mods(self, msg, received):
+        self.msgs.append(msg)
+        self.received.set()
+
+
+''' a bad connection must not hold up the others '''
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.refmon = FakeRefMon()
+        self.server = Server(self.refmon, 'localhost', 0, None)
+        self.address = self.server.listener.getsockname()
+        self.server.start()
+        self.socks = []
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+        self.server.stop()
+        self.server.listener.close()
+
+    def connect(self):
+        sock = socket.create_connection(self.address)
+        self.socks.append(sock)
+        # accept order is the dispatch order
+        time.sleep(0.1)
+        return sock
+
+    def assert_closed(self, sock):
+        sock.settimeout(2)
+        self.assertEqual(sock.recv(1), '')
+
+    def assert_dispatched(self, participant):
+        # well within CONN_TIMEOUT
+        self.assertTrue(self.refmon.received.wait(1))
+        self.assertEqual([msg["auth_info"]["participant"] for msg in self.refmon.msgs], [participant])
+
+    def test_message_without_auth_info_closes(self):
+        bad = self.connect()
+        # a first chunk too short to peek at, so the participant isn't known
+        bad.sendall(frame(json.dumps({"flow_mods": []})))
+        good = self.connect()
+        good.sendall(frame(flow_mods(2)))
+
+        self.assert_closed(bad)
+        self.assert_dispatched(2)
+
+    def test_non_json_message_closes(self):
+        bad = self.connect()
+        bad.sendall(frame('not json'))
+        good = self.connect()
+        good.sendall(frame(flow_mods(2)))
+
+        self.assert_closed(bad)
+        self.assert_dispatched(2)
+
+    def test_trickling_unknown_connection_is_dropped(self):
+        timeout, server.CONN_TIMEOUT = server.CONN_TIMEOUT, 0.5
+        try:
+            bad = self.connect()
+            good = self.connect()
+            good.sendall(frame(flow_mods(2)))
+            # a byte at a time never lets the connection stall
+            bad.sendall(HEADER.pack(1000))
+            start = time.time()
+            while not self.refmon.received.is_set() and time.time() - start < 3:
+                bad.sendall(' ')
+                time.sleep(0.05)
+            self.assertTrue(self.refmon.received.is_set())
+            self.assert_dispatched(2)
+            self.assert_closed(bad)
+        finally:
+            server.CONN_TIMEOUT = timeout
+
+
+if __name__ == '__main__':
+    unittest.main()
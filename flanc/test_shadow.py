@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#  Author:
+#  Rudiger Birkner (Networked Systems Group ETH Zurich)
+
+
+import unittest
+
+from ryu.ofproto import ofproto_v1_3
+
+from bench_refmon import MS_CONFIG, FakeDatapath, StubParser
+from lib import Config, MultiSwitchController, ShadowFlowTable, delete_covers
+from ofdpa20 import get_ofdpa
+from ofp13 import FlowMod
+
+
+class FakeOFProto(object):
+    OFPFC_ADD = 0
+    OFPFC_MODIFY_STRICT = 2
+    OFPFC_DELETE = 3
+
+
+class FakeOFPFlowMod(object):
+    def __init__(self, command, cookie, cookie_mask=0):
+        self.command = command
+        self.cookie = cookie
+        self.cookie_mask = cookie_mask
+        self.table_id = 0
+
+
+class FakeFlowMod(object):
+    "What the shadow table reads of an ofp13.FlowMod"
+    def __init__(self, matches, actions=None, priority=4):
+        self.matches = matches
+        self.actions = actions or {"fwd": ["inbound"]}
+        self.priority = priority
+
+
+def add(shadow, matches, cookie=1, actions=None):
+    return shadow.update(FakeFlowMod(matches, actions), FakeOFPFlowMod(FakeOFProto.OFPFC_ADD, cookie), FakeOFProto)
+
+
+def delete(shadow, matches, cookie=0, cookie_mask=0):
+    return shadow.update(FakeFlowMod(matches), FakeOFPFlowMod(FakeOFProto.OFPFC_DELETE, cookie, cookie_mask), FakeOFProto)
+
+
+''' the shadow table may only forget flows the switch certainly deleted '''
+class ShadowFlowTableTest(unittest.TestCase):
+
+    def test_masked_delete_keeps_flows_outside_the_mask(self):
+        shadow = ShadowFlowTable()
+        add(shadow, {"ipv4_dst": "10.0.0.1"})
+        add(shadow, {"ipv4_dst": "11.0.0.1"})
+
+        flow_mod, removed = delete(shadow, {"ipv4_dst": ["10.0.0.0", "255.0.0.0"]})
+        self.assertNotEqual(flow_mod, None)
+        self.assertEqual([fm.matches for fm in removed], [{"ipv4_dst": "10.0.0.1"}])
+
+        # the switch still has 11.0.0.1, deleting it must reach the switch
+        flow_mod, removed = delete(shadow, {"ipv4_dst": "11.0.0.1"})
+        self.assertNotEqual(flow_mod, None)
+        self.assertEqual(len(removed), 1)
+        self.assertEqual(shadow.flow_mods(), [])
+
+    def test_delete_of_nothing_is_suppressed(self):
+        shadow = ShadowFlowTable()
+        add(shadow, {"ipv4_dst": "11.0.0.1"})
+        flow_mod, removed = delete(shadow, {"ipv4_dst": "10.0.0.0/8"})
+        self.assertEqual((flow_mod, removed), (None, []))
+        self.assertEqual(len(shadow.flow_mods()), 1)
+
+    def test_unsure_flow_is_kept_and_not_suppressed(self):
+        shadow = ShadowFlowTable()
+        add(shadow, {"eth_type": "arp"})
+        # a value the shadow doesn't understand, the switch may have deleted the flow
+        flow_mod, removed = delete(shadow, {"eth_type": "ip"})
+        self.assertNotEqual(flow_mod, None)
+        self.assertEqual(removed, [])
+        self.assertEqual(len(shadow.flow_mods()), 1)
+
+        # so adding it again is sent, and a later delete too
+        flow_mod, _ = add(shadow, {"eth_type": "arp"})
+        self.assertEqual(flow_mod.command, FakeOFProto.OFPFC_ADD)
+        delete(shadow, {"eth_type": "ip"})
+        flow_mod, _ = delete(shadow, {"eth_type": "ip"})
+        self.assertNotEqual(flow_mod, None)
+
+    def test_delete_covers(self):
+        self.assertTrue(delete_covers({"eth_dst": "20:00:00:00:01:02", "tcp_dst": 80},
+                                      {"eth_dst": ["20:00:00:00:01:00", "ff:ff:ff:ff:ff:00"]}))
+        self.assertFalse(delete_covers({"eth_dst": "20:00:00:00:02:02"},
+                                       {"eth_dst": ["20:00:00:00:01:00", "ff:ff:ff:ff:ff:00"]}))
+        # a flow that matches more than the delete isn't removed
+        self.assertFalse(delete_covers({"ipv4_dst": "10.0.0.0/8"}, {"ipv4_dst": "10.0.0.0/16"}))
+        self.assertTrue(delete_covers({"ipv4_dst": "10.1.0.0/16"}, {"ipv4_dst": "10.0.0.0/255.0.0.0"}))
+        self.assertFalse(delete_covers({}, {"tcp_dst": 80}))
+        self.assertTrue(delete_covers({"tcp_dst": 80}, {}))
+        self.assertEqual(delete_covers({"eth_type": "arp"}, {"eth_type": "ip"}), None)
+
+
+''' a shared OFDPA group stays while a flow that points to it is installed '''
+class GroupRefcountTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = Config(MS_CONFIG)
+        self.config.ofv = "1.3"
+        self.config.always_ready = True
+        self.config.ofdpa = set(self.config.dpids)
+        self.controller = MultiSwitchController(self.config)
+        for dpid in self.config.dpids.itervalues():
+            self.controller.switch_connect(FakeDatapath(dpid, ofproto_v1_3, StubParser))
+        self.dp = self.config.datapaths["outbound"]
+        self.shadow = self.controller.shadow["outbound"]
+
+    def tearDown(self):
+        for dp in self.config.datapaths.values():
+            get_ofdpa(self.config).forget_switch(dp)
+
+    def burst(self, mod_type, ipv4_dst):
+        flow_mod = {"rule_type": "outbound", "mod_type": mod_type, "priority": 4, "cookie": [1, 65535],
+                    "action": {"fwd": ["inbound"], "set_eth_dst": "a2:00:00:00:01:01"},
+                    "match": {"ipv4_dst": ipv4_dst}}
+        msgs = self.controller.burst_msgs(self.dp, self.shadow, [FlowMod(self.config, 1, flow_mod)])
+        # the stub flow mods and group mods are the same class
+        return [msg for msg in msgs if hasattr(msg, 'group_id') and msg.command == ofproto_v1_3.OFPGC_DELETE]
+
+    def test_masked_delete_keeps_group_of_uncovered_flow(self):
+        self.burst("insert", "10.0.0.1")
+        self.burst("insert", "11.0.0.1")
+        switch = get_ofdpa(self.config).switch_info[self.dp.id]
+        gid, = switch.refs.keys()
+        self.assertEqual(switch.refs[gid], 2)
+
+        # 11.0.0.1 is still installed and points to the group
+        self.assertEqual(self.burst("remove", ["10.0.0.0", "255.0.0.0"]), [])
+        self.assertEqual(switch.refs[gid], 1)
+
+        deletes = self.burst("remove", "11.0.0.1")
+        self.assertEqual([msg.group_id for msg in deletes], [gid])
+        self.assertEqual(switch.refs, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
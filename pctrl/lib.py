@@ -17,6 +17,7 @@ if np not in sys.path:
 from xctrl.flowmodmsg import FlowModMsgBuilder
 
 from peer import BGPPeer
+from vnh import VNH_GRACE_PERIOD
 
 
 class PConfig(object):
@@ -84,6 +85,8 @@ class PConfig(object):
 
 
         self.VNHs = IPNetwork(config["VNHs"])
+        self.vnh_grace_period = float(config.get("VNH Grace Period", VNH_GRACE_PERIOD))
+        self.vnh_sharing = bool(config.get("VNH Sharing", False))
 
     def get_macs(self):
         return [port['MAC'] for port in self.ports]
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+#  Author:
+#  Rudiger Birkner (Networked Systems Group ETH Zurich)
+
+
+from threading import RLock
+
+
+# locks shared by all prefixes, independent of the size of the table
+LOCK_STRIPES = 256
+
+
+''' RLock that counts how often it had to wait, the counts are only updated while it is held '''
+class StripeLock(object):
+    def __init__(self):
+        self.lock = RLock()
+        self.acquired = 0
+        self.contended = 0
+
+    def __enter__(self):
+        contended = not self.lock.acquire(False)
+        if contended:
+            self.lock.acquire()
+        self.acquired += 1
+        self.contended += contended
+        return self
+
+    def __exit__(self, *args):
+        self.lock.release()
+
+
+''' a fixed pool of locks, a prefix gets the one its hash points to '''
+class StripedLocks(object):
+    def __init__(self, stripes=LOCK_STRIPES):
+        self.locks = [StripeLock() for _ in xrange(stripes)]
+
+    def get(self, prefix):
+        return self.locks[hash(prefix) % len(self.locks)]
+
+    def stats(self):
+        acquired = sum(lock.acquired for lock in self.locks)
+        contended = sum(lock.contended for lock in self.locks)
+        return 'stripes=%d acquired=%d contended=%d' % (len(self.locks), acquired, contended)
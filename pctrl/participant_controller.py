@@ -5,12 +5,13 @@
 
 import argparse
 import atexit
+from collections import deque
 import json
 from multiprocessing.connection import Listener, Client
 import os
 from signal import signal, SIGTERM
 from sys import exit
-from threading import RLock, Thread
+from threading import Thread
 import time
 
 import sys
@@ -24,11 +25,15 @@ from lib import PConfig
 from peer import BGPPeer
 from ss_lib import vmac_part_port_match
 from ss_rule_scheme import update_outbound_rules, init_inbound_rules, init_outbound_rules, msg_clear_all_outbound, ss_process_policy_change
-from supersets import SuperSets
+from supersets import SuperSets, get_all_participants_advertising
+from vnh import VNHAllocator, SharedVNHAllocator
 
 
 TIMING = True
 
+# (vnh, vmac) pairs per bulk garp message to the ARP proxy
+GARP_BULK_SIZE = 1024
+
 
 class ParticipantController(object):
     def __init__(self, id, config_file, policy_file, logger):
@@ -39,7 +44,6 @@ class ParticipantController(object):
 
         # used to signal termination
         self.run = True
-        self.prefix_lock = {}
 
         # Initialize participant params
         self.cfg = PConfig(config_file, self.id)
@@ -56,10 +60,15 @@ class ParticipantController(object):
 
         self.nexthop_2_part = self.cfg.get_nexthop_2_part()
 
-        # VNHs related params
-        self.num_VNHs_in_use = 0
-        self.VNH_2_prefix = {}
-        self.prefix_2_VNH = {}
+        # VNHs related params, the dicts are string views of the allocator
+        if self.cfg.vnh_sharing and self.cfg.isSupersetsMode():
+            self.vnhs = SharedVNHAllocator(self.cfg.VNHs, self.cfg.vnh_grace_period, self.has_local_route, self.vnh_reclaimed)
+        else:
+            self.vnhs = VNHAllocator(self.cfg.VNHs, self.cfg.vnh_grace_period, self.has_local_route, self.vnh_reclaimed)
+        # freed VNHs the ARP proxy still has to drop from its reply cache
+        self.reclaimed_vnhs = deque()
+        self.VNH_2_prefix = self.vnhs.VNH_2_prefix
+        self.prefix_2_VNH = self.vnhs.prefix_2_VNH
 
 
         # Superset related params
@@ -83,8 +92,7 @@ class ParticipantController(object):
         self.bgp_instance = self.cfg.get_bgp_instance()
 
         # Route server client, Reference monitor client, Arp Proxy client
-        self.xrs_client = self.cfg.get_xrs_client(self.logger)
-	self.xrs_client.send({'msgType': 'hello', 'id': self.cfg.id, 'peers_in': self.cfg.peers_in, 'peers_out': self.cfg.peers_out, 'ports': self.cfg.get_ports()})
+        snapshot, pending = self.connect_xrs()
 
         self.arp_client = self.cfg.get_arp_client(self.logger)
         self.arp_client.send({'msgType': 'hello', 'macs': self.cfg.get_macs()})
@@ -94,9 +102,15 @@ class ParticipantController(object):
         self.fm_builder = FlowModMsgBuilder(self.id, self.refmon_client.key)
 
         # Send flow rules for initial policies to the SDX's Reference Monitor
-        self.initialize_dataplane()
+        updates = self.initialize_dataplane(snapshot)
         self.push_dp()
 
+        # Announce the snapshot routes to our routers
+        self.update_peers(updates)
+
+        # then what XRS sent while the snapshot was on its way
+        self.process_pending(pending)
+
         # Start the event handlers
         ps_thread_arp = Thread(target=self.start_eh_arp)
         ps_thread_arp.daemon = True
@@ -128,9 +142,79 @@ class ParticipantController(object):
                     policy['action']['fwd'] = 0
 
 
-    def initialize_dataplane(self):
+    def connect_xrs(self):
+        "Say hello to XRS, it answers with the routes it currently has for us. Returns them and the messages received meanwhile."
+        self.xrs_client = self.cfg.get_xrs_client(self.logger)
+        self.xrs_client.send({'msgType': 'hello', 'id': self.cfg.id, 'peers_in': self.cfg.peers_in, 'peers_out': self.cfg.peers_out, 'ports': self.cfg.get_ports()})
+        return self.receive_snapshot()
+
+
+    def reconnect_xrs(self):
+        "XRS dropped us, e.g. because we fell behind: reconnect and catch up from its snapshot"
+        self.xrs_client.close()
+        snapshot, pending = self.connect_xrs()
+
+        # routes XRS doesn't have anymore were withdrawn while we weren't listening
+        announced = set()
+        for route in snapshot:
+            neighbor = route['neighbor']
+            for prefixes in neighbor['message']['update']['announce']['ipv4 unicast'].itervalues():
+                announced.update((neighbor['ip'], prefix) for prefix in prefixes)
+        withdrawn = {}
+        for route in self.bgp_instance.rib['input'].get_all():
+            if (route.neighbor, route.prefix) not in announced:
+                withdrawn.setdefault(route.neighbor, {})[route.prefix] = {}
+
+        self.logger.info("Resyncing with XRS: "+str(sum(map(len, withdrawn.values())))+" routes withdrawn, "+str(len(snapshot))+" updates")
+        for ip, prefixes in withdrawn.iteritems():
+            self.process_bgp_route({'neighbor': {'ip': ip, 'message': {'update': {'withdraw': {'ipv4 unicast': prefixes}}}}})
+        # routes we have already are no change for the decision process
+        for route in snapshot:
+            self.process_bgp_route(route)
+        self.process_pending(pending)
+
+
+    def receive_snapshot(self):
+        "Collect the routes XRS sends in response to our hello, and the other messages in between"
+        routes = []
+        pending = []
+        while True:
+            data = json.loads(self.xrs_client.recv())
+            if 'bgp_snapshot' not in data:
+                # applied once the snapshot is
+                self.logger.debug("Queueing XRS message received during the snapshot: "+str(data))
+                pending.append(data)
+                continue
+            routes.extend(data['bgp_snapshot'])
+            if data['done']:
+                break
+
+        self.logger.info("Received snapshot of "+str(len(routes))+" routes and "+str(len(pending))+" other messages from XRS")
+        return routes, pending
+
+
+    def process_pending(self, pending):
+        "Process the XRS messages that arrived with the snapshot, in order"
+        for data in pending:
+            self.process_event(data)
+
+
+    def initialize_dataplane(self, snapshot):
         "Read the config file and update the queued policy variable"
 
+        # Load the snapshot into the ribs first, so that VNHs and supersets
+        # are computed once for the whole table
+        tstart = time.time()
+        updates = []
+        for route in snapshot:
+            updates.extend(self.bgp_instance.update(route))
+        for update in updates:
+            self.bgp_instance.decision_process_local(update)
+
+        if TIMING:
+            elapsed = time.time() - tstart
+            self.logger.debug("Time taken to load snapshot: "+str(elapsed))
+
         self.logger.info("Initializing inbound rules")
 
         final_switch = "main-in"
@@ -152,11 +236,12 @@ class ParticipantController(object):
                 rule_msgs['changes'] = []
             rule_msgs['changes'] += rule_msgs2['changes']
 
-        #TODO: Initialize Outbound Policies from RIB
         self.logger.debug("Rule Messages:: "+str(rule_msgs))
         if 'changes' in rule_msgs:
             self.dp_queued.extend(rule_msgs["changes"])
 
+        return updates
+
 
     def push_dp(self):
         '''
@@ -223,7 +308,11 @@ class ParticipantController(object):
                 continue
             try:
                 tmp = self.xrs_client.recv()
-            except EOFError:
+            except (EOFError, IOError):
+                if self.run:
+                    self.logger.warn("Lost the connection to XRS, reconnecting")
+                    self.reconnect_xrs()
+                    continue
                 break
 
             data = json.loads(tmp)
@@ -305,12 +394,21 @@ class ParticipantController(object):
 
 
 
-    def process_arp_request(self, part_mac, vnh):
+    def get_vmac(self, vnh):
         vmac = ""
         if self.cfg.isSupersetsMode():
             vmac = self.supersets.get_vmac(self, vnh)
         else:
             vmac = "whoa" # MDS vmac goes here
+        return vmac
+
+
+    def process_arp_request(self, part_mac, vnh):
+        vmac = self.get_vmac(vnh)
+
+        if vmac == "":
+            self.logger.debug("No VMAC for VNH "+str(vnh)+", not sending ARP")
+            return
 
         arp_responses = list()
 
@@ -349,15 +447,41 @@ class ParticipantController(object):
             self.arp_client.send(arp_response)
 
 
-    def getlock(self, prefixes):
-        prefixes.sort()
-        hsh = "-".join(prefixes)
-        if hsh not in self.prefix_lock:
-            #self.logger.debug("First Lock:: "+str(hsh))
-            self.prefix_lock[hsh] = RLock()
-        #else:
-            #self.logger.debug("Repeat :: "+str(hsh))
-        return self.prefix_lock[hsh]
+    def send_gratuitous_arps(self, vnhs):
+        "Re-ARP the VNHs on all our ports, in bulk garp messages to the ARP proxy"
+        # the ARP proxy sends one gratuitous ARP per (vnh, vmac) to each of them
+        eth_dsts = [vmac_part_port_match(self.id, i, self.supersets, False) for i in range(len(self.cfg.ports))]
+
+        garps = []
+        for vnh in vnhs:
+            vmac = self.get_vmac(vnh)
+            if vmac == "":
+                self.logger.debug("No VMAC for VNH "+str(vnh)+", not sending ARP")
+                continue
+            garps.append((vnh, vmac))
+
+        self.logger.debug("Sending "+str(len(garps))+" Gratuitous ARPs to "+str(len(eth_dsts))+" ports")
+
+        for i in range(0, len(garps), GARP_BULK_SIZE):
+            self.arp_client.send({'msgType': 'garps',
+                                  'garps': garps[i:i + GARP_BULK_SIZE],
+                                  'eth_dsts': eth_dsts})
+
+
+    def send_invalidations(self):
+        "Tell the ARP proxy to forget the VMACs of the VNHs freed since the last call"
+        vnhs = []
+        while self.reclaimed_vnhs:
+            vnhs.append(self.reclaimed_vnhs.popleft())
+        if not vnhs:
+            return
+
+        self.logger.debug("Invalidating "+str(len(vnhs))+" freed VNHs")
+
+        for i in range(0, len(vnhs), GARP_BULK_SIZE):
+            self.arp_client.send({'msgType': 'invalidate',
+                                  'vnhs': vnhs[i:i + GARP_BULK_SIZE]})
+
 
     def process_bgp_route(self, route):
         "Process each incoming BGP advertisement"
@@ -369,13 +493,17 @@ class ParticipantController(object):
         # TODO: This step should be parallelized
         # TODO: The decision process for these prefixes is going to be same, we
         # should think about getting rid of such redundant computations.
+        # prefixes that moved to another VNH and have to be announced again
+        moved_prefixes = set()
         for update in updates:
             self.bgp_instance.decision_process_local(update)
-            self.vnh_assignment(update)
+            if self.vnh_assignment(update):
+                moved_prefixes.add(update['announce' if 'announce' in update else 'withdraw'].prefix)
 
         if TIMING:
             elapsed = time.time() - tstart
             self.logger.debug("Time taken for decision process: "+str(elapsed))
+            self.logger.debug("Prefix locks: "+self.bgp_instance.prefix_locks.stats())
             tstart = time.time()
 
         if self.cfg.isSupersetsMode():
@@ -433,8 +561,18 @@ class ParticipantController(object):
             self.logger.debug("Time taken to push dp msgs: "+str(elapsed))
             tstart = time.time()
 
+        self.update_peers(updates, garp_required_vnhs, moved_prefixes)
+
+        if TIMING:
+            elapsed = time.time() - tstart
+            self.logger.debug("Time taken to send garps/announcements: "+str(elapsed))
+            tstart = time.time()
+
+
+    def update_peers(self, updates, garp_required_vnhs=[], moved_prefixes=()):
+        "Announce the new best routes to our routers and re-ARP their VNHs"
         changed_vnhs, announcements = self.bgp_instance.bgp_update_peers(updates,
-                self.prefix_2_VNH, self.cfg.ports)
+                self.prefix_2_VNH, self.cfg.ports, moved_prefixes)
 
         """ Combine the VNHs which have changed BGP default routes with the
             VNHs which have changed supersets.
@@ -443,20 +581,18 @@ class ParticipantController(object):
         changed_vnhs = set(changed_vnhs)
         changed_vnhs.update(garp_required_vnhs)
 
+        # VNHs freed or handed to another prefix must not be answered from the
+        # proxy's cache, a reassigned one gets its new VMAC with the garps
+        self.send_invalidations()
+
         # Send gratuitous ARP responses for all them
-        for vnh in changed_vnhs:
-            self.process_arp_request(None, vnh)
+        self.send_gratuitous_arps(changed_vnhs)
 
         # Tell Route Server that it needs to announce these routes
         for announcement in announcements:
             # TODO: Complete the logic for this function
             self.send_announcement(announcement)
 
-        if TIMING:
-            elapsed = time.time() - tstart
-            self.logger.debug("Time taken to send garps/announcements: "+str(elapsed))
-            tstart = time.time()
-
 
     def send_announcement(self, announcement):
         "Send the announcements to XRS"
@@ -465,43 +601,60 @@ class ParticipantController(object):
 
 
     def vnh_assignment(self, update):
-        "Assign VNHs for the advertised prefixes"
+        "Assign VNHs for the advertised prefixes, True if the prefix moved to another VNH"
         if self.cfg.isSupersetsMode():
             " Superset"
-            # TODO: Do we really need to assign a VNH for each advertised prefix?
             if ('announce' in update):
                 prefix = update['announce'].prefix
-
-                if (prefix not in self.prefix_2_VNH):
-                    # get next VNH and assign it the prefix
-                    self.num_VNHs_in_use += 1
-                    vnh = str(self.cfg.VNHs[self.num_VNHs_in_use])
-
-                    self.prefix_2_VNH[prefix] = vnh
-                    self.VNH_2_prefix[vnh] = prefix
+                if self.cfg.vnh_sharing:
+                    return self.vnhs.assign(prefix, time.time(), self.vnh_class(prefix))
+                self.vnhs.assign(prefix, time.time())
+
+            elif ('withdraw' in update):
+                # the VNH is withdrawn along with the route and reused after the grace period
+                prefix = update['withdraw'].prefix
+                if not self.has_local_route(prefix):
+                    self.vnhs.release(prefix, time.time())
+                elif self.cfg.vnh_sharing and prefix in self.prefix_2_VNH:
+                    # one advertiser less, the prefix may be in another class now
+                    return self.vnhs.assign(prefix, time.time(), self.vnh_class(prefix))
         else:
             "Disjoint"
             # TODO: @Robert: Place your logic here for VNH assignment for MDS scheme
             self.logger.debug("VNH assignment called for disjoint vmac_mode")
 
 
+    def vnh_reclaimed(self, prefix, vnh):
+        self.reclaimed_vnhs.append(vnh)
+
+
+    def has_local_route(self, prefix):
+        return self.bgp_instance.get_route('local', prefix) is not None
+
+
+    def vnh_class(self, prefix):
+        "Prefixes with the same advertisers and best next hop get the same VMAC, so they can share a VNH"
+        advertisers = frozenset(get_all_participants_advertising(self, prefix))
+        route = self.bgp_instance.get_route('local', prefix)
+        nexthop_part = self.nexthop_2_part.get(route.next_hop) if route is not None else None
+        return (advertisers, nexthop_part)
+
+
     def init_vnh_assignment(self):
         "Assign VNHs for the advertised prefixes"
         if self.cfg.isSupersetsMode():
             " Superset"
-            # TODO: Do we really need to assign a VNH for each advertised prefix?
             #self.bgp_instance.rib["local"].dump()
             prefixes = self.bgp_instance.rib["local"].get_prefixes()
             #print 'init_vnh_assignment: prefixes:', prefixes
             #print 'init_vnh_assignment: prefix_2_VNH:', self.prefix_2_VNH
+            now = time.time()
             for prefix in prefixes:
-                if (prefix not in self.prefix_2_VNH):
-                    # get next VNH and assign it the prefix
-                    self.num_VNHs_in_use += 1
-                    vnh = str(self.cfg.VNHs[self.num_VNHs_in_use])
-
-                    self.prefix_2_VNH[prefix] = vnh
-                    self.VNH_2_prefix[vnh] = prefix
+                if self.cfg.vnh_sharing:
+                    self.vnhs.assign(prefix, now, self.vnh_class(prefix))
+                else:
+                    self.vnhs.assign(prefix, now)
+            self.logger.debug("VNHs: " + self.vnhs.stats())
         else:
             "Disjoint"
             # TODO: @Robert: Place your logic here for VNH assignment for MDS scheme
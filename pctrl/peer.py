@@ -5,7 +5,6 @@
 #  Arpit Gupta (Princeton)
 
 
-from threading import RLock
 import time
 
 import os
@@ -16,6 +15,7 @@ if np not in sys.path:
 import util.log
 
 from decision_process import decision_process, best_path_selection
+from locks import StripedLocks
 from ribm import rib, RibTuple
 
 
@@ -25,7 +25,7 @@ class BGPPeer(object):
         self.id = id
         self.asn = asn
         self.ports = ports
-        self.prefix_lock = {}
+        self.prefix_locks = StripedLocks()
         self.logger = util.log.getLogger('P'+str(self.id)+'-peer')
 
         self.rib = {"input": rib(str(self.asn),"input"),
@@ -186,7 +186,7 @@ class BGPPeer(object):
                     self.logger.debug(" Peer Object for: "+str(self.id)+" --- This is weird. How can we not have any delete object in this function")
 
 
-    def bgp_update_peers(self, updates, prefix_2_VNH, ports):
+    def bgp_update_peers(self, updates, prefix_2_VNH, ports, moved_prefixes=()):
         # TODO: Verify if the new logic makes sense
         changed_vnhs = []
         announcements = []
@@ -221,8 +221,8 @@ class BGPPeer(object):
             #self.logger.debug("**********best route for: "+str(prefix)+" route:: "+str(best_route))
 
             if ('announce' in update):
-                # Check if best path has changed for this prefix
-                if not bgp_routes_are_equal(best_route, prev_route):
+                # Check if best path or the VNH has changed for this prefix
+                if not bgp_routes_are_equal(best_route, prev_route) or prefix in moved_prefixes:
                     # store announcement in output rib
                     # self.logger.debug(str(best_route)+' '+str(prev_route))
                     self.update_route("output", best_route)
@@ -244,8 +244,8 @@ class BGPPeer(object):
                 # A new announcement is only needed if the best path has changed
                 if best_route:
                     "There is a best path available for this prefix"
-                    if not bgp_routes_are_equal(best_route, prev_route):
-                        "There is a new best path available now"
+                    if not bgp_routes_are_equal(best_route, prev_route) or prefix in moved_prefixes:
+                        "There is a new best path or VNH available now"
                         # store announcement in output rib
                         self.update_route("output", best_route)
 
@@ -274,9 +274,7 @@ class BGPPeer(object):
 
 
     def getlock(self, prefix):
-        if prefix not in self.prefix_lock:
-            self.prefix_lock[prefix] = RLock()
-        return self.prefix_lock[prefix]
+        return self.prefix_locks.get(prefix)
 
 
     def process_notification(self,route):
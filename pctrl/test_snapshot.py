@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#  Author:
+#  Rudiger Birkner (Networked Systems Group ETH Zurich)
+
+
+import json
+import unittest
+
+from participant_controller import ParticipantController
+import util.log
+
+
+def announce(ip, prefix):
+    return {'neighbor': {'ip': ip, 'message': {'update': {'announce': {'ipv4 unicast': {ip: {prefix: {}}}}}}}}
+
+
+def withdraw(ip, prefix):
+    return {'neighbor': {'ip': ip, 'message': {'update': {'withdraw': {'ipv4 unicast': {prefix: {}}}}}}}
+
+
+class FakeXRSClient(object):
+    def __init__(self, messages):
+        self.messages = [json.dumps(msg) for msg in messages]
+        self.sent = []
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+    def recv(self):
+        return self.messages.pop(0)
+
+    def close(self):
+        pass
+
+
+class FakeConfig(object):
+    id = 1
+    peers_in = [2]
+    peers_out = [2]
+
+    def __init__(self, client):
+        self.client = client
+
+    def get_xrs_client(self, logger):
+        return self.client
+
+    def get_ports(self):
+        return ['172.0.0.1']
+
+
+class FakeRib(object):
+    def get_all(self):
+        return []
+
+
+class FakeBGPPeer(object):
+    rib = {'input': FakeRib()}
+
+
+''' updates XRS sends while the snapshot is on its way must not get lost '''
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pctrl = ParticipantController.__new__(ParticipantController)
+        self.pctrl.logger = util.log.getLogger('test')
+        self.pctrl.bgp_instance = FakeBGPPeer()
+        self.routes = []
+        self.pctrl.process_bgp_route = self.routes.append
+
+    def test_update_during_snapshot_is_applied_after_it(self):
+        update = withdraw('172.0.0.21', '100.0.0.0/24')
+        client = FakeXRSClient([{'bgp_snapshot': [announce('172.0.0.21', '100.0.0.0/24')], 'done': False},
+                                {'bgp': update},
+                                {'bgp_snapshot': [announce('172.0.0.21', '110.0.0.0/24')], 'done': True}])
+        self.pctrl.cfg = FakeConfig(client)
+        self.pctrl.xrs_client = client
+
+        self.pctrl.reconnect_xrs()
+
+        self.assertEqual(client.sent[0]['msgType'], 'hello')
+        self.assertEqual(self.routes, [announce('172.0.0.21', '100.0.0.0/24'),
+                                       announce('172.0.0.21', '110.0.0.0/24'),
+                                       update])
+        self.assertEqual(client.messages, [])
+
+    def test_receive_snapshot_keeps_other_messages(self):
+        self.pctrl.xrs_client = FakeXRSClient([{'bgp': withdraw('172.0.0.21', '100.0.0.0/24')},
+                                               {'bgp_snapshot': [], 'done': True}])
+        routes, pending = self.pctrl.receive_snapshot()
+        self.assertEqual(routes, [])
+        self.assertEqual(pending, [{'bgp': withdraw('172.0.0.21', '100.0.0.0/24')}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+#  Author:
+#  Rudiger Birkner (Networked Systems Group ETH Zurich)
+
+
+from collections import deque
+import socket
+import struct
+
+
+IPV4 = struct.Struct('!I')
+
+# seconds a withdrawn prefix keeps its VNH, routers may still use it for a while
+VNH_GRACE_PERIOD = 300
+
+
+class VNHsExhausted(Exception):
+    pass
+
+
+''' hands out the addresses of the VNH range by index and takes them back once their prefix is gone '''
+class VNHAllocator(object):
+    def __init__(self, vnhs, grace_period=VNH_GRACE_PERIOD, in_use=None, on_reclaim=None):
+        # index i is the address network + i, the network address itself is never handed out
+        self.network = int(vnhs.network)
+        self.size = vnhs.size - 1
+        self.grace_period = grace_period
+        # in_use(prefix) is asked before a VNH is reused, the withdrawal may have been stale
+        self.in_use = in_use
+        # on_reclaim(prefix, vnh) is told when a VNH is freed, caches of its VMAC are stale from now on
+        self.on_reclaim = on_reclaim
+
+        # index -> prefix, None for index 0 and the free ones
+        self.prefixes = [None]
+        self.indexes = {}
+        self.free = []
+
+        # (withdrawn at, index) in withdrawal order, withdrawn_at says which are still current
+        self.withdrawn = deque()
+        self.withdrawn_at = {}
+
+        self.prefix_2_VNH = PrefixVNHs(self)
+        self.VNH_2_prefix = VNHPrefixes(self)
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def to_vnh(self, index):
+        return socket.inet_ntoa(IPV4.pack(self.network + index))
+
+    def to_index(self, vnh):
+        try:
+            index = IPV4.unpack(socket.inet_aton(vnh))[0] - self.network
+        except (socket.error, TypeError):
+            return None
+        if 0 < index < len(self.prefixes):
+            return index
+        return None
+
+    def assign(self, prefix, now):
+        "Index of the prefix's VNH, a new or reclaimed one if it has none"
+        index = self.indexes.get(prefix)
+        if index is not None:
+            # announced again before its VNH was reclaimed
+            self.withdrawn_at.pop(index, None)
+            return index
+
+        self.reclaim(now)
+        if self.free:
+            index = self.free.pop()
+        else:
+            index = len(self.prefixes)
+            if index >= self.size:
+                raise VNHsExhausted('all %d VNHs are in use' % (self.size - 1))
+            self.prefixes.append(None)
+
+        self.prefixes[index] = prefix
+        self.indexes[prefix] = index
+        return index
+
+    def release(self, prefix, now):
+        "The prefix was withdrawn, its VNH is reused once the grace period is over"
+        index = self.indexes.get(prefix)
+        if index is None or index in self.withdrawn_at:
+            return
+        self.withdrawn_at[index] = now
+        self.withdrawn.append((now, index))
+
+    def reclaim(self, now):
+        withdrawn = self.withdrawn
+        while withdrawn and now - withdrawn[0][0] >= self.grace_period:
+            withdrawn_at, index = withdrawn.popleft()
+            if self.withdrawn_at.get(index) != withdrawn_at:
+                # announced again since
+                continue
+            del self.withdrawn_at[index]
+
+            prefix = self.prefixes[index]
+            if self.in_use is not None and self.in_use(prefix):
+                continue
+            del self.indexes[prefix]
+            self.prefixes[index] = None
+            self.free.append(index)
+            if self.on_reclaim is not None:
+                self.on_reclaim(prefix, self.to_vnh(index))
+
+    def stats(self):
+        return 'prefixes=%d high water=%d free=%d withdrawn=%d' % (
+            len(self.indexes), len(self.prefixes) - 1, len(self.free), len(self.withdrawn_at))
+
+
+''' prefix -> VNH string view of the allocator '''
+class PrefixVNHs(object):
+    def __init__(self, allocator):
+        self.allocator = allocator
+
+    def __getitem__(self, prefix):
+        return self.allocator.to_vnh(self.allocator.indexes[prefix])
+
+    def __contains__(self, prefix):
+        return prefix in self.allocator.indexes
+
+    def __len__(self):
+        return len(self.allocator.indexes)
+
+    def keys(self):
+        return self.allocator.indexes.keys()
+
+
+''' VNH string -> prefix view of the allocator '''
+class VNHPrefixes(object):
+    def __init__(self, allocator):
+        self.allocator = allocator
+
+    def __getitem__(self, vnh):
+        index = self.allocator.to_index(vnh)
+        if index is None or self.allocator.prefixes[index] is None:
+            raise KeyError(vnh)
+        return self.allocator.prefixes[index]
+
+    def __contains__(self, vnh):
+        index = self.allocator.to_index(vnh)
+        return index is not None and self.allocator.prefixes[index] is not None
+
+    def __len__(self):
+        return len(self.allocator.indexes)
+
+    def keys(self):
+        to_vnh = self.allocator.to_vnh
+        return [to_vnh(index) for index, prefix in enumerate(self.allocator.prefixes) if prefix is not None]
+
+
+''' one VNH per class of prefixes, prefixes of a class get the same VMAC '''
+class SharedVNHAllocator(object):
+    def __init__(self, vnhs, grace_period=VNH_GRACE_PERIOD, in_use=None, on_reclaim=None):
+        # the classes are what the allocator hands VNHs out to
+        self.classes = VNHAllocator(vnhs, grace_period, self.class_in_use, self.class_reclaimed)
+        self.in_use = in_use
+        # on_reclaim(class, vnh) is told when the VNH of a class is freed
+        self.on_reclaim = on_reclaim
+
+        self.prefix_2_class = {}
+        # class -> its announced prefixes
+        self.members = {}
+        # class -> withdrawn prefixes that still resolve to its VNH
+        self.gone = {}
+
+        self.prefix_2_VNH = SharedPrefixVNHs(self)
+        self.VNH_2_prefix = SharedVNHPrefixes(self)
+
+    def __len__(self):
+        return len(self.prefix_2_class)
+
+    def assign(self, prefix, now, key):
+        "Put the prefix in class key, True if that changed its VNH"
+        old = self.prefix_2_class.get(prefix)
+        if old is not None and old != key:
+            self.leave(prefix, old, now, False)
+        elif old is not None:
+            self.gone.get(key, set()).discard(prefix)
+
+        self.classes.assign(key, now)
+        self.prefix_2_class[prefix] = key
+        self.members.setdefault(key, set()).add(prefix)
+        return old is not None and old != key
+
+    def release(self, prefix, now):
+        "The prefix was withdrawn, its class' VNH is reused once no prefix is left and the grace period is over"
+        key = self.prefix_2_class.get(prefix)
+        if key is not None:
+            self.leave(prefix, key, now, True)
+
+    def leave(self, prefix, key, now, withdrawn):
+        members = self.members.get(key)
+        if members is None or prefix not in members:
+            if not withdrawn:
+                self.gone.get(key, set()).discard(prefix)
+            return
+
+        members.discard(prefix)
+        if withdrawn:
+            self.gone.setdefault(key, set()).add(prefix)
+        if not members:
+            del self.members[key]
+            self.classes.release(key, now)
+
+    def class_in_use(self, key):
+        # withdrawn prefixes that have a route again after all rejoin the class
+        if self.in_use is not None:
+            gone = self.gone.get(key, set())
+            for prefix in [prefix for prefix in gone if self.in_use(prefix)]:
+                gone.discard(prefix)
+                self.members.setdefault(key, set()).add(prefix)
+        return key in self.members
+
+    def class_reclaimed(self, key, vnh):
+        for prefix in self.gone.pop(key, ()):
+            del self.prefix_2_class[prefix]
+        if self.on_reclaim is not None:
+            self.on_reclaim(key, vnh)
+
+    def prefix_of(self, index):
+        "A prefix of the class at index, they all resolve to the same VMAC"
+        key = self.classes.prefixes[index]
+        if key is None:
+            return None
+        for prefix in self.members.get(key) or self.gone.get(key) or ():
+            return prefix
+        return None
+
+    def stats(self):
+        return 'prefixes=%d classes=%d %s' % (len(self.prefix_2_class), len(self.classes), self.classes.stats())
+
+
+''' prefix -> VNH string view of the shared allocator '''
+class SharedPrefixVNHs(object):
+    def __init__(self, allocator):
+        self.allocator = allocator
+
+    def __getitem__(self, prefix):
+        classes = self.allocator.classes
+        return classes.to_vnh(classes.indexes[self.allocator.prefix_2_class[prefix]])
+
+    def __contains__(self, prefix):
+        return prefix in self.allocator.prefix_2_class
+
+    def __len__(self):
+        return len(self.allocator.prefix_2_class)
+
+    def keys(self):
+        return self.allocator.prefix_2_class.keys()
+
+
+''' VNH string -> prefix view of the shared allocator, one prefix per class '''
+class SharedVNHPrefixes(object):
+    def __init__(self, allocator):
+        self.allocator = allocator
+
+    def __getitem__(self, vnh):
+        index = self.allocator.classes.to_index(vnh)
+        prefix = self.allocator.prefix_of(index) if index is not None else None
+        if prefix is None:
+            raise KeyError(vnh)
+        return prefix
+
+    def __contains__(self, vnh):
+        index = self.allocator.classes.to_index(vnh)
+        return index is not None and self.allocator.prefix_of(index) is not None
+
+    def __len__(self):
+        return len(self.allocator.classes)
+
+    def keys(self):
+        return self.allocator.classes.VNH_2_prefix.keys()
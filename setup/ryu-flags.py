@@ -5,6 +5,8 @@ CONF.register_cli_opts([
                help='path of config file'),
     cfg.StrOpt('flowmodlog', default=None,
                help='path of flowmod log file'),
+    cfg.StrOpt('flowmodlogformat', default='text',
+               help='format of the flowmod log file: text or binary'),
     cfg.StrOpt('input', default=None,
                help='path of input file'),
     cfg.StrOpt('log', default=None,
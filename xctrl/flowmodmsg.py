@@ -3,6 +3,9 @@
 #  Rudiger Birkner (Networked Systems Group ETH Zurich)
 
 
+from collections import OrderedDict
+
+
 class FlowModMsgBuilder(object):
     def __init__(self, participant, key):
         self.participant = participant
@@ -36,13 +39,14 @@ class FlowModMsgBuilder(object):
         self.flow_mods.append(fm)
 
     def get_msg(self):
-        msg = {
-                "auth_info": {
-                               "participant" : self.participant,
-                               "key" : self.key
-                             },
-                "flow_mods": self.flow_mods
-              }
+        # auth_info first, the refmon tells whose a connection is from its first bytes
+        msg = OrderedDict([
+                ("auth_info", OrderedDict([
+                               ("participant", self.participant),
+                               ("key", self.key)
+                             ])),
+                ("flow_mods", self.flow_mods)
+              ])
 
         return msg
 
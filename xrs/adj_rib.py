@@ -0,0 +1,51 @@
+from coalesce import group_updates
+
+
+''' routes currently announced by each neighbor (Adj-RIB-In) '''
+class AdjRibIn(object):
+
+    def __init__(self):
+        # neighbor ip -> {prefix: (route template, attribute, next hop)}
+        self.neighbors = {}
+
+    def update(self, route):
+        try:
+            neighbor = route['neighbor']
+            ip = neighbor['ip']
+        except KeyError:
+            return
+
+        if neighbor.get('state') == 'down':
+            self.neighbors.pop(ip, None)
+            return
+
+        try:
+            update = neighbor['message']['update']
+        except (KeyError, TypeError):
+            return
+
+        # an update may carry both, the withdrawals come first
+        rib = self.neighbors.setdefault(ip, {})
+        withdraw = update.get('withdraw', {}).get('ipv4 unicast', {})
+        for prefix in withdraw:
+            rib.pop(prefix, None)
+
+        announce = update.get('announce', {}).get('ipv4 unicast', {})
+        attribute = update.get('attribute')
+        for next_hop, prefixes in announce.iteritems():
+            for prefix in prefixes:
+                rib[prefix] = (route, attribute, next_hop)
+
+    def snapshot(self, ips, chunk_size):
+        "Yield the routes of the given neighbors as lists of at most chunk_size updates"
+        entries = []
+        for ip in ips:
+            for prefix, value in self.neighbors.get(ip, {}).iteritems():
+                entries.append(((ip, prefix), value))
+
+        updates = group_updates(entries)
+        for i in xrange(0, len(updates), chunk_size):
+            yield updates[i:i + chunk_size]
+
+    def count(self):
+        return sum(len(rib) for rib in self.neighbors.itervalues())
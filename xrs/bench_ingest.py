@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+'''
+Measure the ExaBGP -> client.py -> server.py ingest rate.
+
+A synthetic ExaBGP stand-in spawns client.py exactly like ExaBGP would and
+writes JSON updates to its stdin as fast as it can, while server.py reads
+them back in batches.
+'''
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from threading import Thread
+
+from server import server as Server
+
+
+def make_update(i):
+    prefix = '%d.%d.%d.0/24' % (10 + (i >> 16) % 200, (i >> 8) & 0xff, i & 0xff)
+    return json.dumps({
+        "exabgp": "3.4.8", "time": time.time(), "type": "update",
+        "neighbor": {"ip": "172.0.0.1", "address": {"local": "172.0.255.254", "peer": "172.0.0.1"},
+                     "message": {"update": {
+                         "attribute": {"origin": "igp", "as-path": [100, 200], "confederation-path": []},
+                         "announce": {"ipv4 unicast": {"172.0.0.1": {prefix: {}}}}}}}})
+
+
+def exabgp_standin(stdin, count):
+    lines = [make_update(i) + '\n' for i in range(min(count, 65536))]
+    for i in xrange(count):
+        stdin.write(lines[i % len(lines)])
+    stdin.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--count', type=int, default=200000, help='number of updates to send')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    server = Server(logging.getLogger('bench'))
+
+    client_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'client.py')
+    client = subprocess.Popen([sys.executable, client_path], stdin=subprocess.PIPE, stdout=open(os.devnull, 'w'))
+    server.start()
+
+    feeder = Thread(target=exabgp_standin, args=(client.stdin, args.count))
+    feeder.daemon = True
+
+    received = 0
+    batches = 0
+    start = time.time()
+    feeder.start()
+    while received < args.count:
+        routes = server.recv_batch(5)
+        if not routes:
+            break
+        received += len(routes)
+        batches += 1
+    elapsed = time.time() - start
+
+    client.stdin.close()
+    client.wait()
+    server.close()
+
+    print 'received %d/%d updates in %d batches in %.3fs: %.0f updates/s' % (
+        received, args.count, batches, elapsed, received / elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,8 @@
 #  Muhammad Shahbaz (muhammad.shahbaz@gatech.edu)
 #  Arpit Gupta
 
-from multiprocessing.connection import Client
 import os
+import socket
 import sys
 from threading import Thread
 
@@ -13,6 +13,8 @@ if np not in sys.path:
     sys.path.append(np)
 import util.log
 
+from frames import FrameReader, connect, pack_frame
+
 
 sendLogger = util.log.getLogger('XRS-send')
 recvLogger = util.log.getLogger('XRS-recv')
@@ -24,35 +26,42 @@ def _write(stdout,data):
 
 ''' Sender function '''
 def _sender(conn,stdin):
-    # Warning: when the parent dies we are seeing continual
-    # newlines, so we only access so many before stopping
-    counter = 0
+    # read whatever ExaBGP has written so far and forward all complete
+    # lines in a single write
+    fd = stdin.fileno()
+    pending = ''
 
     while True:
-        try:
-            line = stdin.readline().strip()
+        data = os.read(fd, 65536)
+        if data == '':
+            # the parent died
+            break
 
-            if line == "":
-                counter += 1
-                if counter > 100:
-                    break
-                continue
-            counter = 0
+        lines = (pending + data).split('\n')
+        pending = lines.pop()
+
+        frames = [pack_frame(line.strip()) for line in lines if line.strip()]
+        if not frames:
+            continue
 
-            conn.send(line)
+        conn.sendall(''.join(frames))
 
-            sendLogger.debug(line)
+        sendLogger.debug('forwarded %d lines', len(frames))
 
-        except:
-            pass
+    # let the receiver and server.py know we are done
+    conn.shutdown(socket.SHUT_RDWR)
 
 ''' Receiver function '''
 def _receiver(conn,stdout):
+    reader = FrameReader(conn)
 
     while True:
         try:
-            line = conn.recv()
+            lines = reader.read()
+        except (EOFError, socket.error):
+            break
 
+        for line in lines:
             if line == "":
                 continue
 
@@ -61,13 +70,10 @@ def _receiver(conn,stdout):
 
             recvLogger.debug(line)
 
-        except:
-            pass
-
 ''' main '''
 if __name__ == '__main__':
 
-    conn = Client(('localhost', 6000), authkey='xrs')
+    conn = connect()
 
     sender = Thread(target=_sender, args=(conn,sys.stdin))
     sender.start()
@@ -0,0 +1,150 @@
+from collections import OrderedDict
+import json
+import time
+
+
+''' collapses bursts of BGP updates to the final state per (neighbor, prefix) '''
+class Coalescer(object):
+
+    def __init__(self, window, max_messages):
+        # a window is flushed window seconds after its first update
+        # or once it holds max_messages updates, whichever comes first
+        self.window = window
+        self.max_messages = max_messages
+
+        # (neighbor ip, prefix) -> (route template, attribute, next hop);
+        # next hop is None for a withdraw
+        self.pending = OrderedDict()
+        self.deadline = None
+        self.messages = 0
+
+        # statistics
+        self.received = 0
+        self.forwarded = 0
+        self.suppressed = 0
+
+    def add(self, route):
+        "Buffer route. Returns the routes that must be forwarded right now, in order."
+        self.received += 1
+
+        entries = split_update(route)
+        if entries is None:
+            # not a plain ipv4 update (e.g. a state change): flush what
+            # came before it and pass it through, preserving order
+            out = self.flush()
+            out.append(route)
+            self.forwarded += 1
+            return out
+
+        for key, value in entries:
+            if key in self.pending:
+                del self.pending[key]
+                self.suppressed += 1
+            self.pending[key] = value
+
+        if self.deadline is None:
+            self.deadline = time.time() + self.window
+        self.messages += 1
+
+        if self.messages >= self.max_messages:
+            return self.flush()
+        return []
+
+    def timeout(self):
+        "Seconds until the current window has to be flushed, None if nothing is pending"
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - time.time())
+
+    def due(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def flush(self):
+        "Regroup the pending state into as few updates as possible"
+        out = group_updates(self.pending.iteritems())
+
+        self.pending.clear()
+        self.deadline = None
+        self.messages = 0
+        self.forwarded += len(out)
+
+        return out
+
+    def stats(self):
+        return {'received': self.received,
+                'forwarded': self.forwarded,
+                'suppressed': self.suppressed,
+                'pending': len(self.pending)}
+
+
+def split_update(route):
+    "Break an ExaBGP update into ((neighbor, prefix), state) pairs, None if it can't be"
+    try:
+        neighbor = route['neighbor']
+        ip = neighbor['ip']
+        update = neighbor['message']['update']
+    except (KeyError, TypeError):
+        return None
+
+    if 'state' in neighbor or not set(update).issubset(('attribute', 'announce', 'withdraw')):
+        return None
+    if 'announce' in update and 'withdraw' in update:
+        return None
+
+    entries = []
+    if 'announce' in update:
+        if update['announce'].keys() != ['ipv4 unicast']:
+            return None
+        attribute = update.get('attribute')
+        for next_hop, prefixes in update['announce']['ipv4 unicast'].iteritems():
+            for prefix in prefixes:
+                entries.append(((ip, prefix), (route, attribute, next_hop)))
+    elif 'withdraw' in update:
+        if update['withdraw'].keys() != ['ipv4 unicast']:
+            return None
+        for prefix in update['withdraw']['ipv4 unicast']:
+            entries.append(((ip, prefix), (route, None, None)))
+
+    if not entries:
+        return None
+    return entries
+
+
+def group_updates(entries):
+    "Turn ((neighbor, prefix), state) pairs into as few ExaBGP updates as possible"
+    announces = OrderedDict()
+    withdraws = OrderedDict()
+    # prefixes of one update share its attribute object, only encode it once
+    attribute_keys = {}
+
+    for (ip, prefix), (template, attribute, next_hop) in entries:
+        if next_hop is None:
+            group = withdraws.setdefault(ip, (template, []))
+            group[1].append(prefix)
+        else:
+            akey = attribute_keys.get(id(attribute))
+            if akey is None:
+                akey = attribute_keys[id(attribute)] = json.dumps(attribute, sort_keys=True)
+            gkey = (ip, next_hop, akey)
+            group = announces.setdefault(gkey, (template, attribute, []))
+            group[2].append(prefix)
+
+    out = []
+    for template, prefixes in withdraws.itervalues():
+        out.append(build_update(template, {
+            'withdraw': {'ipv4 unicast': dict((prefix, {}) for prefix in prefixes)}}))
+    for (ip, next_hop, _), (template, attribute, prefixes) in announces.iteritems():
+        update = {'announce': {'ipv4 unicast': {next_hop: dict((prefix, {}) for prefix in prefixes)}}}
+        if attribute is not None:
+            update['attribute'] = attribute
+        out.append(build_update(template, update))
+
+    return out
+
+
+def build_update(template, update):
+    route = dict(template)
+    neighbor = dict(template['neighbor'])
+    neighbor['message'] = {'update': update}
+    route['neighbor'] = neighbor
+    return route
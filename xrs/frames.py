@@ -0,0 +1,94 @@
+from multiprocessing.connection import answer_challenge, deliver_challenge
+import socket
+import struct
+
+
+# where server.py listens for client.py (the process ExaBGP runs)
+XRS_ADDRESS = ('localhost', 6000)
+# shared secret of the handshake, as with the multiprocessing Listener before
+XRS_AUTHKEY = 'xrs'
+# seconds the server waits for a new client to complete the handshake
+HANDSHAKE_TIMEOUT = 5
+
+HEADER = struct.Struct('!I')
+
+
+def pack_frame(line):
+    "Length-prefix one line for the client.py <-> server.py stream"
+    if isinstance(line, unicode):
+        line = line.encode('utf-8')
+    return HEADER.pack(len(line)) + line
+
+
+def connect(address=XRS_ADDRESS, authkey=XRS_AUTHKEY):
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    answer_challenge(HandshakeChannel(sock), authkey)
+    return sock
+
+
+def authenticate(sock, authkey=XRS_AUTHKEY):
+    "Challenge a new client, raises AuthenticationError if it doesn't know authkey"
+    sock.settimeout(HANDSHAKE_TIMEOUT)
+    try:
+        deliver_challenge(HandshakeChannel(sock), authkey)
+    finally:
+        sock.settimeout(None)
+
+
+def recv_exact(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+''' runs multiprocessing.connection's HMAC handshake over the framed stream '''
+class HandshakeChannel(object):
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def send_bytes(self, data):
+        self.sock.sendall(pack_frame(data))
+
+    def recv_bytes(self, maxlength=None):
+        # reads exactly one frame, nothing of what follows the handshake
+        length = HEADER.unpack(recv_exact(self.sock, HEADER.size))[0]
+        if maxlength is not None and length > maxlength:
+            raise IOError('handshake message too long')
+        return recv_exact(self.sock, length)
+
+
+''' reassembles length-prefixed frames read from a stream socket '''
+class FrameReader(object):
+
+    def __init__(self, sock, bufsize=65536):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.buf = ''
+
+    def read(self):
+        "Read once from the socket and return every frame it completed"
+        data = self.sock.recv(self.bufsize)
+        if not data:
+            raise EOFError
+
+        buf = self.buf + data
+        size = len(buf)
+        frames = []
+
+        offset = 0
+        while size - offset >= HEADER.size:
+            length = HEADER.unpack_from(buf, offset)[0]
+            end = offset + HEADER.size + length
+            if end > size:
+                break
+            frames.append(buf[offset + HEADER.size:end])
+            offset = end
+
+        self.buf = buf[offset:]
+        return frames
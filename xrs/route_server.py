@@ -7,10 +7,11 @@
 
 import argparse
 from collections import namedtuple
+import cPickle
 import json
 from multiprocessing.connection import Listener, Client
 import os
-import Queue
+import socket
 import sys
 from threading import Thread, Lock
 import time
@@ -20,12 +21,20 @@ if np not in sys.path:
     sys.path.append(np)
 import util.log
 
+from adj_rib import AdjRibIn
+from coalesce import Coalescer
+from send_queue import SendQueue
 from server import server as Server
 
 
 logger = util.log.getLogger('XRS')
 
-Config = namedtuple('Config', 'ah_socket')
+Config = namedtuple('Config', 'ah_socket send_queue_size coalesce_window coalesce_messages')
+
+SEND_QUEUE_SIZE = 10000
+COALESCE_WINDOW_MS = 0
+COALESCE_MESSAGES = 1000
+SNAPSHOT_CHUNK = 1000
 
 bgpListener = None
 config = None
@@ -34,6 +43,15 @@ participantsLock = Lock()
 participants = dict()
 portip2participant = dict()
 
+# advertiser id -> tuple of PctrlClients that receive its routes.
+# Rebuilt under participantsLock on hello/disconnect and swapped in as a
+# whole, so BGPListener reads it without taking the lock.
+fanoutTable = dict()
+
+# routes announced by each neighbor, replayed to participant controllers on hello
+ribLock = Lock()
+adjRibIn = AdjRibIn()
+
 clientPoolLock = Lock()
 clientActivePool = dict()
 clientDeadPool = set()
@@ -48,8 +66,15 @@ class PctrlClient(object):
         self.peers_in = []
         self.peers_out = []
 
+        # route updates are written by a separate thread so that a slow
+        # participant controller doesn't stall the BGPListener
+        self.send_queue = SendQueue(config.send_queue_size)
+        self.writer = Thread(target=self.write_loop)
+        self.writer.daemon = True
+
     def start(self):
         logger.info('BGP PctrlClient started for client ip %s.', self.addr)
+        self.writer.start()
         while True:
             try:
                 rv = self.conn.recv()
@@ -75,16 +100,23 @@ class PctrlClient(object):
         with participantsLock:
             logger.debug('Trace: PctrlClient.start: portip2participant before: %s', portip2participant)
             logger.debug('Trace: PctrlClient.start: participants before: %s', participants)
-            found = [k for k,v in portip2participant.items() if v == self.id]
-            for k in found:
-                del portip2participant[k]
+            # unless the participant controller has reconnected already
+            if participants.get(self.id) is self:
+                found = [k for k,v in portip2participant.items() if v == self.id]
+                for k in found:
+                    del portip2participant[k]
 
             found = [k for k,v in participants.items() if v == self]
             for k in found:
                 del participants[k]
+
+            rebuild_fanout()
             logger.debug('Trace: PctrlClient.start: portip2participant after: %s', portip2participant)
             logger.debug('Trace: PctrlClient.start: participants after: %s', participants)
 
+        self.send_queue.close()
+        self.writer.join()
+
 
     def process_message(self, msgType=None, **data):
         if msgType == 'hello':
@@ -108,27 +140,75 @@ class PctrlClient(object):
         self.peers_in = set(peers_in)
         self.peers_out = set(peers_out)
 
-        with participantsLock:
-            logger.debug('Trace: PctrlClient.hello: portip2participant before: %s', portip2participant)
-            logger.debug('Trace: PctrlClient.hello: participants before: %s', participants)
-            for port in ports:
-                portip2participant[port] = id
-            participants[id] = self
-            logger.debug('Trace: PctrlClient.hello: portip2participant after: %s', portip2participant)
-            logger.debug('Trace: PctrlClient.hello: participants after: %s', participants)
+        # no live update can reach us before the snapshot is queued
+        with ribLock:
+            with participantsLock:
+                logger.debug('Trace: PctrlClient.hello: portip2participant before: %s', portip2participant)
+                logger.debug('Trace: PctrlClient.hello: participants before: %s', participants)
+                for port in ports:
+                    portip2participant[port] = id
+                participants[id] = self
+
+                rebuild_fanout()
+                logger.debug('Trace: PctrlClient.hello: portip2participant after: %s', portip2participant)
+                logger.debug('Trace: PctrlClient.hello: participants after: %s', participants)
+
+                # the neighbors whose routes we are allowed to see
+                ips = [ip for ip, advertise_id in portip2participant.iteritems()
+                       if self in fanoutTable.get(advertise_id, ())]
+
+            self.send_snapshot(ips)
 
         return True
 
 
+    def send_snapshot(self, ips):
+        "Send the current routes of the given neighbors, terminated by a 'done' message"
+        count = 0
+        for routes in adjRibIn.snapshot(ips, SNAPSHOT_CHUNK):
+            count += len(routes)
+            self.send((), encode_snapshot(routes, False))
+        self.send((), encode_snapshot([], True))
+
+        logger.info('Sent snapshot of %d updates from %d neighbors to participant %d', count, len(ips), self.id)
+
+
     def process_bgp_message(self, announcement=None, **data):
         if announcement:
             bgpListener.send(announcement)
         return True
 
 
-    def send(self, route):
-        logger.debug('Sending a route update to participant %d', self.id)
-        self.conn.send(json.dumps({'bgp': route}))
+    def send(self, keys, data):
+        # data is already encoded by encode_route, shared by all recipients
+        self.send_queue.put(keys, data)
+
+
+    def write_loop(self):
+        while True:
+            data = self.send_queue.get()
+            if data is None:
+                if self.send_queue.overflowed:
+                    self.disconnect()
+                break
+
+            logger.debug('Sending a route update to participant %d', self.id)
+            try:
+                self.conn.send_bytes(data)
+            except IOError:
+                logger.warn('Failed to send route update to participant %s', self.id)
+                self.send_queue.close()
+                break
+
+
+    def disconnect(self):
+        "Drop a participant controller that fell behind, it reconnects and gets a new snapshot"
+        logger.warn('Participant %s is too slow, its send queue overflowed. Disconnecting it.', self.id)
+        try:
+            # wakes up the recv() in start(), which cleans up
+            socket.fromfd(self.conn.fileno(), socket.AF_INET, socket.SOCK_STREAM).shutdown(socket.SHUT_RDWR)
+        except (IOError, socket.error) as e:
+            logger.warn('Failed to disconnect participant %s: %s', self.id, e)
 
 
 class PctrlListener(object):
@@ -174,6 +254,11 @@ class BGPListener(object):
         self.server = Server(logger)
         self.run = True
 
+        # optionally collapse bursts of updates before fan-out
+        self.coalescer = None
+        if config.coalesce_window > 0:
+            self.coalescer = Coalescer(config.coalesce_window, config.coalesce_messages)
+
 
     def start(self):
         logger.info("Starting the Server to handle incoming BGP Updates.")
@@ -181,48 +266,81 @@ class BGPListener(object):
 
         waiting = 0
         while self.run:
+            # don't wait past the end of the current coalescing window
+            timeout = 1
+            if self.coalescer:
+                remaining = self.coalescer.timeout()
+                if remaining is not None:
+                    timeout = min(timeout, remaining)
+
             # get BGP messages from ExaBGP via stdin in client.py,
-            # which is routed to server.py via port 6000,
-            # which is routed to here via receiver_queue.
-            try:
-                route = self.server.receiver_queue.get(True, 1)
-            except Queue.Empty:
+            # which is framed to server.py via port 6000
+            # and read here in batches.
+            routes = self.server.recv_batch(timeout)
+            for route in routes:
+                self.process_route(route)
+
+            if self.coalescer and self.coalescer.due():
+                for route in self.coalescer.flush():
+                    self.fan_out(route)
+
+            if not routes:
                 if waiting == 0:
                     logger.debug("Waiting for BGP update...")
                 waiting = (waiting+1) % 30
                 continue
 
             waiting = 0
-            route = json.loads(route)
 
-            logger.debug("Got route from ExaBGP: %s", route)
 
-            # Received BGP route advertisement from ExaBGP
-            try:
-                advertise_ip = route['neighbor']['ip']
-            except KeyError:
-                continue
+    def process_route(self, raw):
+        logger.debug("Got route from ExaBGP: %s", raw)
 
-            found = []
-            with participantsLock:
-                try:
-                    advertise_id = portip2participant[advertise_ip]
-                    peers_out = participants[advertise_id].peers_out
-                except KeyError:
-                    continue
+        try:
+            route = json.loads(raw)
+        except ValueError:
+            return
+
+        if self.coalescer:
+            for route in self.coalescer.add(route):
+                self.fan_out(route)
+        else:
+            self.fan_out(route, raw)
 
-                for id, peer in participants.iteritems():
-                    # Apply the filtering logic
-                    if id in peers_out and advertise_id in peer.peers_in:
-                        found.append(peer)
 
-            for peer in found:
-                # Now send this route to participant `id`'s controller'
-                peer.send(route)
+    def fan_out(self, route, raw=None):
+        # Received BGP route advertisement from ExaBGP
+        try:
+            neighbor = route['neighbor']
+            advertise_ip = neighbor['ip']
+        except KeyError:
+            return
+
+        # ribLock keeps the Adj-RIB-In and the recipients consistent with
+        # the snapshots sent on hello: a peer that registers after this is
+        # sent the update in its snapshot, one that registered before has
+        # its snapshot queued already
+        with ribLock:
+            adjRibIn.update(route)
+
+            # the filtering logic is precomputed in fanoutTable
+            advertise_id = portip2participant.get(advertise_ip)
+            found = fanoutTable.get(advertise_id)
+        if not found:
+            return
+
+        # serialize once, reuse the same bytes for every recipient
+        if raw is None:
+            raw = json.dumps(route)
+        keys = route_keys(neighbor)
+        data = encode_route(raw)
+        for peer in found:
+            # Now send this route to participant `id`'s controller'
+            peer.send(keys, data)
 
 
     def send(self, announcement):
-        self.server.sender_queue.put(announcement)
+        self.server.send(announcement)
 
 
     def stop(self):
@@ -230,6 +348,62 @@ class BGPListener(object):
         self.run = False
 
 
+def rebuild_fanout():
+    "Recompute fanoutTable from participants. Caller must hold participantsLock."
+    global fanoutTable
+
+    table = {}
+    for advertise_id, advertiser in participants.iteritems():
+        # Apply the filtering logic
+        table[advertise_id] = tuple(peer for id, peer in participants.iteritems()
+                                    if id in advertiser.peers_out and advertise_id in peer.peers_in)
+    fanoutTable = table
+
+
+def route_keys(neighbor):
+    "The (neighbor, prefix) pairs whose routing state an update describes, empty if it can't be merged"
+    try:
+        update = neighbor['message']['update']
+    except (KeyError, TypeError):
+        return ()
+
+    prefixes = []
+    if 'announce' in update and 'ipv4 unicast' in update['announce']:
+        for next_hop in update['announce']['ipv4 unicast'].itervalues():
+            prefixes.extend(next_hop.keys())
+    if 'withdraw' in update and 'ipv4 unicast' in update['withdraw']:
+        prefixes.extend(update['withdraw']['ipv4 unicast'].keys())
+
+    ip = neighbor['ip']
+    return tuple((ip, prefix) for prefix in prefixes)
+
+
+def log_stats():
+    with ribLock:
+        logger.info('Adj-RIB-In: %d routes', adjRibIn.count())
+
+    if bgpListener.coalescer:
+        stats = bgpListener.coalescer.stats()
+        logger.info('Coalescer: received %d, forwarded %d, suppressed %d, pending %d',
+                    stats['received'], stats['forwarded'], stats['suppressed'], stats['pending'])
+
+    with participantsLock:
+        peers = participants.items()
+    for id, peer in peers:
+        stats = peer.send_queue.stats()
+        logger.info('Send queue of participant %d: depth %d, lag %.3fs, oldest %.3fs, sent %d, coalesced %d',
+                    id, stats['depth'], stats['lag'], stats['oldest'], stats['sent'], stats['coalesced'])
+
+
+def encode_route(route):
+    "Wrap a raw ExaBGP JSON line in a 'bgp' message, pickled as Connection.recv() expects"
+    return cPickle.dumps('{"bgp": ' + route + '}', cPickle.HIGHEST_PROTOCOL)
+
+
+def encode_snapshot(routes, done):
+    return cPickle.dumps(json.dumps({'bgp_snapshot': routes, 'done': done}), cPickle.HIGHEST_PROTOCOL)
+
+
 def parse_config(config_file):
     "Parse the config file"
 
@@ -240,9 +414,12 @@ def parse_config(config_file):
         config = json.load(f)
 
     ah_socket = tuple(config["Route Server"]["AH_SOCKET"])
+    send_queue_size = int(config["Route Server"].get("SEND_QUEUE_SIZE", SEND_QUEUE_SIZE))
+    coalesce_window = float(config["Route Server"].get("COALESCE_WINDOW_MS", COALESCE_WINDOW_MS)) / 1000
+    coalesce_messages = int(config["Route Server"].get("COALESCE_MESSAGES", COALESCE_MESSAGES))
 
     logger.debug("Done parsing config")
-    return Config(ah_socket)
+    return Config(ah_socket, send_queue_size, coalesce_window, coalesce_messages)
 
 
 def main():
@@ -269,6 +446,7 @@ def main():
     while bp_thread.is_alive():
         try:
             time.sleep(5)
+            log_stats()
         except KeyboardInterrupt:
             bgpListener.stop()
 
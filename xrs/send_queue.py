@@ -0,0 +1,127 @@
+from collections import OrderedDict
+from threading import Condition
+import time
+
+
+''' bounded outbound queue of one participant controller '''
+class SendQueue(object):
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.cond = Condition()
+        self.closed = False
+
+        # slot -> (keys, data, enqueue time), in send order
+        self.items = OrderedDict()
+        # key -> slot of the most recent pending update for that key
+        self.latest = {}
+        # slot -> number of its keys it is the most recent update for
+        self.live = {}
+        # slots whose keys all have a more recent update pending, oldest first
+        self.superseded = OrderedDict()
+        # updates without keys don't count against maxsize
+        self.unkeyed = 0
+        self.seq = 0
+        # the queue was closed because it overflowed, the receiver has missed updates
+        self.overflowed = False
+
+        # statistics
+        self.sent = 0
+        self.coalesced = 0
+        self.lag = 0.0
+
+    def put(self, keys, data):
+        '''
+        Queue data for sending. keys are the (neighbor, prefix) pairs whose
+        routing state the update describes, empty if it cannot be merged.
+        Never blocks: when full, pending updates superseded by newer ones for
+        all of their keys are dropped. If that doesn't make room, no update
+        is dropped, the queue is closed and marked overflowed instead, so
+        that the receiver can be disconnected and resynced. Updates without
+        keys (snapshots) don't count against maxsize.
+        '''
+        with self.cond:
+            if self.closed:
+                return False
+
+            self.seq += 1
+            slot = self.seq
+            keys = frozenset(keys)
+            for key in keys:
+                old = self.latest.get(key)
+                if old is not None:
+                    self.live[old] -= 1
+                    if not self.live[old]:
+                        del self.live[old]
+                        self.superseded[old] = None
+                self.latest[key] = slot
+            if keys:
+                self.live[slot] = len(keys)
+            else:
+                self.unkeyed += 1
+            self.items[slot] = (keys, data, time.time())
+
+            while len(self.items) - self.unkeyed > self.maxsize and self.superseded:
+                old, _ = self.superseded.popitem(last=False)
+                del self.items[old]
+                self.coalesced += 1
+
+            if len(self.items) - self.unkeyed > self.maxsize:
+                self.overflowed = True
+                self.clear()
+                return False
+
+            self.cond.notify_all()
+        return True
+
+    def forget(self, slot, keys):
+        for key in keys:
+            if self.latest.get(key) == slot:
+                del self.latest[key]
+        self.live.pop(slot, None)
+        self.superseded.pop(slot, None)
+
+    def get(self):
+        "Block until data is available. Returns None once the queue is closed."
+        with self.cond:
+            while not self.items and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                return None
+
+            slot, (keys, data, enqueued) = self.items.popitem(last=False)
+            if keys:
+                self.forget(slot, keys)
+            else:
+                self.unkeyed -= 1
+
+            self.sent += 1
+            self.lag = time.time() - enqueued
+        return data
+
+    def close(self):
+        with self.cond:
+            self.clear()
+
+    def clear(self):
+        "Close the queue, caller holds cond"
+        self.closed = True
+        self.items.clear()
+        self.latest.clear()
+        self.live.clear()
+        self.superseded.clear()
+        self.unkeyed = 0
+        self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            if self.items:
+                oldest = time.time() - next(self.items.itervalues())[2]
+            else:
+                oldest = 0.0
+            return {'depth': len(self.items),
+                    'lag': self.lag,
+                    'oldest': oldest,
+                    'sent': self.sent,
+                    'coalesced': self.coalesced,
+                    'overflowed': self.overflowed}
@@ -2,57 +2,97 @@
 #  Author:
 #  Muhammad Shahbaz (muhammad.shahbaz@gatech.edu)
 
-from multiprocessing import Queue
-from multiprocessing.connection import Listener
-from threading import Thread
+from multiprocessing import AuthenticationError
+import select
+import socket
+from threading import Lock
+
+from frames import XRS_ADDRESS, FrameReader, authenticate, pack_frame
 
 ''' bgp server '''
 class server(object):
 
-    def __init__(self, logger):
+    def __init__(self, logger, address=XRS_ADDRESS):
         self.logger = logger
 
-        self.listener = Listener(('localhost', 6000), authkey='xrs', backlog=100)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen(100)
 
-        self.sender_queue = Queue()
-        self.receiver_queue = Queue()
+        self.conn = None
+        self.reader = None
+        self.send_lock = Lock()
 
     def start(self):
-        self.conn = self.listener.accept()
-        self.logger.debug('Connection accepted from '+str(self.listener.last_accepted))
-
-        self.sender = Thread(target=_sender, args=(self.conn,self.sender_queue))
-        self.sender.start()
+        self.accept(None)
 
-        self.receiver = Thread(target=_receiver, args=(self.conn,self.receiver_queue))
-        self.receiver.start()
+    def accept(self, timeout):
+        ready, _, _ = select.select([self.listener], [], [], timeout)
+        if not ready:
+            return False
 
-''' sender '''
-def _sender(conn,queue):
-    while True:
+        conn, addr = self.listener.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         try:
-            line = queue.get()
-            conn.send(line)
-        except:
-            pass
+            authenticate(conn)
+        except (AuthenticationError, EOFError, IOError, socket.error) as e:
+            self.logger.warn('Rejected connection from '+str(addr)+': '+str(e))
+            conn.close()
+            return False
+        self.logger.debug('Connection accepted from '+str(addr))
+
+        with self.send_lock:
+            self.conn = conn
+            self.reader = FrameReader(conn)
+        return True
+
+    def recv_batch(self, timeout):
+        '''
+        Return the lines ExaBGP has output so far, waiting up to timeout
+        seconds for the first one. If client.py went away, wait for it to
+        reconnect.
+        '''
+        if self.conn is None:
+            self.accept(timeout)
+            return []
+
+        ready, _, _ = select.select([self.conn], [], [], timeout)
+        if not ready:
+            return []
 
-''' receiver '''
-def _receiver(conn,queue):
-    while True:
         try:
-            line = conn.recv()
-            queue.put(line)
-        except:
-            pass
+            return self.reader.read()
+        except (EOFError, socket.error):
+            self.logger.debug('Connection to client closed')
+            self.close()
+            return []
+
+    def send(self, line):
+        with self.send_lock:
+            if self.conn is None:
+                self.logger.warn('No connection to client, dropping: '+str(line))
+                return
+            try:
+                self.conn.sendall(pack_frame(line))
+            except socket.error:
+                self.logger.warn('Sending to client failed, dropping: '+str(line))
+
+    def close(self):
+        with self.send_lock:
+            if self.conn is not None:
+                self.conn.close()
+            self.conn = None
+            self.reader = None
 
 ''' main '''
 if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=logging.DEBUG)
+
+    server = server(logging.getLogger('server'))
+    server.start()
     while True:
-        server = server()
-        while True:
-            try:
-                print server.receiver_queue.get()
-                server.sender_queue.put('announce route %s next-hop %s as-path [ %s ]' % ('200.0.0.0/16','172.0.0.1','100'))
-            except:
-                print 'thread ended'
-                break
+        for line in server.recv_batch(1):
+            print line
+            server.send('announce route %s next-hop %s as-path [ %s ]' % ('200.0.0.0/16','172.0.0.1','100'))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#  Author:
+#  Rudiger Birkner (Networked Systems Group ETH Zurich)
+
+
+import random
+import unittest
+
+from send_queue import SendQueue
+
+
+def drain(queue, state):
+    "Apply everything pending to state, as the participant controller would"
+    while queue.items:
+        keys, value = queue.get()
+        for key in keys:
+            state[key] = value
+
+
+''' no prefix may end up with a stale route on the receiving side '''
+class SendQueueTest(unittest.TestCase):
+
+    def test_final_state_kept_when_coalescing(self):
+        random.seed(1)
+        queue = SendQueue(16)
+        keys = [('172.0.0.1', '10.%d.0.0/16' % i) for i in range(16)]
+        sent, received = {}, {}
+        for i in range(10000):
+            update = random.sample(keys, random.randint(1, 3))
+            self.assertTrue(queue.put(update, (update, i)))
+            for key in update:
+                sent[key] = i
+            # a slow receiver, the queue is full most of the time
+            if random.random() < 0.1:
+                drain(queue, received)
+        drain(queue, received)
+
+        self.assertFalse(queue.overflowed)
+        self.assertTrue(queue.coalesced > 0)
+        self.assertEqual(sent, received)
+
+    def test_partly_superseded_update_is_kept(self):
+        queue = SendQueue(2)
+        a, b = ('172.0.0.1', '10.0.0.0/8'), ('172.0.0.1', '11.0.0.0/8')
+        queue.put([a, b], ([a, b], 1))
+        queue.put([a], ([a], 2))
+        queue.put([a], ([a], 3))
+        received = {}
+        drain(queue, received)
+        self.assertEqual(received, {a: 3, b: 1})
+
+    def test_overflow_closes_instead_of_dropping(self):
+        queue = SendQueue(4)
+        for i in range(4):
+            self.assertTrue(queue.put([('172.0.0.1', '10.%d.0.0/16' % i)], i))
+        # a fifth prefix doesn't fit, nothing pending supersedes anything
+        self.assertFalse(queue.put([('172.0.0.1', '10.4.0.0/16')], 4))
+        self.assertTrue(queue.overflowed)
+        self.assertEqual(queue.get(), None)
+        self.assertFalse(queue.put([('172.0.0.1', '10.0.0.0/16')], 5))
+
+    def test_snapshot_does_not_count(self):
+        queue = SendQueue(1)
+        for i in range(10):
+            self.assertTrue(queue.put((), i))
+        self.assertTrue(queue.put([('172.0.0.1', '10.0.0.0/8')], 10))
+        self.assertFalse(queue.overflowed)
+        self.assertEqual([queue.get() for i in range(11)], range(11))
+
+
+if __name__ == '__main__':
+    unittest.main()